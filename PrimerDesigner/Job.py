@@ -1,15 +1,26 @@
 import sys
 import io
 import os
-import yaml
 import uuid
+import signal
+import shutil
 import subprocess
 import hashlib
+import tempfile
+import threading
+import contextlib
 import time
 import sqlite3
-import multiprocessing
-from Bio.Blast import NCBIXML
+from xml.etree import ElementTree
 from PrimerDesigner.tools import tools
+from PrimerDesigner import config
+from PrimerDesigner import fm_index
+from PrimerDesigner import sharding
+from PrimerDesigner import megablast_index
+from PrimerDesigner import autotune
+from PrimerDesigner import kmer_sketch
+from PrimerDesigner import hit_store
+from PrimerDesigner.hitset_cache import database_fingerprint
 #from . import tools
 
 
@@ -19,13 +30,158 @@ class Job:
         self.error = error
         self.finished = finished
         self.future = future
+        self.stdout_file = None
         self.stdout = ''
         self.stderr = ''
         self.executor = executor
+        self.cancel_reason = None
+        self._cancel_event = threading.Event()
+        self._processes = []
+        self._lock = threading.Lock()
+
+    @property
+    def stdout(self):
+        # output spooled to disk is only read when it is explicitly requested
+        if self.stdout_file is not None:
+            with open(self.stdout_file, 'r') as f:
+                return f.read()
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, value):
+        self.stdout_file = None
+        self._stdout = value
+
+    def open_stdout(self):
+        """
+        Opens the output of the job for streaming
+        :return: file object
+        """
+
+        if self.stdout_file is not None:
+            return open(self.stdout_file, 'r')
+        return io.StringIO(self._stdout)
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self, reason='cancelled by user'):
+        """
+        Cancels the job, running child processes are killed together with their process group
+        :param reason: str, why the job was cancelled, only the first reason is kept
+        :return: bool, False if the job had already ended and was left unchanged
+        """
+
+        with self._lock:
+            if self.finished:
+                return False
+            if self.cancel_reason is None:
+                self.cancel_reason = reason
+            self._cancel_event.set()
+            processes = list(self._processes)
+        for proc in processes:
+            Job._kill(proc)
+        if self.future is not None and self.future.cancel():
+            # the job was still waiting in the executor
+            self.status = 'cancelled'
+            self.error = True
+            self.finished = True
+        return True
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    @staticmethod
+    def _set_limits(proc, cpu_timeout=None, memory_limit=None):
+        if cpu_timeout is None and memory_limit is None:
+            return
+        try:
+            import resource
+            prlimit = resource.prlimit
+        except (ImportError, AttributeError):
+            print('resource limits are not supported on this platform', file=sys.stderr)
+            return
+        # the limits are set right after the process started, setting them in preexec_fn is not thread-safe
+        try:
+            if cpu_timeout is not None:
+                prlimit(proc.pid, resource.RLIMIT_CPU, (int(cpu_timeout), int(cpu_timeout) + 1))
+            if memory_limit is not None:
+                prlimit(proc.pid, resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+        except ProcessLookupError:
+            pass
+
+    def run_processes(self, calls, outputs, timeout=None, cpu_timeout=None, memory_limit=None, stdin=None):
+        """
+        Runs processes concurrently, each one in its own process group so that cancel can kill it
+        :param calls: list, the calls of the processes
+        :param outputs: list, the file objects for the stdout of each process
+        :param stdin: bytes, the input of every process, e.g. the query of blastn -query -, no input if None
+        :param timeout: float, the wall-clock timeout in seconds for all processes
+        :param cpu_timeout: int, the CPU time limit in seconds of each process
+        :param memory_limit: int, the address space limit in bytes of each process
+        :return: str, the combined stderr of all processes
+        """
+
+        procs = []
+        errors = []
+        try:
+            for call, output in zip(calls, outputs):
+                errors.append(tempfile.TemporaryFile())
+                proc = subprocess.Popen(call, stdin=subprocess.PIPE if stdin is not None else None,
+                                        stdout=output, stderr=errors[-1], start_new_session=True)
+                procs.append(proc)
+                if stdin is not None:
+                    tools.feed_stdin(proc, stdin)
+                Job._set_limits(proc, cpu_timeout=cpu_timeout, memory_limit=memory_limit)
+                with self._lock:
+                    self._processes.append(proc)
+                    cancelled = self._cancel_event.is_set()
+                if cancelled:
+                    Job._kill(proc)
+
+            deadline = time.time() + timeout if timeout is not None else None
+            for proc in procs:
+                while True:
+                    try:
+                        proc.wait(timeout=0.1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        if deadline is not None and time.time() > deadline:
+                            self.cancel('wall-clock timeout of {} s exceeded'.format(timeout))
+            stderr = []
+            for call, proc in zip(calls, procs):
+                if proc.returncode is None or proc.returncode >= 0:
+                    continue
+                if cpu_timeout is not None and proc.returncode == -signal.SIGXCPU:
+                    self.cancel('CPU time limit of {} s exceeded'.format(cpu_timeout))
+                elif not self.cancelled:
+                    # killed from outside, e.g. by the OOM killer or an operator, the output is incomplete
+                    try:
+                        name = signal.Signals(-proc.returncode).name
+                    except ValueError:
+                        name = str(-proc.returncode)
+                    stderr.append('{} was terminated by signal {}\n'.format(os.path.basename(call[0]), name))
+
+            for error in errors:
+                error.seek(0)
+                stderr.append(error.read().decode('utf-8', 'replace'))
+            return ''.join(stderr)
+        finally:
+            for error in errors:
+                error.close()
+            with self._lock:
+                for proc in procs:
+                    self._processes.remove(proc)
 
     def __str__(self):
+        output = self.stdout_file if self.stdout_file is not None else self._stdout
         return str({'status': self.status, 'error': self.error, 'finished': self.finished,
-                    'output': self.stdout, 'stderr': self.stderr})
+                    'output': output, 'stderr': self.stderr, 'cancel_reason': self.cancel_reason})
 
     def __repr__(self):
         return '{}(status={}, error={}, finished={}, future={})'.format(self.__class__,
@@ -42,8 +198,11 @@ class BlastJob(Job):
         self.directory_database = ''
         self.directory_tmp = '/tmp/'
         self.directory_query = ''
+        self.directory_results = ''
         self.conf_file = conf_file
+        self.settings = None
         self.blast_db = None
+        self.shards = None
         self.get_locations()
         self.set_database(blast_db)
         self.defaults = self._get_defaults()
@@ -51,34 +210,15 @@ class BlastJob(Job):
         self.run_hash = None
 
     def get_locations(self):
-        if os.path.isfile(self.conf_file):
-            with open('/tmp/tmp.txt', 'a') as f:
-                f.write('\nfound conf file')
-
-            with open(self.conf_file, 'r') as f:
-                config = yaml.load(f)
-        else:
-            config = {'blast': os.environ.get('BLAST_EXECUTABLE'),
-                      'blast_dir': os.environ.get('BLAST_DIRECTORY')}
-        self.blast_executable = config.get('blast')
-        self.directory_database = config.get('blast_dir')
-        with open('/tmp/tmp.txt', 'a') as f:
-            f.write('\n')
-            f.write(os.getcwd())
-            f.write(str(self.blast_executable))
-            f.write('\n')
-            f.write(str(self.directory_tmp))
-            f.write('\n')
-            f.write(str(self.blast_db))
+        self.settings = config.get_settings(self.conf_file)
+        self.blast_executable = self.settings.blast_executable
+        self.directory_database = self.settings.directory_database
+        self.directory_query = self.settings.directory_query
+        self.directory_tmp = self.settings.directory_tmp
+        self.directory_results = self.settings.directory_results
         if self.blast_executable is None or (self.directory_tmp is None and not os.path.isfile(self.blast_db)):
             raise ValueError('Blast executable and database dir need to be present '
                              'in config file or environment variable')
-        if self.directory_query is None or len(self.directory_query) == 0:
-            self.directory_query = os.path.join(os.path.dirname(self.directory_database), '..', 'query')
-
-        os.makedirs(self.directory_database, exist_ok=True)
-        os.makedirs(self.directory_query, exist_ok=True)
-        os.makedirs(self.directory_tmp, exist_ok=True)
 
         return self.blast_executable, self.directory_database
 
@@ -87,26 +227,30 @@ class BlastJob(Job):
             database = 'nt'
         elif not isinstance(database, str):
             raise TypeError('database needs to be a str, got {}'.format(type(database)))
-        if os.path.isfile(database):
+        if os.path.isfile(database) or os.path.isfile(sharding.manifest_filename(database)):
             self.blast_db = database
         elif os.path.join(self.directory_database, database):
             self.blast_db = os.path.join(self.directory_database, database)
         else:
             raise ValueError('could not find database or in directory {}'.format(self.directory_database))
+        self.shards = sharding.read_manifest(self.blast_db)
+        self._database_size = None
         return self.blast_db
 
     def run(self, parameters, cache=True, query_is_file=False, delete_query_file=False):
+        tune_threads = 'num_threads' not in parameters
         parameters = self._clean_parameters(parameters, query_is_file=query_is_file)
+        if self.cancelled:
+            self._set_cancelled()
+            return parameters['job_id']
 
         if query_is_file:
             filename_query = parameters['sequence']
             with open(filename_query, 'r') as f:
                 seq = f.read()
         else:
-            filename_query = os.path.join(self.directory_query, 'blast_{}.fa'.format(parameters['job_id']))
+            filename_query = None
             seq = parameters['sequence']
-            with open(filename_query, 'w') as f:
-                f.write(seq)
         call = [self.blast_executable,
                 '-db', '{}'.format(self.blast_db),
                 '-outfmt', str(parameters['outfmt'])]
@@ -117,8 +261,10 @@ class BlastJob(Job):
                                   'window_masker_db', 'soft_masking', 'lcase_masking', 'db_soft_mask', 'db_hard_mask',
                                   'perc_identity', 'template_type', 'template_length', 'use_index', 'index_name',
                                   'xdrop_ungap', 'xdrop_gap', 'xdrop_gap_final', 'no_greedy', 'min_raw_gapped_score',
-                                  'ungapped', 'window_size', 'evalue')
-        other_blast_parameters = ('sequence', 'forward', 'reverse', 'job_id', 'num_threads', 'job_id', 'outfmt')
+                                  'ungapped', 'window_size', 'evalue', 'seqidlist', 'taxidlist', 'task',
+                                  'max_target_seqs')
+        other_blast_parameters = ('sequence', 'forward', 'reverse', 'job_id', 'num_threads', 'job_id', 'outfmt',
+                                  'timeout', 'cpu_timeout', 'memory_limit')
         for param_k, param_v in parameters.items():
             if param_k in valid_blast_parameters:
                 call.append('-{}'.format(param_k))
@@ -126,33 +272,59 @@ class BlastJob(Job):
             elif param_k not in other_blast_parameters:
                 print('encountered invalid parameters: {}'.format(param_k), file=sys.stderr)
 
-        if len(seq.split('\n', 1)[-1]) < self.defaults['short_sequence']:
-            call.append('-task')
-            call.append('blastn-short')
+        # the task is chosen before hashing, searches with different tasks report different hits and never share
+        # their cached results
+        query_length = len(seq.split('\n', 1)[-1].replace('\n', ''))
+        if 'task' in parameters:
+            task = parameters['task']
+        else:
+            task = self._autotune(parameters, query_length, tune_threads)
+            if task != 'megablast':
+                call.append('-task')
+                call.append(task)
 
         if cache:
-            self.run_hash = hashlib.md5(('_'.join(call) + '_' + seq.split('\n', 1)[-1]).encode('utf-8')).hexdigest()
+            # results of a rebuilt database are never reused
+            self.run_hash = hashlib.md5(('_'.join(call) + '_' + database_fingerprint(self.blast_db) + '_' +
+                                         seq.split('\n', 1)[-1]).encode('utf-8')).hexdigest()
             rows = self.get_cached_results()
         else:
             rows = None
 
-        if cache and len(rows) > 0:
-            self.stdout = rows[0][5]
-            self.stderr = rows[0][6]
-        else:
-            call.append('-query')
-            call.append(filename_query)
-            call.append('-num_threads')
-            call.append(str(parameters['num_threads']))
-            proc = subprocess.Popen(call,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-
-            self.status = 'running'
-            self.stdout, self.stderr = proc.communicate()
-            self.stdout, self.stderr = self.stdout.decode('utf-8'), self.stderr.decode('utf-8')
+        if not cache or not self._load_cached_results(rows):
+            if self._use_megablast_index(parameters, call):
+                # added after hashing, indexed and unindexed searches share their cached results
+                call += ['-use_index', 'true', '-index_name', self.blast_db]
+            # the output is spooled to the result directory and never held in memory
+            filename_out = os.path.join(self.directory_results,
+                                        '{}.out'.format(self.run_hash if cache else parameters['job_id']))
+            filename_tmp = '{}.{}.tmp'.format(filename_out, parameters['job_id'])
+            load = autotune.current_load()
+            t0 = time.time()
+            with self._query_input(seq, filename_query) as (query, stdin), open(filename_tmp, 'wb') as out:
+                call.append('-query')
+                call.append(query)
+                self.status = 'running'
+                if self.shards is None:
+                    call.append('-num_threads')
+                    call.append(str(parameters['num_threads']))
+                    self.stderr = self.run_processes([call], [out], stdin=stdin, **self._limits(parameters))
+                else:
+                    self.stderr = self._run_sharded(call, out, parameters, stdin=stdin)
+            if self.cancelled:
+                # partial output is never cached
+                os.remove(filename_tmp)
+                self._set_cancelled()
+                return parameters['job_id']
+            if self.stderr == '':
+                autotune.Autotuner(self.result_db).record(self.blast_db, self.database_size(), query_length, task,
+                                                          parameters['num_threads'], time.time() - t0, load=load)
+            os.replace(filename_tmp, filename_out)
+            self.stdout_file = filename_out
         if self.stderr is None or len(self.stderr) > 0:
             self.error = True
+        if not self.error and self.settings.config.get('hit_store', False):
+            self._store_hits(parameters)
         self.finished = True
         self.status = 'finished'
         if cache:
@@ -164,6 +336,172 @@ class BlastJob(Job):
                 pass
         return parameters['job_id']
 
+    def temporary_directory(self, prefix='blast_'):
+        """
+        :param prefix: str, the prefix of the directory name
+        :return: context manager which yields a private directory for the temporary files of a job, it is created
+                 in job_tmp_dir of blast.conf, e.g. a tmpfs like /dev/shm, or in the tmp directory and removed on exit
+        """
+
+        return tools.temporary_directory(self.settings.config.get('job_tmp_dir', self.directory_tmp), prefix=prefix)
+
+    @contextlib.contextmanager
+    def _query_input(self, seq, filename_query=None):
+        """
+        Provides the query of a blastn call, queries are piped into its stdin unless query_stdin is false in
+        blast.conf, then they are written to a temporary directory which is removed after the call
+        :param seq: str, the query in FASTA format
+        :param filename_query: str, a query file which is used as it is
+        :return: context manager which yields a tuple (str argument of -query, bytes stdin or None)
+        """
+
+        if filename_query is not None:
+            yield filename_query, None
+        elif self.settings.config.get('query_stdin', True):
+            yield '-', seq.encode('utf-8')
+        else:
+            with self.temporary_directory() as directory:
+                filename_query = os.path.join(directory, 'query.fa')
+                with open(filename_query, 'w') as f:
+                    f.write(seq)
+                yield filename_query, None
+
+    def database_size(self):
+        if self._database_size is None:
+            self._database_size = autotune.database_size(self.blast_db, self.shards)
+        return self._database_size
+
+    def _autotune(self, parameters, query_length, tune_threads):
+        """
+        Picks the task and, if not given, the number of threads from the timing history of similar searches
+        :param parameters: dict, the cleaned parameters, num_threads is updated
+        :param query_length: int, the length of the query
+        :param tune_threads: bool, False if num_threads was passed explicitly
+        :return: str, the task
+        """
+
+        short = self.defaults['short_sequence']
+        task = 'blastn-short' if query_length < short else 'megablast'
+        if not self.settings.config.get('autotune', True):
+            return task
+        # slightly longer queries may use the more sensitive blastn-short if it is faster, short queries never
+        # switch to megablast which could miss hits
+        tasks = ['blastn-short', 'megablast'] if short <= query_length <= 2 * short else [task]
+        threads = list(range(1, (os.cpu_count() or 1) + 1)) if tune_threads else [parameters['num_threads']]
+        if len(tasks) == 1 and len(threads) == 1:
+            return task
+        choice = autotune.Autotuner(self.result_db).choose(self.database_size(), query_length, tasks, threads)
+        if choice is None:
+            return task
+        task, parameters['num_threads'] = choice
+        return task
+
+    def _use_megablast_index(self, parameters, call):
+        if self.shards is not None or '-task' in call or not megablast_index.is_eligible(parameters):
+            return False
+        if not self.settings.config.get('megablast_index', True):
+            return False
+        status = megablast_index.index_status(self.blast_db)
+        if status == 'stale':
+            print('the megablast index of {} is older than the database and is not used, '
+                  'rebuild it with build_megablast_index'.format(self.blast_db), file=sys.stderr)
+        return status == 'current'
+
+    def build_megablast_index(self):
+        """
+        Builds megablast indexes for the database or for each of its shards, they are used automatically by run
+        :return: list, the index files
+        """
+
+        databases = [self.blast_db] if self.shards is None else self.shards['shards']
+        files = []
+        for database in databases:
+            files.extend(megablast_index.build_index(self.blast_executable, database))
+        return files
+
+    def iter_database_sequences(self):
+        """
+        Streams all sequences of the database, or of each of its shards, with blastdbcmd
+        :return: generator of str, raises ValueError if blastdbcmd failed
+        """
+
+        databases = [self.blast_db] if self.shards is None else self.shards['shards']
+        for database in databases:
+            call = [self.blast_executable.replace('blastn', 'blastdbcmd'),
+                    '-db', database,
+                    '-entry', 'all',
+                    '-outfmt', '%s']
+            with tempfile.TemporaryFile() as stderr:
+                proc = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+                try:
+                    for line in proc.stdout:
+                        yield line.strip()
+                    proc.wait()
+                finally:
+                    if proc.poll() is None:
+                        proc.kill()
+                        proc.wait()
+                    proc.stdout.close()
+                stderr.seek(0)
+                error = stderr.read().decode('utf-8').strip()
+            if proc.returncode != 0:
+                raise ValueError('blastdbcmd failed with error: {}'.format(error))
+
+    def build_kmer_sketch(self, k=None, width=None, depth=None):
+        """
+        Counts the k-mers of the database in a count-min sketch which is used to reject primers with frequent
+        3' ends before they are validated, see kmer_sketch
+        :param k: int, the k-mer length, config key kmer_prefilter_k or 12 if None
+        :param width: int, the counters per row, config key kmer_prefilter_width or 2 ** 22 if None
+        :param depth: int, the number of rows, config key kmer_prefilter_depth or 4 if None
+        :return: CountMinSketch
+        """
+
+        config = self.settings.config
+        k = int(config.get('kmer_prefilter_k', 12)) if k is None else k
+        width = int(config.get('kmer_prefilter_width', 2 ** 22)) if width is None else width
+        depth = int(config.get('kmer_prefilter_depth', 4)) if depth is None else depth
+        # databases built from a FASTA file are counted from the file, which is faster than blastdbcmd
+        if os.path.isfile(self.blast_db):
+            sequences = (seq for _, seq in tools.iter_fasta(self.blast_db))
+        else:
+            sequences = self.iter_database_sequences()
+        fingerprint = database_fingerprint(self.blast_db)
+        return kmer_sketch.build(sequences, kmer_sketch.sketch_filename(self.blast_db, k), k=k, width=width,
+                                 depth=depth, fingerprint=fingerprint)
+
+    def _store_hits(self, parameters):
+        """
+        Stores the HSPs of the finished run in the hit store, output formats without coordinates are skipped
+        The store is enabled with the config key hit_store, runs are kept for hit_store_max_age days, 30 by default
+        :param parameters: dict, the cleaned parameters
+        :return: int, the number of stored HSPs
+        """
+
+        if str(parameters['outfmt']).split(' ')[0] not in ('5', '6', '7', '10'):
+            return 0
+        run = self.run_hash if self.run_hash is not None else parameters['job_id']
+        store = hit_store.HitStore(self.result_db)
+        try:
+            store.prune(float(self.settings.config.get('hit_store_max_age', 30)) * 86400)
+            with self.open_stdout() as f:
+                return store.store(run, f, parameters['outfmt'], blast_db=self.blast_db, job=parameters['job_id'])
+        except (ValueError, ElementTree.ParseError, sqlite3.Error) as e:
+            # the hit store is an index of the output, a failure must not fail the job
+            print('could not store hits of {}: {}'.format(run, e), file=sys.stderr)
+            return 0
+
+    def _set_cancelled(self):
+        self.status = 'cancelled'
+        self.error = True
+        self.finished = True
+
+    @staticmethod
+    def _limits(parameters):
+        return {'timeout': parameters['timeout'],
+                'cpu_timeout': parameters['cpu_timeout'],
+                'memory_limit': parameters['memory_limit']}
+
     def get_cached_results(self):
         conn = sqlite3.connect(self.result_db)
         c = conn.cursor()
@@ -180,6 +518,70 @@ class BlastJob(Job):
         conn.close()
         return rows
 
+    def _run_sharded(self, call, out, parameters, stdin=None):
+        """
+        Runs blastn against all shards of the database concurrently and merges the results,
+        e-values are computed for the size of the whole database
+        :param call: list, the blastn call for the whole database
+        :param out: file object, the merged output is written to it
+        :param parameters: dict, the cleaned parameters, num_threads is split between the shards
+        :param stdin: bytes, the query which is piped into every shard search, if -query is -
+        :return: str, the combined stderr of all shards
+        """
+
+        shards = self.shards['shards']
+        num_threads = max(1, parameters['num_threads'] // len(shards))
+        calls = []
+        filenames = []
+        for i, shard in enumerate(shards):
+            shard_call = list(call)
+            shard_call[shard_call.index('-db') + 1] = shard
+            shard_call[shard_call.index('-outfmt') + 1] = sharding.shard_outfmt(parameters['outfmt'])
+            if 'dbsize' not in parameters:
+                shard_call += ['-dbsize', str(self.shards['length'])]
+            shard_call += ['-num_threads', str(num_threads)]
+            calls.append(shard_call)
+            filenames.append('{}.shard{}'.format(out.name, i))
+        outputs = []
+        try:
+            outputs = [open(filename, 'wb') for filename in filenames]
+            stderr = self.run_processes(calls, outputs, stdin=stdin, **self._limits(parameters))
+            for output in outputs:
+                output.close()
+            if len(stderr.strip()) == 0 and not self.cancelled:
+                sharding.merge(filenames, out, parameters['outfmt'],
+                               max_target_seqs=int(parameters.get('max_target_seqs',
+                                                                  sharding.DEFAULT_MAX_TARGET_SEQS)),
+                               database=self.blast_db)
+        finally:
+            for output in outputs:
+                output.close()
+            for filename in filenames:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        return stderr
+
+    def _load_cached_results(self, rows):
+        """
+        Uses the spooled output of a cached run
+        :param rows: list, the rows of the jobs table for the run hash
+        :return: bool, True if the output is available
+        """
+
+        filename = os.path.join(self.directory_results, '{}.out'.format(self.run_hash))
+        for row in rows:
+            if not os.path.isfile(filename) and len(row[5]) > 0:
+                # results cached before the output was spooled are stored in the database
+                filename_tmp = '{}.{}.tmp'.format(filename, BlastJob.get_job_id())
+                with open(filename_tmp, 'w') as f:
+                    f.write(row[5])
+                os.replace(filename_tmp, filename)
+            if os.path.isfile(filename):
+                self.stdout_file = filename
+                self.stderr = row[6]
+                return True
+        return False
+
     def write_cached_results(self, seq):
         conn = sqlite3.connect(self.result_db)
         c = conn.cursor()
@@ -188,7 +590,7 @@ class BlastJob(Job):
                                                                                            0000,
                                                                                            time.time(),
                                                                                            'finished',
-                                                                                           self.stdout.replace("'", "''"),
+                                                                                           '',
                                                                                            self.stderr.replace("'", "''")))
         c.execute(cmd)
         conn.commit()
@@ -211,9 +613,6 @@ class BlastJob(Job):
     
     def get_accession(self, accession):
 
-        filename = None
-        while filename is None or os.path.exists(filename):
-            filename = os.path.join(self.directory_tmp, "blastdbcmd_{}".format(BlastJob.get_job_id()))
         if isinstance(accession, str):
             accession = accession.replace(';', '\n')
         elif isinstance(accession, list):
@@ -221,22 +620,100 @@ class BlastJob(Job):
         else:
             raise ValueError('accession must be either str or list')
 
-        with open(filename, 'w') as f:
-            f.write(accession)
         #TODO: make this replace prettier
+        # the accessions are piped into blastdbcmd instead of a batch file
         call = [self.blast_executable.replace('blastn', 'blastdbcmd'),
                 '-db', self.blast_db,
-                '-entry_batch', filename]
+                '-entry_batch', '-']
         proc = subprocess.Popen(call,
+                                stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 universal_newlines=True)
-        stdout, stderr = proc.communicate()
+        stdout, stderr = proc.communicate(accession + '\n')
         if (stderr is not None and len(stderr.strip()) > 0) or stdout.startswith('Error:'):
             error = '\n'.join([stderr, stdout])
             raise ValueError('blastdbcmd failed with error: {}'.format(error))
         return stdout
 
+    def iter_accessions(self, accessions, start=None, end=None):
+        """
+        Retrieves sequences with a single blastdbcmd call and yields each record as soon as it was read
+        :param accessions: list, the accessions
+        :param start: int, 1-based start of the subsequence, from the beginning if None
+        :param end: int, 1-based inclusive end of the subsequence, until the end if None
+        :return: generator of tuples (header, sequence), raises ValueError if blastdbcmd reported errors
+        """
+
+        if start is not None and start < 1 or end is not None and end < 1 or \
+                start is not None and end is not None and start > end:
+            raise ValueError('invalid range: {}-{}'.format(start, end))
+        # blastdbcmd only takes ranges with both ends, open ranges are cut after retrieval
+        entry_range = ' {}-{}'.format(start, end) if start is not None and end is not None else ''
+        entries = ''.join('{}{}\n'.format(accession, entry_range) for accession in accessions)
+
+        call = [self.blast_executable.replace('blastn', 'blastdbcmd'),
+                '-db', self.blast_db,
+                '-entry_batch', '-']
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(call, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                                    universal_newlines=True)
+            # records are read while the accessions are still written
+            tools.feed_stdin(proc, entries)
+            try:
+                for header, seq in tools.iter_fasta(proc.stdout):
+                    if entry_range == '' and (start is not None or end is not None):
+                        seq = seq[(start or 1) - 1:end]
+                    yield header, seq
+                proc.wait()
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+            stderr.seek(0)
+            error = stderr.read().decode('utf-8').strip()
+        if len(error) > 0:
+            raise ValueError('blastdbcmd failed with error: {}'.format(error))
+
+    def get_fm_index(self, fasta=None):
+        """
+        Returns the FM-index of the database, it is built on first use and stored next to the database
+        The index is rebuilt if the database changed since it was built
+        :param fasta: str, the FASTA file of the database, exported with blastdbcmd if None
+        :return: fm_index.FmIndex
+        """
+
+        filename = self.blast_db + '.fmi'
+        fingerprint = database_fingerprint(self.blast_db)
+        if self.fm_index_status() != 'current':
+            if fasta is None and os.path.isfile(self.blast_db):
+                fasta = self.blast_db
+            if fasta is not None:
+                fm_index.FmIndex.build(fasta, filename, fingerprint=fingerprint).close()
+            else:
+                fasta = os.path.join(self.directory_tmp, 'blastdbcmd_{}.fa'.format(BlastJob.get_job_id()))
+                call = [self.blast_executable.replace('blastn', 'blastdbcmd'),
+                        '-db', self.blast_db,
+                        '-entry', 'all',
+                        '-out', fasta]
+                proc = subprocess.run(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                try:
+                    if proc.returncode != 0:
+                        raise ValueError('blastdbcmd failed with error: {}'.format(proc.stderr))
+                    fm_index.FmIndex.build(fasta, filename, fingerprint=fingerprint).close()
+                finally:
+                    if os.path.isfile(fasta):
+                        os.remove(fasta)
+        return fm_index.open_index(filename)
+
+    def fm_index_status(self):
+        """
+        :return: str, 'missing', 'stale' or 'current', see fm_index.index_status
+        """
+
+        return fm_index.index_status(self.blast_db + '.fmi', database_fingerprint(self.blast_db))
+
     def get_accessions_from_list(self, accessions):
         acc = list()
         for accession in accessions:
@@ -245,8 +722,18 @@ class BlastJob(Job):
         acc = list(set(acc))
         return acc
 
+    def get_hits(self):
+        """
+        Extracts the accessions of all hits while streaming the output of the job
+        :return: list, the accessions
+        """
+
+        with self.open_stdout() as f:
+            return BlastJob.extract_hits_from_blast(f)
+
     @staticmethod
     def extract_hits_from_blast(blast_xml):
+        from Bio.Blast import NCBIXML
         if isinstance(blast_xml, str):
             blast_xml = io.StringIO(blast_xml)
         blast_records = NCBIXML.read(blast_xml)
@@ -274,7 +761,11 @@ class BlastJob(Job):
         parameters['sequence'] = seq
         parameters['job_id'] = job_id
 
-        num_threads = parameters.get('num_threads', self.defaults['num_threads'])
+        if self.shards is None:
+            num_threads = parameters.get('num_threads', self.defaults['num_threads'])
+        else:
+            # the threads are split between the shards
+            num_threads = parameters.get('num_threads', os.cpu_count())
         if not isinstance(num_threads, int):
             try:
                 num_threads = int(num_threads)
@@ -284,6 +775,26 @@ class BlastJob(Job):
             raise ValueError('num_threads needs to be 1 or higher')
         parameters['num_threads'] = num_threads
 
+        for limit, limit_type in (('timeout', float), ('cpu_timeout', int), ('memory_limit', int)):
+            value = parameters.get(limit, self.defaults.get(limit))
+            if value is not None:
+                try:
+                    value = limit_type(value)
+                except ValueError:
+                    raise ValueError('{} must be a number'.format(limit))
+                if value <= 0:
+                    raise ValueError('{} needs to be larger than 0'.format(limit))
+            parameters[limit] = value
+
+        # restrictions are compiled to files named by their content, so they are part of the run hash
+        if parameters.get('seqidlist') is not None:
+            parameters['seqidlist'] = self.compile_seqidlist(parameters['seqidlist'])
+        if parameters.get('taxids') is not None:
+            parameters['taxidlist'] = self.compile_taxidlist(parameters.pop('taxids'))
+        for restriction in ('seqidlist', 'taxids'):
+            if restriction in parameters and parameters[restriction] is None:
+                del parameters[restriction]
+
         outfmt = str(parameters.get('outfmt', self.defaults['outfmt'])).lower()
         valid_outfmt = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11')
         outfmt_parts = outfmt.split(' ')
@@ -302,32 +813,133 @@ class BlastJob(Job):
 
         return parameters
 
+    @staticmethod
+    def _read_id_list(ids):
+        if isinstance(ids, str):
+            if os.path.isfile(ids):
+                with open(ids, 'r') as f:
+                    ids = f.read()
+            ids = ids.replace(';', '\n').replace(',', '\n').split()
+        ids = sorted(set(str(i).strip() for i in ids if len(str(i).strip()) > 0))
+        if len(ids) == 0:
+            raise ValueError('the list of IDs is empty')
+        return ids
+
+    def _write_id_list(self, ids, extension):
+        directory = os.path.join(self.settings.directory_cache, 'seqidlists')
+        os.makedirs(directory, exist_ok=True)
+        content = '\n'.join(ids) + '\n'
+        filename = os.path.join(directory, '{}.{}'.format(hashlib.sha1(content.encode('utf-8')).hexdigest(),
+                                                          extension))
+        if not os.path.isfile(filename):
+            filename_tmp = '{}.{}.tmp'.format(filename, BlastJob.get_job_id())
+            with open(filename_tmp, 'w') as f:
+                f.write(content)
+            os.replace(filename_tmp, filename)
+        return filename
+
+    def compile_seqidlist(self, accessions):
+        """
+        Writes a seqidlist which restricts the search to a subset of the database, lists are cached by their content
+        :param accessions: list, the accessions, or a str with a file or accessions separated by ',', ';' or whitespace
+        :return: str, the seqidlist, a binary list (.bsl) if binary_seqidlist is set in blast.conf
+        """
+
+        filename = self._write_id_list(BlastJob._read_id_list(accessions), 'txt')
+        if not self.settings.config.get('binary_seqidlist', False):
+            return filename
+        # binary lists need BLAST 2.9+ and version 5 databases, they are read much faster than text lists
+        filename_bsl = filename[0:-len('.txt')] + '.bsl'
+        if not os.path.isfile(filename_bsl):
+            filename_tmp = '{}.{}.tmp'.format(filename_bsl, BlastJob.get_job_id())
+            call = [self.blast_executable.replace('blastn', 'blastdb_aliastool'),
+                    '-seqid_file_in', filename,
+                    '-seqid_file_out', filename_tmp]
+            proc = subprocess.run(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                raise RuntimeError('failed to compile seqidlist {}. Error: {}'.format(filename, proc.stderr))
+            os.replace(filename_tmp, filename_bsl)
+        return filename_bsl
+
+    def compile_taxidlist(self, taxids):
+        """
+        Writes a taxidlist which restricts the search to sequences of these taxa, needs BLAST 2.8+
+        :param taxids: list of int, or a str with a file or taxids separated by ',', ';' or whitespace
+        :return: str, the taxidlist
+        """
+
+        taxids = BlastJob._read_id_list(taxids)
+        for taxid in taxids:
+            if not taxid.isdigit():
+                raise ValueError('taxids must be integers, got: {}'.format(taxid))
+        return self._write_id_list(sorted(taxids, key=int), 'txids')
+
     def _get_defaults(self):
-        filename = 'blast_defaults'
-        if os.path.isfile(filename):
-            with open(filename, 'r') as f:
-                defaults = yaml.load(f)
-        else:
-            defaults = {}
-        defaults['short_sequence'] = int(defaults.get('short_sequence', 25))
-        defaults['num_threads'] = int(defaults.get('num_threads', min(6, multiprocessing.cpu_count())))
-        defaults['outfmt'] = int(defaults.get('outfmt', 5))
-        self.defaults = defaults
-        return defaults
-
-    def fasta_to_blast_db(self, filename):
+        self.defaults = dict(self.settings.defaults)
+        return self.defaults
+
+    def fasta_to_blast_db(self, filename, shards=1, database=None, build_index=False):
+        """
+        Creates a BLAST database from a FASTA file
+        :param filename: str, the FASTA file or a FASTA formatted sequence
+        :param shards: int, the number of shards, shards are searched in parallel by run
+        :param database: str, the name of the database, the FASTA filename if None
+        :param build_index: bool, builds megablast indexes for the new database
+        :return: str, the name of the database
+        """
+
         if filename.startswith('>') and not os.path.isfile(filename):
             filename_ = 'blast_db.txt'
             with open(filename_, 'w') as f:
                 f.write(filename)
             filename = filename_
+        if database is None:
+            database = filename
+            if os.path.splitext(filename)[1] in ('.gz', '.bgz'):
+                database = os.path.splitext(filename)[0]
+        if shards > 1:
+            manifest = sharding.build_shards(filename, database, shards, self._make_blast_db)
+            databases = manifest['shards']
+        else:
+            self._make_blast_db(filename, database)
+            databases = [database]
+        for db in databases:
+            if build_index:
+                megablast_index.build_index(self.blast_executable, db)
+            elif megablast_index.index_status(db) == 'stale':
+                # the rebuilt database would otherwise keep an outdated index
+                megablast_index.remove_index(db)
+        return database
+
+    def _make_blast_db(self, filename, database):
         # TODO make replace prettier
         call = [self.blast_executable.replace('blastn', 'makeblastdb'),
                 '-in', filename,
-                '-dbtype', 'nucl']
-        proc = subprocess.Popen(call,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        if proc.stderr is not None or proc.stderr != '':
-            raise RuntimeError('failed to convert FASTA {} to BLAST database. Error: {}'.format(filename, self.stderr))
-        return proc.stdout
+                '-dbtype', 'nucl',
+                '-out', database]
+        if not tools.is_gzip(filename):
+            proc = subprocess.run(call,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+            stdout, stderr = proc.stdout, proc.stderr
+        else:
+            # makeblastdb cannot read compressed input, the FASTA is decompressed into its stdin
+            call[2] = '-'
+            call.extend(['-title', os.path.basename(database)])
+            with tempfile.TemporaryFile() as f_out, tempfile.TemporaryFile() as f_err:
+                proc = subprocess.Popen(call, stdin=subprocess.PIPE, stdout=f_out, stderr=f_err)
+                try:
+                    with tools.open_fasta(filename, 'rb') as f:
+                        shutil.copyfileobj(f, proc.stdin)
+                except BrokenPipeError:
+                    pass
+                finally:
+                    proc.stdin.close()
+                proc.wait()
+                f_out.seek(0)
+                f_err.seek(0)
+                stdout, stderr = f_out.read().decode('utf-8'), f_err.read().decode('utf-8')
+        if proc.returncode != 0 or stderr.strip() != '':
+            raise RuntimeError('failed to convert FASTA {} to BLAST database. Error: {}'.format(filename, stderr))
+        return stdout
@@ -1,14 +1,23 @@
 import sys
+import io
 import os
 import subprocess
 import time
-import primer3
+import tempfile
+import threading
 import concurrent.futures
 import functools
-import yaml
 
-from Bio import SeqIO
 from PrimerDesigner.Job import BlastJob
+from PrimerDesigner import config
+from PrimerDesigner import twobit
+from PrimerDesigner import indexed_fasta
+from PrimerDesigner import dedup
+from PrimerDesigner import kmer_sketch
+from PrimerDesigner import amplicons
+from PrimerDesigner.pipeline import Pipeline
+from PrimerDesigner.tools import tools
+from PrimerDesigner.hitset_cache import HitSetCache, database_fingerprint
 
 
 class Primer:
@@ -67,12 +76,15 @@ class PrimerPair:
 
 
 class GfServer:
-    def __init__(self, port=12345, executable=None, file_2bit=None, file_fasta=None):
+    def __init__(self, port=12345, executable=None, file_2bit=None, file_fasta=None, conf_file='blast.conf',
+                 key=None):
         self.port = port
+        self.conf_file = conf_file
         self.executable = executable
         self.process = None
         self.file_2bit = file_2bit
         self.file_fasta = file_fasta
+        self.key = key
         if executable is None:
             self.get_location()
 
@@ -80,14 +92,8 @@ class GfServer:
             self.convert_fasta_to_2bit()
 
     def get_location(self):
-        conf_filename = 'blast.conf'
-
-        if os.path.isfile(conf_filename):
-            with open(conf_filename, 'r') as f:
-                self.executable = yaml.load(f)['gfserver']
-        else:
-            self.executable = os.environ.get('GFSERVER')
-        if not os.path.isfile(self.executable):
+        self.executable = config.get_settings(self.conf_file).gfserver
+        if self.executable is None or not os.path.isfile(self.executable):
             raise ValueError('gfServer executable not found in location: {}'.format(self.executable))
         return self.executable
 
@@ -100,16 +106,11 @@ class GfServer:
 
     def convert_fasta_to_2bit(self):
         """
-        Converts a FASTA file to 2bit format
+        Converts a FASTA file to 2bit format, conversions are cached by the key of the FASTA file or its content
         :return: str, the full path of the 2bit file
         """
-        exec_2bit = self.executable[0:self.executable.rfind('gfServer')] + 'faToTwoBit'
-        if self.file_fasta.endswith('.fa'):
-            self.file_2bit = self.file_fasta[0:self.file_fasta.rfind('.fa')] + '.2bit'
-        else:
-            self.file_2bit = self.file_fasta + '.2bit'
-        p = subprocess.Popen([exec_2bit, self.file_fasta, self.file_2bit])
-        p.communicate()
+        cache = twobit_cache(config.get_settings(self.conf_file))
+        self.file_2bit = cache.get(self.file_fasta, key=self.key)
         return self.file_2bit
 
     @staticmethod
@@ -120,6 +121,22 @@ class GfServer:
 
         return len(response.splitlines())
 
+    @staticmethod
+    def parse_amplicons(response):
+        """
+        Returns the names of the sequences with an amplicon
+        :param response: str or bytes, the output of gfServer pcr
+        :return: list, one name per amplicon
+        """
+
+        if isinstance(response, bytes):
+            response = response.decode()
+        names = []
+        for line in response.strip().splitlines():
+            if len(line.strip()) > 0:
+                names.append(line.split()[0].lstrip('>').split(':')[0])
+        return names
+
     def call(self, primer_pair, max_distance=1500, trials=100):
         sub = None
         while trials > 0 and (sub is None or sub.stderr != b''):
@@ -141,13 +158,15 @@ class GfServer:
 
 
 def call_ispcr(primer_pair):
-    with open('primerPair.txt', 'w') as f:
-        f.write('{} {} {}'.format('bla', primer_pair.forward.seq, primer_pair.reverse.seq))
-    p = subprocess.run(['./isPcr', 'top500.fa', 'primerPair.txt', 'stdout'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # the primer pair is piped into isPcr, concurrent calls do not share a query file
+    query = '{} {} {}\n'.format('bla', primer_pair.forward.seq, primer_pair.reverse.seq)
+    p = subprocess.run(['./isPcr', 'top500.fa', 'stdin', 'stdout'], input=query.encode('utf-8'),
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     return p.stdout
 
 
 def create_primers(record, number_of_primers=1000):
+    import primer3
     return primer3.bindings.designPrimers(
         {
             'SEQUENCE_ID': record.id,
@@ -178,95 +197,277 @@ def create_primers(record, number_of_primers=1000):
         })
 
 
-def validate_primerpairs(primer_pairs, filename=None):
+def find_amplicons(gfserver, primer_pair, members=None):
+    """
+    Finds the amplicons of a primer pair in the sequences served by a gfServer
+    :param gfserver: GfServer, a started server
+    :param primer_pair: PrimerPair, the primers
+    :param members: dict, see dedup.collapse, amplicons of representatives count for every collapsed member
+    :return: list, the name of the sequence of each amplicon
+    """
+
+    r = gfserver.call(primer_pair)
+    if members is None:
+        return GfServer.parse_amplicons(r.stdout)
+    return dedup.expand(GfServer.parse_amplicons(r.stdout), members)
+
+
+def validate_primerpairs(primer_pairs, filename=None, members=None):
     gfserver = GfServer(file_fasta=filename)
     gfserver.start()
     validated = []
     for pp in primer_pairs:
-        r = gfserver.call(pp)
-        no_r = (GfServer.parse_response(r.stdout))
-        if no_r == 1:
+        if len(find_amplicons(gfserver, pp, members=members)) == 1:
             validated.append(pp)
 
     gfserver.stop()
     return validated
 
 
+def iter_primer_pairs(record, primer_pairs_to_screen, stopped=None, accept=None):
+    """
+    Yields the primer pairs of a target, primer3 is rerun with twice as many pairs until no new pairs are found
+    :param record: SeqRecord, the target sequence
+    :param primer_pairs_to_screen: int, the number of pairs of the first primer3 run
+    :param stopped: callable, returns True if no more pairs are needed
+    :param accept: callable, takes a PrimerPair and returns False if it is rejected without validation
+    :return: generator of tuples (int rank, PrimerPair)
+    """
+
+    returned = 0
+    while stopped is None or not stopped():
+        primers = create_primers(record, number_of_primers=primer_pairs_to_screen)
+        if primers['PRIMER_LEFT_NUM_RETURNED'] <= returned:
+            return
+        for i in range(returned, primers['PRIMER_LEFT_NUM_RETURNED']):
+            pp = PrimerPair.parse_primer3(primers, index=i)
+            if accept is None or accept(pp):
+                yield i, pp
+        returned = primers['PRIMER_LEFT_NUM_RETURNED']
+        primer_pairs_to_screen = primer_pairs_to_screen * 2
+
+
 def make_directories():
     os.makedirs(os.path.join(os.path.dirname(__file__), 'data', 'input'), exist_ok=True)
 
 
-def write_sequence_to_file(sequence):
+def write_sequence_to_file(sequence, directory=None):
+    """
+    Writes a sequence to a new file with a unique name, the caller removes it
+    :param sequence: str, the sequence in FASTA format
+    :param directory: str, the directory of the file, the system temporary directory if None
+    :return: str, the filename
+    """
 
-    filename = os.path.join('/tmp/', 'file.fa')
-    with open(filename, 'w') as f:
+    fd, filename = tempfile.mkstemp(suffix='.fa', dir=directory)
+    with os.fdopen(fd, 'w') as f:
         f.write(sequence)
     return filename
 
 
-def design_primers(filename, number_of_primers, database='nt', primer_pairs_to_screen=3200):
-
-    make_directories()
-    # get target sequence
-
-    if filename.startswith('>') and not os.path.isfile(filename):
-        filename = write_sequence_to_file(filename)
-
-    try:
-        record = SeqIO.read(filename, 'fasta')
-    except ValueError as e:
-        raise e
-    # run BLAST in the background
-    blast = BlastJob(blast_db=database)
-    blast.run(parameters={'sequence': record.format('fasta')})
-
+def get_restriction(blast, seqidlist=None, taxids=None):
+    """
+    Compiles the subset of the database which is searched
+    :param blast: BlastJob, the job used to search the database
+    :param seqidlist: list or str, accessions, see BlastJob.compile_seqidlist
+    :param taxids: list or str, taxids, see BlastJob.compile_taxidlist
+    :return: dict, BLAST parameters which restrict the search, empty if the whole database is searched
+    """
+
+    restriction = {}
+    if seqidlist is not None:
+        restriction['seqidlist'] = blast.compile_seqidlist(seqidlist)
+    if taxids is not None:
+        restriction['taxidlist'] = blast.compile_taxidlist(taxids)
+    return restriction
+
+
+def twobit_cache(settings):
+    """
+    :param settings: config.Settings
+    :return: twobit.TwoBitCache, limited by the config key twobit_cache_bytes
+    """
+
+    return twobit.TwoBitCache(settings.directory_cache, max_bytes=int(settings.config.get('twobit_cache_bytes',
+                                                                                        2 ** 30)))
+
+
+def hit_set_2bit_key(filename_hits):
+    """
+    Hit set FASTA files are named by their cache key and derived files, e.g. collapsed hits, add their own suffix,
+    the name identifies the content and the FASTA file does not need to be hashed again
+    :param filename_hits: str, a hit set FASTA file or a file derived from it
+    :return: str, the key of its 2bit conversion
+    """
+
+    return 'hitset_' + os.path.basename(filename_hits)
+
+
+def hit_set_key(blast, record, restriction=None):
+    """
+    :param blast: BlastJob, the job used to search the database
+    :param record: SeqRecord, the target sequence
+    :param restriction: dict, see get_restriction
+    :return: tuple (HitSetCache, str the key of the hit set of the target)
+    """
+
+    if restriction is None:
+        restriction = {}
+    cache = HitSetCache(os.path.join(blast.settings.directory_cache, 'hitsets'),
+                        max_bytes=int(blast.settings.config.get('hitset_cache_bytes', 2 ** 30)))
+    parameters = {'blast_db': os.path.abspath(blast.blast_db), 'defaults': blast.defaults,
+                  'restriction': {k: os.path.basename(v) for k, v in restriction.items()}}
+    return cache, cache.key(str(record.seq), parameters, database_fingerprint(blast.blast_db))
+
+
+def get_hit_set(blast, record, restriction=None):
+    """
+    Returns the BLAST hits of a target sequence, hit sets are cached by the target sequence, the BLAST parameters
+    and the fingerprint of the database, a rebuilt database never returns stale hits
+    :param blast: BlastJob, the job used to search the database
+    :param record: SeqRecord, the target sequence
+    :param restriction: dict, see get_restriction, the compiled lists are named by their content hash
+    :return: tuple (list of accessions, str filename of the FASTA file with the hit sequences)
+    """
+
+    if restriction is None:
+        restriction = {}
+    cache, key = hit_set_key(blast, record, restriction=restriction)
+    hit_set = cache.get(key)
+    if hit_set is not None:
+        return hit_set
+
+    blast.run(parameters=dict(restriction, sequence=record.format('fasta')))
     while not blast.finished:
         time.sleep(0.1)
     if blast.stderr is None or blast.stderr != '':
         raise RuntimeError('BLAST failed with error: {}'.format(blast.stderr))
+    acc_hits = blast.get_hits()
+    return cache.put(key, acc_hits, blast.get_accession(acc_hits))
 
-    # get BLAST sequences
-    executor = concurrent.futures.ThreadPoolExecutor(4)
-    future_blast = executor.submit(functools.partial(blast.extract_hits_from_blast, blast.stdout))
-
-    acc_hits = future_blast.result(timeout=120)
-    # TODO default
-    filename_hits = os.path.join(os.path.dirname(__file__), 'data', 'input', blast.get_job_id() + '.fa')
-    with open(filename_hits, 'w') as f:
-        f.write(blast.get_accession(acc_hits))
-
-    primer_pairs = []
-    valid_pairs = []
-    primers = {}
-    while len(valid_pairs) < number_of_primers:
-        old_len = primers.get('PRIMER_LEFT_NUM_RETURNED', 0)
-        future_primers = executor.submit(functools.partial(create_primers, record,
-                                                           number_of_primers=primer_pairs_to_screen))
-        primers = future_primers.result(timeout=120)
-        for i in range(old_len, primers['PRIMER_LEFT_NUM_RETURNED']):
-            pp = PrimerPair.parse_primer3(primers, index=i)
-            primer_pairs.append(pp)
-        valid_pairs = list(set(validate_primerpairs(primer_pairs, filename=filename_hits)))
-        primer_pairs_to_screen = primer_pairs_to_screen * 2
 
-    with open('optimal_pairs.txt', 'a') as f:
-        f.write(str(primer_pairs_to_screen))
-        f.write('\n')
-    blast_outputs = []
-    for v, valid in enumerate(valid_pairs):
-        # run against all nucleotides
-        for orientation in ('forward', 'reverse'):
-            sequence = '>{}_{}\n{}'.format(orientation, v, valid.__getattribute__(orientation).seq)
-            blast.run(parameters={'sequence': sequence})
-            while not blast.finished:
-                time.sleep(0.1)
-            blast_outputs.extend(blast.extract_hits_from_blast(blast.stdout))
-        # collect new sequences
-        # print(blast_outputs, file=sys.stderr)
-        # add new sequences to initial
-        pass
-
-    #acc_hits = blast.get_accessions_from_list(blast_outputs)
-    #print(acc_hits, file=sys.stderr)
-
-    return valid_pairs[0:number_of_primers]
\ No newline at end of file
+def design_primers(filename, number_of_primers, database='nt', primer_pairs_to_screen=3200, specificity='blast',
+                   mismatches=1, record_name=None, seqidlist=None, taxids=None):
+    from Bio import SeqIO
+
+    # get target sequence
+
+    if filename.startswith('>') and not os.path.isfile(filename):
+        # sequences which are passed directly are parsed in memory, no file is written
+        records = [r for r in SeqIO.parse(io.StringIO(filename), 'fasta')
+                   if record_name is None or r.id == record_name]
+        if len(records) != 1:
+            raise ValueError('expected one target sequence, found {}'.format(len(records)))
+        record = records[0]
+    elif record_name is not None:
+        # single targets are read from indexed panels without decompressing the whole file
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        with indexed_fasta.IndexedFasta(filename) as fasta:
+            record = SeqRecord(Seq(fasta.fetch(record_name)), id=record_name, description='')
+    else:
+        with tools.open_fasta(filename) as f:
+            record = SeqIO.read(f, 'fasta')
+    if specificity not in ('blast', 'fm_index'):
+        raise ValueError("specificity must be either 'blast' or 'fm_index'")
+    if specificity == 'fm_index' and taxids is not None:
+        # the FM-index has no taxonomy, binding sites outside the taxa would count as off-targets
+        raise ValueError("taxids cannot be used with specificity='fm_index', use a seqidlist instead")
+    blast = BlastJob(blast_db=database)
+    restriction = get_restriction(blast, seqidlist=seqidlist, taxids=taxids)
+    settings = blast.settings.config
+
+    def negative_selection():
+        acc_hits, filename_hits = get_hit_set(blast, record, restriction=restriction)
+        members = None
+        if settings.get('dedup_hits', True):
+            threshold = settings.get('dedup_threshold')
+            filename_hits, members = dedup.collapse_fasta(filename_hits,
+                                                          threshold=float(threshold) if threshold is not None else None)
+        return filename_hits, members
+
+    # primer3 starts while the target is searched in the database, primer pairs wait for the hits in the validation
+    # stage and validated pairs are checked for off-target binding while more pairs are validated
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    future_hits = executor.submit(negative_selection)
+    executor.shutdown(wait=False)
+    gfserver = {}
+    gfserver_lock = threading.Lock()
+    accepted = []
+    valid_lock = threading.Lock()
+    pipeline = Pipeline(queue_size=int(settings.get('pipeline_queue_size', 64)))
+
+    def validate(item):
+        filename_hits, members = future_hits.result()
+        with gfserver_lock:
+            if 'server' not in gfserver:
+                gfserver['server'] = GfServer(file_fasta=filename_hits, key=hit_set_2bit_key(filename_hits))
+                gfserver['server'].start()
+        names = find_amplicons(gfserver['server'], item[1], members=members)
+        if len(names) == 1:
+            yield item + (names, )
+
+    if specificity == 'fm_index':
+        index = blast.get_fm_index()
+        subjects = None
+        if 'seqidlist' in restriction:
+            # the index covers the whole database, binding sites outside the seqidlist are dropped
+            with open(restriction['seqidlist'], 'r') as f:
+                subjects = set(amplicons.base_accession(line.strip()) for line in f if line.strip())
+    local = threading.local()
+    max_size = int(settings.get('amplicon_max_size', 1500))
+
+    def primer_hits(rank, valid):
+        if specificity == 'fm_index':
+            return amplicons.PrimerHits.concatenate(
+                [amplicons.PrimerHits.from_fm_index(index.locate(primer.seq, mismatches=mismatches),
+                                                    len(primer.seq), p, subjects=subjects)
+                 for p, primer in enumerate((valid.forward, valid.reverse))])
+        # both primers are searched against all nucleotides at once, every worker needs its own job
+        if not hasattr(local, 'blast'):
+            local.blast = BlastJob(blast_db=database)
+        sequence = '>forward_{0}\n{1}\n>reverse_{0}\n{2}'.format(rank, valid.forward.seq, valid.reverse.seq)
+        local.blast.run(parameters=dict(restriction, sequence=sequence, task='blastn-short',
+                                        evalue=str(settings.get('primer_blast_evalue', 1000)),
+                                        outfmt=amplicons.BLAST_OUTFMT))
+        while not local.blast.finished:
+            time.sleep(0.1)
+        if local.blast.stderr is None or local.blast.stderr != '':
+            raise RuntimeError('BLAST failed with error: {}'.format(local.blast.stderr))
+        with local.blast.open_stdout() as f:
+            return amplicons.PrimerHits.from_blast(f, {'forward_{}'.format(rank): 0, 'reverse_{}'.format(rank): 1})
+
+    def off_target(item):
+        rank, valid, on_target = item
+        # pairs which would amplify anything besides the target are rejected
+        if len(amplicons.off_target_products(primer_hits(rank, valid), on_target, max_size=max_size)) > 0:
+            return
+        with valid_lock:
+            if pipeline.stopped(1):
+                return
+            accepted.append(rank)
+            if len(accepted) >= number_of_primers:
+                pipeline.stop(1)
+        yield rank, valid
+
+    accept = None
+    if settings.get('kmer_prefilter', True):
+        # primers with frequent 3' ends are rejected before they reach gfServer, only if a sketch was built
+        sketch = kmer_sketch.load(blast.blast_db, k=int(settings.get('kmer_prefilter_k', 12)))
+        if sketch is not None:
+            max_count = sketch.max_count(factor=float(settings.get('kmer_prefilter_factor', 10.0)))
+            accept = functools.partial(sketch.accepts, max_count=max_count)
+
+    pipeline.add_stage(validate, workers=int(settings.get('pipeline_validation_workers', 4)), name='validation')
+    pipeline.add_stage(off_target, workers=int(settings.get('pipeline_blast_workers', 2)), name='off-target')
+    try:
+        results = pipeline.run(iter_primer_pairs(record, primer_pairs_to_screen, stopped=pipeline.stopped,
+                                                 accept=accept))
+        if len(results) == 0:
+            # no primer pair was validated, errors of the database search are raised here
+            future_hits.result()
+    finally:
+        if 'server' in gfserver:
+            gfserver['server'].stop()
+    results.sort(key=lambda r: r[0])
+    return [valid for rank, valid in results]
@@ -5,22 +5,178 @@ from flask_restful import reqparse
 from flask import jsonify
 import sys
 import os
+import json
 import sqlite3
 import time
+import zlib
+import itertools
+import threading
 import concurrent.futures
 import functools
 from PrimerDesigner.Job import BlastJob
-import PrimerDesigner.design_primers
+from PrimerDesigner.Primer import design_primers
+from PrimerDesigner.worker import JobQueue, Worker
+from PrimerDesigner.job_registry import JobRegistry
+from PrimerDesigner.hit_store import HitStore
+from PrimerDesigner.hitset_cache import database_fingerprint
+from PrimerDesigner import http_cache
+from PrimerDesigner import config
 from PrimerDesigner.tools import tools
 
-app = Flask(__name__)
-api = Api(app)
-jobs = {}
+jobs = JobRegistry()
+# hits of finished jobs, keyed by the entity tag of the job
+hits_memo = http_cache.Memo()
 executor = concurrent.futures.ThreadPoolExecutor(10)
+_workers_lock = threading.Lock()
+_workers_pid = None
 
 parser = reqparse.RequestParser()
 parser.add_argument('accession', action='append')
-parser.add_argument('format', required=False, default='txt', choices=['txt', 'json'])
+parser.add_argument('format', required=False, default='txt', choices=['txt', 'json', 'fasta', 'ndjson'])
+parser.add_argument('start', type=int, required=False, help='1-based start of the subsequence')
+parser.add_argument('end', type=int, required=False, help='1-based inclusive end of the subsequence')
+
+STREAM_MIMETYPES = {'fasta': 'text/x-fasta', 'ndjson': 'application/x-ndjson'}
+DEFAULT_QUEUE_WAIT_TIMEOUT = 3600
+
+
+class QueueWaitError(RuntimeError):
+    """
+    Raised when a queued job does not deliver a result, status_code is the HTTP status of the response
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def stream_json_string(handle, chunk_size=1 << 16):
+    """
+    Streams the content of a file as a single JSON string without reading the whole file
+    :param handle: file object, the file, it is closed afterwards
+    :param chunk_size: int, the number of characters read at a time
+    :return: generator of str
+    """
+
+    with handle:
+        yield '"'
+        for chunk in iter(lambda: handle.read(chunk_size), ''):
+            yield json.dumps(chunk)[1:-1]
+        yield '"\n'
+
+
+def format_records(records, fmt, line_length=80):
+    """
+    Formats sequence records as FASTA or NDJSON, errors raised by records end the stream,
+    NDJSON reports them as a final error object
+    :param records: iterable of tuples (header, sequence)
+    :param fmt: str, either 'fasta' or 'ndjson'
+    :return: generator of str, one item per record
+    """
+
+    try:
+        for header, seq in records:
+            if fmt == 'ndjson':
+                yield json.dumps({'accession': header.split(' ')[0], 'header': header, 'sequence': seq}) + '\n'
+            else:
+                yield '>{}\n{}'.format(header, ''.join(seq[i:i + line_length] + '\n'
+                                                       for i in range(0, len(seq), line_length)))
+    except ValueError as e:
+        if fmt == 'ndjson':
+            yield json.dumps({'error': str(e)}) + '\n'
+        else:
+            print(e, file=sys.stderr)
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Compresses a stream with gzip, the compressor is flushed after every chunk so clients receive complete records
+    :param chunks: iterable of str
+    :param level: int, the compression level
+    :return: generator of bytes
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def sequence_etag(blast_db, accessions, fmt, start=None, end=None, compressed=False):
+    """
+    Sequences only change when the database is rebuilt, their entity tag is derived from the database fingerprint
+    :param blast_db: str, the database
+    :param accessions: list, the requested accessions
+    :param fmt: str, the format of the response
+    :param start: int, 1-based start of the subsequence
+    :param end: int, 1-based inclusive end of the subsequence
+    :param compressed: bool, True if the response is gzip compressed
+    :return: str, the strong entity tag without quotes
+    """
+
+    return http_cache.make_etag('sequence', database_fingerprint(blast_db), ';'.join(accessions), fmt, start, end,
+                                compressed)
+
+
+def sequence_cache_control():
+    max_age = config.get_settings().config.get('sequence_max_age', http_cache.DEFAULT_SEQUENCE_MAX_AGE)
+    return 'public, max-age={}'.format(max_age)
+
+
+def stream_sequences(accessions, fmt='fasta', start=None, end=None):
+    """
+    Streams sequences from the BLAST database while they are retrieved, gzip compressed if the client accepts it
+    :param accessions: list, the accessions, each may contain several accessions separated by ';'
+    :param fmt: str, either 'fasta' or 'ndjson'
+    :param start: int, 1-based start of the subsequence
+    :param end: int, 1-based inclusive end of the subsequence
+    :return: flask.Response
+    """
+
+    accessions = [a for accession in accessions for a in accession.split(';') if len(a.strip()) > 0]
+    job = BlastJob()
+    compressed = 'gzip' in flask.request.headers.get('Accept-Encoding', '')
+    etag = sequence_etag(job.blast_db, accessions, fmt, start, end, compressed)
+    cache_control = sequence_cache_control()
+    response = http_cache.not_modified(etag, cache_control, vary='Accept-Encoding')
+    if response is not None:
+        return response
+    records = job.iter_accessions(accessions, start=start, end=end)
+    # the first record is fetched before the response starts, so that failed requests get an error status
+    try:
+        first = [next(records)]
+    except StopIteration:
+        first = []
+    except ValueError as e:
+        return flask.make_response(jsonify({'error': True, 'message': str(e)}), 404)
+    chunks = format_records(itertools.chain(first, records), fmt)
+    headers = http_cache.cache_headers(etag, cache_control, vary='Accept-Encoding')
+    if compressed:
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return flask.Response(chunks, mimetype=STREAM_MIMETYPES[fmt], headers=headers)
+
+
+def use_queue():
+    """
+    Jobs are put into the shared job queue instead of the local executor if use_queue is set in blast.conf or the
+    app was created with shared state, they are run by PrimerDesigner.worker processes or threads
+    :return: bool
+    """
+
+    if flask.has_app_context() and flask.current_app.config.get('PRIMERDESIGNER_SHARED', False):
+        return True
+    return bool(config.get_settings().config.get('use_queue', False))
+
+
+def find_job(blast_id):
+    job = jobs.get(blast_id)
+    if job is not None:
+        return job
+    if use_queue():
+        blast = BlastJob()
+        return JobQueue(blast.result_db).load_job(blast_id, directory_results=blast.directory_results)
+    return None
 
 
 class RestBlastMinimal(Resource):
@@ -28,11 +184,46 @@ class RestBlastMinimal(Resource):
     def get(self, blast_id):
         if blast_id is None or len(blast_id) == 0:
             return flask.abort(404)
-        if blast_id in jobs:
-            return str(jobs[blast_id].stdout)
+        job = find_job(blast_id)
+        if job is not None:
+            if not job.finished:
+                return str(job.stdout), 200, {'Cache-Control': http_cache.NO_STORE}
+            etag = http_cache.job_etag(blast_id, job)
+            response = http_cache.not_modified(etag, http_cache.IMMUTABLE)
+            if response is not None:
+                return response
+            headers = http_cache.cache_headers(etag, http_cache.IMMUTABLE)
+            if job.stdout_file is None:
+                return str(job.stdout), 200, headers
+            return flask.Response(stream_json_string(job.open_stdout()), mimetype='application/json',
+                                  headers=headers)
 
         return [str(j) for j in jobs.values()]
 
+    def delete(self, blast_id):
+        reason = 'cancelled by user'
+        job = jobs.get(blast_id)
+        if job is not None:
+            # finished and failed jobs keep their status
+            if not job.cancel(reason):
+                return {'job_id': blast_id, 'status': job.status, 'reason': 'the job already ended'}, 409
+            status = 'cancelled'
+        elif use_queue():
+            queue = JobQueue(BlastJob().result_db)
+            status = queue.cancel(blast_id, reason)
+            if status is None:
+                row = queue.get(blast_id)
+                if row is None:
+                    return flask.abort(404)
+                return {'job_id': blast_id, 'status': row['status'], 'reason': 'the job already ended'}, 409
+        else:
+            return flask.abort(404)
+        conn = sqlite3.connect(BlastJob().result_db)
+        conn.execute('UPDATE jobs SET status = ? WHERE id = ?', (status, blast_id))
+        conn.commit()
+        conn.close()
+        return {'job_id': blast_id, 'status': status, 'reason': reason}
+
 
 class RestBlast(Resource):
     def get(self):
@@ -44,6 +235,8 @@ class RestBlast(Resource):
     def post(self):
         parser = reqparse.RequestParser()
         parser.add_argument('sequence', type=str, help='Sequence')
+        parser.add_argument('seqidlist', type=str, action='append', help='Restricts the search to these accessions')
+        parser.add_argument('taxids', type=int, action='append', help='Restricts the search to these taxa')
         args = parser.parse_args()
 
         job = BlastJob()
@@ -62,6 +255,9 @@ class RestBlast(Resource):
         conn.commit()
         conn.close()
         args['job_id'] = job_id
+        if use_queue():
+            JobQueue(job.result_db).enqueue('blast', {'parameters': args}, job_id=job_id)
+            return job_id
         job.future = executor.submit(functools.partial(job.run, parameters=args))
         jobs[job_id] = job
 
@@ -71,16 +267,31 @@ class RestBlast(Resource):
 class RestNucleotide(Resource):
     def get(self):
         args = parser.parse_args()
+        if args['accession'] is None:
+            return flask.abort(400)
+        if args['format'] in STREAM_MIMETYPES:
+            return stream_sequences(args['accession'], args['format'], args['start'], args['end'])
         args['accession'] = args['accession'][0]
         if args['format'] == 'txt':
             return RestNucleotideMinimal().get(args['accession'])
         else:
             job = BlastJob()
+            etag = sequence_etag(job.blast_db, [args['accession']], 'json')
+            cache_control = sequence_cache_control()
+            response = http_cache.not_modified(etag, cache_control)
+            if response is not None:
+                return response
             acc = job.get_accession(args['accession'])
-            return jsonify({'response': acc})
+            response = jsonify({'response': acc})
+            response.headers.extend(http_cache.cache_headers(etag, cache_control))
+            return response
 
     def post(self):
         args = parser.parse_args()
+        if args['accession'] is None:
+            return flask.abort(400)
+        if args['format'] in STREAM_MIMETYPES:
+            return stream_sequences(args['accession'], args['format'], args['start'], args['end'])
         job = BlastJob()
         resp = {}
         for acc in args['accession']:
@@ -93,18 +304,62 @@ class RestNucleotide(Resource):
 
 class RestNucleotideMinimal(Resource):
     def get(self, accession):
+        range_parser = reqparse.RequestParser()
+        range_parser.add_argument('start', type=int, required=False, location='args')
+        range_parser.add_argument('end', type=int, required=False, location='args')
+        args = range_parser.parse_args()
+        if args['start'] is not None or args['end'] is not None:
+            return stream_sequences([accession], 'fasta', args['start'], args['end'])
         job = BlastJob()
+        etag = sequence_etag(job.blast_db, [accession], 'txt')
+        cache_control = sequence_cache_control()
+        response = http_cache.not_modified(etag, cache_control)
+        if response is not None:
+            return response
         acc = job.get_accession(accession)
-        return flask.Response(acc, mimetype='txt')
+        return flask.Response(acc, mimetype='txt', headers=http_cache.cache_headers(etag, cache_control))
 
 
 class RestBlastHits(Resource):
     def get(self, blast_id):
-        if blast_id is None or len(blast_id) == 0 or blast_id not in jobs:
+        if blast_id is None or len(blast_id) == 0:
             return flask.abort(404)
-        if not jobs[blast_id].finished:
+        job = find_job(blast_id)
+        if job is None or not job.finished:
             return flask.abort(404)
-        return BlastJob.extract_hits_from_blast(jobs[blast_id].stdout)
+        etag = http_cache.make_etag('hits', http_cache.job_etag(blast_id, job))
+        response = http_cache.not_modified(etag, http_cache.IMMUTABLE)
+        if response is not None:
+            return response
+        hits = hits_memo.get(etag)
+        if hits is None:
+            with job.open_stdout() as f:
+                hits = hits_memo.put(etag, BlastJob.extract_hits_from_blast(f))
+        return hits, 200, http_cache.cache_headers(etag, http_cache.IMMUTABLE)
+
+class RestHitStore(Resource):
+    def get(self):
+        hit_parser = reqparse.RequestParser()
+        hit_parser.add_argument('mode', type=str, required=False, default='hsps', choices=['hsps', 'queries', 'top'],
+                                location='args', help='hsps lists HSPs, queries lists the queries which hit a subject, '
+                                                      'top lists the subjects hit by the most queries')
+        hit_parser.add_argument('subject', type=str, required=False, location='args')
+        hit_parser.add_argument('job', type=str, action='append', required=False, location='args')
+        hit_parser.add_argument('query', type=str, action='append', required=False, location='args')
+        hit_parser.add_argument('max_evalue', type=float, required=False, location='args')
+        hit_parser.add_argument('limit', type=int, required=False, default=100, location='args')
+        args = hit_parser.parse_args()
+        store = HitStore(BlastJob().result_db)
+        if args['mode'] == 'queries':
+            if args['subject'] is None:
+                return flask.abort(400)
+            return jsonify(store.queries_hitting(args['subject'], jobs=args['job'], max_evalue=args['max_evalue']))
+        if args['mode'] == 'top':
+            return jsonify(store.top_subjects(jobs=args['job'], queries=args['query'], max_evalue=args['max_evalue'],
+                                              limit=args['limit']))
+        return jsonify(store.hits(jobs=args['job'], subject=args['subject'], queries=args['query'],
+                                  max_evalue=args['max_evalue'], limit=args['limit']))
+
 
 class RestDesignPrimers(Resource):
     def get(self):
@@ -116,17 +371,25 @@ class RestDesignPrimers(Resource):
         parser.add_argument('number_of_pairs', type=int, required=False, default=5, help='Number of pairs to design')
 
         args = parser.parse_args()
-        # TODO default
-        filename = os.path.join(os.getcwd(), '..', 'input', BlastJob.get_job_id() + '.fa')
         resp = {'error': False, 'primers': [], 'message': ''}
-        with open(filename, 'w') as f:
-            f.write(args['sequence'])
         try:
-            primers = design_primers(filename, args['number_of_pairs'])
+            if use_queue():
+                primers = self.design_primers_queued(args)
+            else:
+                # the target is passed in memory instead of an input file per request
+                if args['sequence'] is None or not args['sequence'].strip().startswith('>'):
+                    raise ValueError('the target sequence needs to be in FASTA format')
+                primers = design_primers(args['sequence'].strip(), args['number_of_pairs'])
         except ValueError as e:
             resp['error'] = True
             resp['message'] = str(e)
             return jsonify(resp)
+        except QueueWaitError as e:
+            resp['error'] = True
+            resp['message'] = str(e)
+            response = jsonify(resp)
+            response.status_code = e.status_code
+            return response
         for p, primer in enumerate(primers):
             primers[p] = str(primer)
         resp['primers'] = primers
@@ -136,6 +399,36 @@ class RestDesignPrimers(Resource):
             resp['message'] = 'Successfully designed primers'
         return jsonify(resp)
 
+    @staticmethod
+    def design_primers_queued(args, poll_interval=0.5, timeout=None):
+        """
+        Runs a design job through the job queue and waits for its result
+        :param args: dict, the arguments of the request
+        :param poll_interval: float, seconds between checks of the queue
+        :param timeout: float, seconds until the job is cancelled, config key queue_wait_timeout or 3600 if None
+        :return: list, the primer pairs, raises ValueError if the job failed and QueueWaitError if it was cancelled
+                 (409) or did not finish in time (504)
+        """
+
+        if timeout is None:
+            timeout = float(config.get_settings().config.get('queue_wait_timeout', DEFAULT_QUEUE_WAIT_TIMEOUT))
+        queue = JobQueue(BlastJob().result_db)
+        job_id = queue.enqueue('design', {'sequence': args['sequence'], 'number_of_pairs': args['number_of_pairs']})
+        deadline = time.time() + timeout
+        while True:
+            row = queue.get(job_id)
+            if row['status'] == 'finished':
+                return row['result']['primers']
+            if row['status'] == 'failed':
+                raise ValueError(row['error'])
+            if row['status'] in ('cancelling', 'cancelled'):
+                raise QueueWaitError('design job {} was cancelled: {}'.format(job_id, row['error']), 409)
+            if time.time() > deadline:
+                # nobody waits for the result anymore, a worker which picks it up later skips it
+                queue.cancel(job_id, 'no result within {} s'.format(timeout))
+                raise QueueWaitError('design job {} did not finish within {} s'.format(job_id, timeout), 504)
+            time.sleep(poll_interval)
+
 class RestBlastPrimers(Resource):
     def get(self):
         RestBlast().get()
@@ -168,6 +461,9 @@ class RestBlastPrimers(Resource):
         print(args, file=sys.stderr)
         args = job.set_arguments_for_primer_blast(args)
         print(str(args) + '#' * 20, file=sys.stderr)
+        if use_queue():
+            JobQueue(job.result_db).enqueue('blast_primers', {'parameters': args}, job_id=job_id)
+            return job_id
         job.future = executor.submit(functools.partial(job.run, parameters=args))
         jobs[job_id] = job
 
@@ -186,19 +482,85 @@ class RestShutdown(Resource):
         self.get()
 
 
-api.add_resource(RestBlast, '/blast/')
-api.add_resource(RestBlastMinimal, '/blast/<blast_id>')
-api.add_resource(RestBlastHits, '/blast/hits/<blast_id>')
-api.add_resource(RestBlastPrimers, '/blast_primers/')
-api.add_resource(RestNucleotide, '/nucleotide/')
-api.add_resource(RestNucleotideMinimal, '/nucleotide/<accession>')
-api.add_resource(RestDesignPrimers, '/design/')
-api.add_resource(RestShutdown, '/shutdown/')
-
+def register_resources(api):
+    api.add_resource(RestBlast, '/blast/')
+    api.add_resource(RestBlastMinimal, '/blast/<blast_id>')
+    api.add_resource(RestBlastHits, '/blast/hits/<blast_id>')
+    api.add_resource(RestHitStore, '/hits/')
+    api.add_resource(RestBlastPrimers, '/blast_primers/')
+    api.add_resource(RestNucleotide, '/nucleotide/')
+    api.add_resource(RestNucleotideMinimal, '/nucleotide/<accession>')
+    api.add_resource(RestDesignPrimers, '/design/')
+    api.add_resource(RestShutdown, '/shutdown/')
+
+
+def start_workers(result_db, threads):
+    """
+    Starts worker threads which run jobs from the shared queue, once per process. Threads do not survive a fork,
+    pre-fork servers therefore start them in each worker process on its first request.
+    :param result_db: str, the result database with the queue
+    :param threads: int, the number of worker threads
+    :return: bool, True if the threads were started by this call
+    """
+
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return False
+        _workers_pid = os.getpid()
+        queue = JobQueue(result_db)
+        for _ in range(threads):
+            threading.Thread(target=Worker(queue).run, daemon=True).start()
+    return True
+
+
+def create_app(shared=False, worker_threads=None):
+    """
+    Creates the REST application. With shared state all jobs go through the job queue in the result database,
+    which is switched to WAL mode, and any process can answer for any job. This allows serving with several
+    processes of a pre-fork WSGI server, e.g.
+        gunicorn -w 4 'PrimerDesigner.ServerPrimerDesigner:create_app(shared=True)'
+    :param shared: bool, keeps all job state in the result database instead of the process
+    :param worker_threads: int, queue workers per process if shared, config key server_worker_threads or 2 if
+                           None, 0 if jobs are run by separate PrimerDesigner.worker processes
+    :return: Flask
+    """
+
+    application = Flask(__name__)
+    application.config['PRIMERDESIGNER_SHARED'] = shared
+    register_resources(Api(application))
+    if shared:
+        result_db = BlastJob().result_db
+        tools.enable_wal(result_db)
+        if worker_threads is None:
+            worker_threads = int(config.get_settings().config.get('server_worker_threads', 2))
+        if worker_threads > 0:
+            @application.before_request
+            def ensure_workers():
+                start_workers(result_db, worker_threads)
+    return application
+
+
+app = create_app()
+
+
+def start(host='0.0.0.0', debug=False, processes=1):
+    """
+    Runs the Werkzeug server, several processes share their state through the result database
+    :param host: str, the interface
+    :param debug: bool, runs the debug server
+    :param processes: int, the number of processes which handle requests
+    :return: None
+    """
 
-def start(host='0.0.0.0', debug=False):
     tools.create_empty_database()
-    app.run(host=host, debug=debug)
+    if processes <= 1:
+        app.run(host=host, debug=debug)
+        return
+    # Werkzeug forks a process per request, the queue workers run in this process
+    shared_app = create_app(shared=True, worker_threads=0)
+    start_workers(BlastJob().result_db, int(config.get_settings().config.get('server_worker_threads', 2)))
+    shared_app.run(host=host, debug=debug, threaded=False, processes=processes)
 
 
 if __name__ == '__main__':
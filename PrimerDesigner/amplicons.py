@@ -0,0 +1,168 @@
+import re
+import collections
+
+
+# the columns of the primer BLAST searches, sstrand tells on which strand a primer binds
+BLAST_OUTFMT = '6 qseqid sacc sstart send sstrand evalue'
+
+PLUS = 1
+MINUS = -1
+
+Products = collections.namedtuple('Products', ['subjects', 'start', 'end', 'plus_primer', 'minus_primer'])
+
+
+def base_accession(accession):
+    # BLAST reports accessions without version, FASTA headers of blastdbcmd include it, other dots are kept
+    return re.sub(r'\.\d+$', '', accession)
+
+
+class PrimerHits:
+    """
+    Binding sites of primers in a database held in NumPy arrays, coordinates are 0-based, end exclusive and on the
+    plus strand of the subject, a primer on the plus strand is extended towards larger coordinates
+    """
+
+    def __init__(self, subjects, subject_index, start, end, strand, primer):
+        self.subjects = subjects
+        self.subject_index = subject_index
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.primer = primer
+
+    def __len__(self):
+        return len(self.start)
+
+    @staticmethod
+    def from_lists(subjects, start, end, strand, primer):
+        """
+        :param subjects: list, the subject of each hit
+        :param start: list, 0-based start of each hit
+        :param end: list, exclusive end of each hit
+        :param strand: list, PLUS or MINUS
+        :param primer: list, an integer which identifies the primer, e.g. 0 for forward and 1 for reverse
+        :return: PrimerHits
+        """
+
+        import numpy as np
+        if len(subjects) == 0:
+            names, index = [], np.zeros(0, dtype=np.int64)
+        else:
+            names, index = np.unique(np.array(subjects, dtype=str), return_inverse=True)
+        return PrimerHits(list(names), index.astype(np.int64), np.array(start, dtype=np.int64),
+                          np.array(end, dtype=np.int64), np.array(strand, dtype=np.int8),
+                          np.array(primer, dtype=np.int8))
+
+    @staticmethod
+    def from_blast(handle, primers):
+        """
+        Reads the tabular output of a primer search with BLAST_OUTFMT
+        :param handle: file object, the BLAST output
+        :param primers: dict, query id: primer identifier
+        :return: PrimerHits
+        """
+
+        subjects = []
+        start = []
+        end = []
+        strand = []
+        primer = []
+        for line in handle:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if line.startswith('#') or len(line.strip()) == 0:
+                continue
+            query, subject, sstart, send, sstrand = line.rstrip('\n').split('\t')[0:5]
+            sstart = int(sstart)
+            send = int(send)
+            subjects.append(base_accession(subject))
+            start.append(min(sstart, send) - 1)
+            end.append(max(sstart, send))
+            strand.append(MINUS if sstrand == 'minus' or sstart > send else PLUS)
+            primer.append(primers[query])
+        return PrimerHits.from_lists(subjects, start, end, strand, primer)
+
+    @staticmethod
+    def from_fm_index(hits, primer_length, primer, subjects=None):
+        """
+        :param hits: list of fm_index.Hit
+        :param primer_length: int, the length of the primer
+        :param primer: int, the primer identifier
+        :param subjects: set, only hits in these accessions without version are kept, all hits if None
+        :return: PrimerHits
+        """
+
+        if subjects is not None:
+            hits = [hit for hit in hits if base_accession(hit.name) in subjects]
+        return PrimerHits.from_lists([base_accession(hit.name) for hit in hits],
+                                     [hit.position for hit in hits],
+                                     [hit.position + primer_length for hit in hits],
+                                     [PLUS if hit.strand == '+' else MINUS for hit in hits],
+                                     [primer] * len(hits))
+
+    @staticmethod
+    def concatenate(hits):
+        """
+        :param hits: list of PrimerHits
+        :return: PrimerHits, all hits with a common subject table
+        """
+
+        import numpy as np
+        subjects = []
+        for h in hits:
+            subjects.extend(h.subjects[i] for i in h.subject_index)
+        return PrimerHits.from_lists(subjects,
+                                     np.concatenate([h.start for h in hits] + [np.zeros(0, dtype=np.int64)]),
+                                     np.concatenate([h.end for h in hits] + [np.zeros(0, dtype=np.int64)]),
+                                     np.concatenate([h.strand for h in hits] + [np.zeros(0, dtype=np.int8)]),
+                                     np.concatenate([h.primer for h in hits] + [np.zeros(0, dtype=np.int8)]))
+
+
+def predict_products(hits, max_size=1500):
+    """
+    Finds all products which the primers could amplify, i.e. a primer on the plus strand and a primer on the minus
+    strand of the same subject downstream of it within max_size, single primers can form products with themselves.
+    Minus strand hits are sorted by subject and end and each plus strand hit finds its window of minus strand hits by
+    binary search, which takes O(n log n) time for n hits plus the number of products.
+    :param hits: PrimerHits, the binding sites of the primers
+    :param max_size: int, the largest product
+    :return: Products, arrays with one entry per product
+    """
+
+    import numpy as np
+    # subjects are placed apart on one axis so windows never reach into the next subject
+    spacing = np.int64(max(int(hits.end.max()) if len(hits) > 0 else 0, 0) + max_size + 1)
+    plus = np.flatnonzero(hits.strand == PLUS)
+    minus = np.flatnonzero(hits.strand == MINUS)
+    plus_start = hits.subject_index[plus] * spacing + hits.start[plus]
+    plus_end = hits.subject_index[plus] * spacing + hits.end[plus]
+    minus_end = hits.subject_index[minus] * spacing + hits.end[minus]
+    order = np.argsort(minus_end, kind='stable')
+    minus = minus[order]
+    minus_end = minus_end[order]
+
+    # a product reaches at least to the end of its plus strand primer
+    lo = np.searchsorted(minus_end, plus_end, side='left')
+    hi = np.searchsorted(minus_end, plus_start + max_size, side='right')
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    plus_idx = np.repeat(plus, counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    minus_idx = minus[np.repeat(lo, counts) + np.arange(total, dtype=np.int64) - offsets]
+    return Products(hits.subject_index[plus_idx], hits.start[plus_idx], hits.end[minus_idx],
+                    hits.primer[plus_idx], hits.primer[minus_idx])
+
+
+def off_target_products(hits, on_target, max_size=1500):
+    """
+    :param hits: PrimerHits, the binding sites of the primers
+    :param on_target: iterable, accessions on which products are expected
+    :param max_size: int, the largest product
+    :return: dict, accession: number of products on every other subject
+    """
+
+    import numpy as np
+    products = predict_products(hits, max_size=max_size)
+    expected = set(base_accession(accession) for accession in on_target)
+    subjects, counts = np.unique(products.subjects, return_counts=True)
+    return {hits.subjects[s]: int(c) for s, c in zip(subjects, counts) if hits.subjects[s] not in expected}
@@ -0,0 +1,124 @@
+import os
+import glob
+import time
+import statistics
+from PrimerDesigner.tools import tools
+
+
+def database_size(blast_db, shards=None):
+    """
+    Returns the size of a database in bytes of sequence data
+    :param blast_db: str, the database as passed to blastn -db
+    :param shards: dict, the shard manifest of a sharded database
+    :return: int
+    """
+
+    databases = [blast_db] if shards is None else shards['shards']
+    size = 0
+    for database in databases:
+        filenames = glob.glob(glob.escape(database) + '.nsq') + glob.glob(glob.escape(database) + '.*.nsq')
+        if len(filenames) == 0 and os.path.isfile(database):
+            filenames = [database]
+        size += sum(os.path.getsize(f) for f in filenames)
+    return size
+
+
+def current_load():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def slowdown(load, num_threads, cpus=None):
+    """
+    Estimates how much slower a search runs when the machine is busy
+    :param load: float, the load average
+    :param num_threads: int, the threads of the search
+    :param cpus: int, the number of CPUs
+    :return: float, 1 if all threads get a CPU
+    """
+
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    return max(1.0, (load + num_threads) / cpus)
+
+
+class Autotuner:
+    """
+    Records the run time of BLAST searches in the blast_timings table of the result database and picks the number
+    of threads and the task with the lowest expected latency for similar searches, i.e. searches against databases of
+    similar size with queries of similar length. Run times are normalized by the load at the time of the search.
+    """
+
+    def __init__(self, result_db='blast_jobs.db', min_samples=3, size_factor=2.0):
+        self.result_db = result_db
+        self.min_samples = min_samples
+        self.size_factor = size_factor
+
+    def _connect(self):
+        return tools.connect_result_db(self.result_db)
+
+    def record(self, blast_db, db_size, query_length, task, num_threads, seconds, load=None):
+        """
+        Stores the run time of a search
+        :param blast_db: str, the database
+        :param db_size: int, the size of the database, see database_size
+        :param query_length: int, the length of the query
+        :param task: str, the BLAST task
+        :param num_threads: int, the number of threads
+        :param seconds: float, the run time
+        :param load: float, the load average when the search started
+        :return: None
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO blast_timings (db, db_size, query_length, task, num_threads, load, seconds, '
+                         'created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (os.path.abspath(blast_db), db_size, query_length, task, num_threads,
+                          current_load() if load is None else load, seconds, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def estimates(self, db_size, query_length, tasks, threads, load=None):
+        """
+        Estimates the latency of each task and number of threads from similar searches
+        :return: dict, (task, num_threads): expected seconds, only combinations with enough samples
+        """
+
+        if load is None:
+            load = current_load()
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT task, num_threads, seconds, load FROM blast_timings '
+                                'WHERE db_size BETWEEN ? AND ? AND query_length BETWEEN ? AND ? '
+                                'AND num_threads IN ({}) AND task IN ({})'.format(','.join('?' * len(threads)),
+                                                                                  ','.join('?' * len(tasks))),
+                                [db_size / self.size_factor, db_size * self.size_factor,
+                                 query_length / self.size_factor, query_length * self.size_factor] +
+                                list(threads) + list(tasks)).fetchall()
+        finally:
+            conn.close()
+        samples = {}
+        for task, num_threads, seconds, load_then in rows:
+            samples.setdefault((task, num_threads), []).append(seconds / slowdown(load_then or 0, num_threads))
+        return {key: statistics.median(values) * slowdown(load, key[1])
+                for key, values in samples.items() if len(values) >= self.min_samples}
+
+    def choose(self, db_size, query_length, tasks, threads, load=None):
+        """
+        Picks the task and number of threads with the lowest expected latency
+        :param db_size: int, the size of the database
+        :param query_length: int, the length of the query
+        :param tasks: list, the tasks which are suitable for the query
+        :param threads: list, the numbers of threads which may be used
+        :param load: float, the current load average, measured if None
+        :return: tuple (task, num_threads) or None if there are not enough similar searches
+        """
+
+        estimates = self.estimates(db_size, query_length, tasks, threads, load=load)
+        if len(estimates) == 0:
+            return None
+        return min(estimates, key=lambda key: (estimates[key], key[1]))
@@ -0,0 +1,100 @@
+import os
+import threading
+import multiprocessing
+import collections
+import types
+
+
+Settings = collections.namedtuple('Settings', ['conf_file',
+                                               'blast_executable',
+                                               'directory_database',
+                                               'directory_query',
+                                               'directory_tmp',
+                                               'directory_cache',
+                                               'directory_results',
+                                               'gfserver',
+                                               'defaults',
+                                               'config'])
+
+_settings = {}
+_lock = threading.Lock()
+
+
+def _read_yaml(filename):
+    # yaml is only needed when a configuration file is actually present
+    import yaml
+    with open(filename, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def _load_settings(conf_file, defaults_file):
+    if os.path.isfile(conf_file):
+        config = _read_yaml(conf_file)
+    else:
+        config = {'blast': os.environ.get('BLAST_EXECUTABLE'),
+                  'blast_dir': os.environ.get('BLAST_DIRECTORY'),
+                  'gfserver': os.environ.get('GFSERVER')}
+
+    if os.path.isfile(defaults_file):
+        defaults = _read_yaml(defaults_file)
+    else:
+        defaults = {}
+    defaults['short_sequence'] = int(defaults.get('short_sequence', 25))
+    defaults['num_threads'] = int(defaults.get('num_threads', min(6, multiprocessing.cpu_count())))
+    defaults['outfmt'] = int(defaults.get('outfmt', 5))
+
+    directory_database = config.get('blast_dir')
+    directory_query = config.get('query_dir')
+    if directory_query is None and directory_database is not None:
+        directory_query = os.path.join(os.path.dirname(directory_database), '..', 'query')
+    directory_tmp = config.get('tmp_dir', '/tmp/')
+    directory_cache = config.get('cache_dir')
+    if directory_cache is None:
+        if directory_database is not None:
+            directory_cache = os.path.join(os.path.dirname(directory_database), '..', 'cache')
+        else:
+            directory_cache = os.path.join(directory_tmp, 'primer_designer_cache')
+
+    directory_results = config.get('result_dir', os.path.join(directory_cache, '..', 'results'))
+
+    # directories are created once per configuration, not once per job
+    for direc in (directory_database, directory_query, directory_tmp, directory_cache, directory_results):
+        if direc:
+            os.makedirs(direc, exist_ok=True)
+
+    return Settings(conf_file=conf_file,
+                    blast_executable=config.get('blast'),
+                    directory_database=directory_database,
+                    directory_query=directory_query,
+                    directory_tmp=directory_tmp,
+                    directory_cache=directory_cache,
+                    directory_results=directory_results,
+                    gfserver=config.get('gfserver'),
+                    defaults=types.MappingProxyType(defaults),
+                    config=types.MappingProxyType(dict(config)))
+
+
+def get_settings(conf_file='blast.conf', defaults_file='blast_defaults', reload=False):
+    """
+    Returns the settings for a configuration file, the file is only read on first use
+    :param conf_file: str, the YAML configuration file, environment variables are used if it does not exist
+    :param defaults_file: str, the YAML file with the BLAST defaults
+    :param reload: bool, if True the configuration is read again from disk
+    :return: Settings, an immutable settings object
+    """
+
+    key = (os.path.abspath(conf_file), os.path.abspath(defaults_file))
+    with _lock:
+        if reload or key not in _settings:
+            _settings[key] = _load_settings(conf_file, defaults_file)
+        return _settings[key]
+
+
+def reload_settings():
+    """
+    Drops all cached settings, they are read again on next use
+    :return: None
+    """
+
+    with _lock:
+        _settings.clear()
@@ -0,0 +1,186 @@
+import os
+import json
+import uuid
+import hashlib
+import collections
+from PrimerDesigner.tools import tools
+from PrimerDesigner import kmer_sketch
+
+
+def _accession(header):
+    return header.split(' ')[0]
+
+
+class MinHash:
+    """
+    MinHash sketches of canonical k-mers, similar sequences are found by locality sensitive hashing of the sketches
+    """
+
+    def __init__(self, k=21, num_hashes=64, bands=16, seed=42):
+        import numpy as np
+        if k > 31:
+            raise ValueError('k needs to be 31 or smaller')
+        if num_hashes % bands != 0:
+            raise ValueError('num_hashes needs to be a multiple of bands')
+        self.np = np
+        self.k = k
+        self.num_hashes = num_hashes
+        self.bands = bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=num_hashes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_hashes, dtype=np.uint64)
+
+    def kmers(self, seq):
+        """
+        Returns the canonical k-mers of a sequence, k-mers with other bases than ACGT are skipped
+        :param seq: str, the sequence
+        :return: numpy.ndarray of uint64
+        """
+
+        return kmer_sketch.canonical_kmers(seq, self.k)
+
+    def sketch(self, seq):
+        """
+        Returns the MinHash sketch of a sequence
+        :param seq: str, the sequence
+        :return: numpy.ndarray of uint64 or None if the sequence has no valid k-mer
+        """
+
+        np = self.np
+        kmers = self.kmers(seq)
+        if len(kmers) == 0:
+            return None
+        sketch = np.empty(self.num_hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for i in range(self.num_hashes):
+                h = kmers * self._a[i] + self._b[i]
+                h ^= h >> np.uint64(29)
+                sketch[i] = h.min()
+        return sketch
+
+    def similarity(self, sketch_1, sketch_2):
+        return float((sketch_1 == sketch_2).mean())
+
+    def band_keys(self, sketch):
+        rows = self.num_hashes // self.bands
+        return [(b, sketch[b * rows:(b + 1) * rows].tobytes()) for b in range(self.bands)]
+
+
+def collapse(records, threshold=None, minhash=None):
+    """
+    Collapses identical sequences and optionally clusters near-identical ones
+    :param records: iterable of tuples (header, sequence)
+    :param threshold: float, the estimated Jaccard similarity of k-mers above which sequences are clustered,
+                      only identical sequences are collapsed if None
+    :param minhash: MinHash, the sketcher used for clustering, created with default parameters if None
+    :return: tuple (list of representative records, dict representative accession: list of member accessions)
+    """
+
+    representatives = []
+    members = collections.OrderedDict()
+    seen = {}
+    for header, seq in records:
+        digest = hashlib.sha1(seq.upper().encode('utf-8')).digest()
+        accession = _accession(header)
+        if digest in seen:
+            members[seen[digest]].append(accession)
+            continue
+        seen[digest] = accession
+        representatives.append((header, seq))
+        members[accession] = [accession]
+    if threshold is None:
+        return representatives, members
+
+    if minhash is None:
+        minhash = MinHash()
+    # long sequences become the representatives of their clusters
+    representatives.sort(key=lambda r: len(r[1]), reverse=True)
+    buckets = collections.defaultdict(list)
+    sketches = {}
+    clustered = []
+    clustered_members = collections.OrderedDict()
+    for header, seq in representatives:
+        accession = _accession(header)
+        sketch = minhash.sketch(seq)
+        representative = None
+        if sketch is not None:
+            keys = minhash.band_keys(sketch)
+            candidates = []
+            for key in keys:
+                for candidate in buckets.get(key, []):
+                    if candidate not in candidates:
+                        candidates.append(candidate)
+            for candidate in candidates:
+                if minhash.similarity(sketch, sketches[candidate]) >= threshold:
+                    representative = candidate
+                    break
+        if representative is not None:
+            clustered_members[representative].extend(members[accession])
+            continue
+        clustered.append((header, seq))
+        clustered_members[accession] = list(members[accession])
+        if sketch is not None:
+            sketches[accession] = sketch
+            for key in keys:
+                buckets[key].append(accession)
+    return clustered, clustered_members
+
+
+def collapsed_filenames(filename, threshold=None):
+    """
+    :param filename: str, the FASTA file
+    :param threshold: float, see collapse
+    :return: tuple (str filename of the representatives, str filename of the members map)
+    """
+
+    suffix = '.dedup' if threshold is None else '.dedup{:g}'.format(threshold)
+    return filename + suffix + '.fa', filename + suffix + '.members.json'
+
+
+def is_collapsed(filename, threshold=None):
+    # the members map is written last and is newer than the FASTA file if the output is complete
+    filename_members = collapsed_filenames(filename, threshold=threshold)[1]
+    return os.path.isfile(filename_members) and os.path.getmtime(filename_members) >= os.path.getmtime(filename)
+
+
+def collapse_fasta(filename, threshold=None):
+    """
+    Writes the representatives of a FASTA file and the map of their members, results are reused until the
+    FASTA file changes
+    :param filename: str, the FASTA file
+    :param threshold: float, see collapse
+    :return: tuple (str filename of the representatives, dict representative accession: list of member accessions)
+    """
+
+    filename_out, filename_members = collapsed_filenames(filename, threshold=threshold)
+    if is_collapsed(filename, threshold=threshold):
+        with open(filename_members, 'r') as f:
+            return filename_out, json.load(f, object_pairs_hook=collections.OrderedDict)
+
+    representatives, members = collapse(tools.iter_fasta(filename), threshold=threshold)
+    # concurrent jobs on the same hit set write their own temporary files
+    filename_tmp = '{}.{}.tmp'.format(filename_out, uuid.uuid4().hex)
+    with open(filename_tmp, 'w') as f:
+        for header, seq in representatives:
+            f.write('>{}\n{}\n'.format(header, seq))
+    os.replace(filename_tmp, filename_out)
+    # the members map is written last, it marks the output as complete
+    filename_tmp = '{}.{}.tmp'.format(filename_members, uuid.uuid4().hex)
+    with open(filename_tmp, 'w') as f:
+        json.dump(members, f)
+    os.replace(filename_tmp, filename_members)
+    return filename_out, members
+
+
+def expand(accessions, members):
+    """
+    Expands representatives to all their members
+    :param accessions: list, accessions of representatives
+    :param members: dict, see collapse
+    :return: list, the member accessions
+    """
+
+    expanded = []
+    for accession in accessions:
+        expanded.extend(members.get(accession, [accession]))
+    return expanded
@@ -9,6 +9,8 @@ def parse_args(args):
     parser.add_argument('targetSequence', type=str, help='either a plain sequence or a FASTA file')
     parser.add_argument('primerPairs', type=int, help='number of primer pairs which should be designed')
     parser.add_argument('database', type=str, default='nt', help='the database which is used as a negative selection')
+    parser.add_argument('--record', type=str, default=None,
+                        help='the name of the target in an indexed (optionally bgzip compressed) FASTA file')
     return parser.parse_args(args)
 
 
@@ -26,6 +28,6 @@ if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
     if not validate_args(args):
         sys.exit(1)
-    p = Primer.design_primers(args.targetSequence, args.primerPairs, database=args.database)
+    p = Primer.design_primers(args.targetSequence, args.primerPairs, database=args.database, record_name=args.record)
     print(p)
 
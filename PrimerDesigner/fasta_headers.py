@@ -0,0 +1,201 @@
+import sys
+import os
+import mmap
+import argparse
+import concurrent.futures
+from PrimerDesigner.tools import tools
+
+
+OUTPUTS = ('headers', 'accessions', 'descriptions', 'seqidlist', 'csv', 'index')
+
+
+def split_description(header):
+    """
+    Splits a FASTA header into accession and description like cut -d ' ' -f 1 and cut -d ' ' -f 2-
+    :param header: str, the header without '>'
+    :return: tuple (accession, description), the description is the whole header if there is no space
+    """
+
+    cells = header.split(' ', 1)
+    return cells[0], cells[1] if len(cells) > 1 else header
+
+
+def chunk_boundaries(filename, chunks):
+    """
+    Splits a FASTA file into chunks which start at a record
+    :param filename: str, the FASTA file
+    :param chunks: int, the number of chunks
+    :return: list of tuples (start, end) in bytes
+    """
+
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+    boundaries = [0]
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(1, chunks):
+                pos = mm.find(b'\n>', max(size * i // chunks, boundaries[-1]))
+                if pos == -1:
+                    break
+                if pos + 1 > boundaries[-1]:
+                    boundaries.append(pos + 1)
+    boundaries.append(size)
+    return list(zip(boundaries[0:-1], boundaries[1:]))
+
+
+def scan_chunk(filename, start, end):
+    """
+    Scans the records of a chunk
+    :param filename: str, the FASTA file
+    :param start: int, the first byte of the chunk, needs to be the start of a record or of the file
+    :param end: int, the end of the chunk
+    :return: tuple (list of records, number of lines in the chunk), each record is a tuple
+             (header, byte offset, sequence length, first line, last line) with line numbers relative to the chunk
+    """
+
+    records = []
+    lines = 0
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            if mm[pos:pos + 1] != b'>':
+                # text before the first record
+                nxt = mm.find(b'\n>', pos, end)
+                nxt = nxt + 1 if nxt != -1 else end
+                lines += mm[pos:nxt].count(b'\n')
+                pos = nxt
+            while pos < end:
+                header_end = mm.find(b'\n', pos, end)
+                if header_end == -1:
+                    header_end = end
+                nxt = mm.find(b'\n>', header_end, end)
+                record_end = nxt + 1 if nxt != -1 else end
+                seq = mm[header_end + 1:record_end]
+                newlines = seq.count(b'\n')
+                length = len(seq) - newlines - seq.count(b'\r')
+                header = mm[pos + 1:header_end].rstrip(b'\r').decode('utf-8', 'replace')
+                record_lines = 1 + newlines + (0 if len(seq) == 0 or seq.endswith(b'\n') else 1)
+                records.append((header, pos, length, lines + 1, lines + record_lines))
+                lines += 1 + newlines if header_end < end else 0
+                pos = record_end
+    return records, lines
+
+
+def _scan_stream(filename):
+    # compressed files cannot be memory-mapped and are scanned sequentially
+    records = []
+    offset = 0
+    line_no = 0
+    record = None
+    with tools.open_fasta(filename, 'rb') as f:
+        for line in f:
+            line_no += 1
+            if line.startswith(b'>'):
+                if record is not None:
+                    records.append(tuple(record))
+                record = [line[1:].rstrip(b'\r\n').decode('utf-8', 'replace'), offset, 0, line_no, line_no]
+            elif record is not None:
+                record[2] += len(line.rstrip(b'\r\n'))
+                record[4] = line_no
+            offset += len(line)
+    if record is not None:
+        records.append(tuple(record))
+    return records, line_no
+
+
+def iter_records(filename, processes=None, chunks=None):
+    """
+    Scans the headers of a FASTA file in parallel, records are yielded in file order
+    :param filename: str, the FASTA file, compressed files are scanned sequentially
+    :param processes: int, the number of processes, the number of CPUs if None
+    :param chunks: int, the number of chunks, at least four per process and one per 64 MiB if None
+    :return: generator of tuples (header, byte offset, sequence length, first line, last line), line numbers are 1-based
+    """
+
+    if tools.is_gzip(filename):
+        yield from _scan_stream(filename)[0]
+        return
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if chunks is None:
+        chunks = max(processes * 4, os.path.getsize(filename) // 2 ** 26)
+    boundaries = chunk_boundaries(filename, chunks)
+    line_offset = 0
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        results = executor.map(scan_chunk, [filename] * len(boundaries), [b[0] for b in boundaries],
+                               [b[1] for b in boundaries])
+        for records, lines in results:
+            for header, offset, length, first, last in records:
+                yield header, offset, length, first + line_offset, last + line_offset
+            line_offset += lines
+
+
+def extract(filename, outputs, processes=None, chunks=None, delim='\t'):
+    """
+    Writes headers, accessions, descriptions and record positions of a FASTA file in a single pass
+    :param filename: str, the FASTA file
+    :param outputs: dict, output type: filename, the types are
+                    headers: the header lines like scripts/getHeaders.sh
+                    accessions: the accessions like scripts/getAccession.sh
+                    descriptions: the descriptions like scripts/getDescription.sh
+                    seqidlist: the accessions as text seqidlist for blastn -seqidlist
+                    csv: the table written by fasta_to_sql.fasta_to_csv without sequences
+                    index: accession, sequence length and byte offset of the header of each record
+    :param processes: int, the number of processes
+    :param chunks: int, the number of chunks
+    :param delim: str, the delimiter of the csv and index output
+    :return: int, the number of records
+    """
+
+    for output in outputs:
+        if output not in OUTPUTS:
+            raise ValueError('unknown output {}, valid outputs are: {}'.format(output, ', '.join(OUTPUTS)))
+    handles = {}
+    number_of_records = 0
+    try:
+        for output, output_filename in outputs.items():
+            handles[output] = sys.stdout if output_filename == 'stdout' else open(output_filename, 'w')
+        if 'csv' in handles:
+            handles['csv'].write('AccessionNumber{d}Description{d}Start{d}Stop\n'.format(d=delim))
+        if 'index' in handles:
+            handles['index'].write('AccessionNumber{d}Length{d}Offset\n'.format(d=delim))
+        for header, offset, length, first, last in iter_records(filename, processes=processes, chunks=chunks):
+            accession, description = split_description(header)
+            for output, handle in handles.items():
+                if output == 'headers':
+                    handle.write('>{}\n'.format(header))
+                elif output in ('accessions', 'seqidlist'):
+                    handle.write('{}\n'.format(accession))
+                elif output == 'descriptions':
+                    handle.write('{}\n'.format(description))
+                elif output == 'csv':
+                    handle.write('{1}{0}{2}{0}{3}{0}{4}\n'.format(delim, accession, description, first, last))
+                else:
+                    handle.write('{1}{0}{2}{0}{3}\n'.format(delim, accession, length, offset))
+            number_of_records += 1
+    finally:
+        for handle in handles.values():
+            if handle is not sys.stdout:
+                handle.close()
+    return number_of_records
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Extracts headers, accessions and descriptions from a FASTA file '
+                                                 'in a single parallel pass')
+    parser.add_argument('filename', type=str, help='the FASTA file')
+    for output in OUTPUTS:
+        parser.add_argument('--{}'.format(output), type=str, default=None,
+                            help='writes the {} to this file, stdout for printing'.format(output))
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of processes, default all CPUs')
+    parser.add_argument('-d', '--delimiter', type=str, default='\t', help='the delimiter of the csv and index output')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    outputs = {output: getattr(args, output) for output in OUTPUTS if getattr(args, output) is not None}
+    if len(outputs) == 0:
+        outputs = {'headers': 'stdout'}
+    extract(args.filename, outputs, processes=args.processes, delim=args.delimiter)
@@ -1,5 +1,6 @@
 import sys
 import argparse
+from PrimerDesigner.tools import tools
 
 
 def fasta_to_csv(filename, output_location='stdout', output_header=True, output_sequence=False, delim="\t"):
@@ -21,7 +22,7 @@ def fasta_to_csv(filename, output_location='stdout', output_header=True, output_
 	else:
 		output = ''
 	output_location.write(output)
-	with open(filename, 'r') as f:
+	with tools.open_fasta(filename) as f:
 		for line_no, line in enumerate(f):
 			if line.startswith('>'):
 				if line_no != 0:
@@ -0,0 +1,282 @@
+import os
+import time
+from xml.etree import ElementTree
+from PrimerDesigner.tools import tools
+
+
+COLUMNS = ('query', 'subject', 'qstart', 'qend', 'sstart', 'send', 'strand', 'identity', 'evalue', 'bitscore')
+# the columns of outfmt 6, 7 and 10 without format specifiers
+STD_FIELDS = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen', 'qstart', 'qend', 'sstart', 'send',
+              'evalue', 'bitscore']
+TABULAR_FIELDS = {'qseqid': 'query', 'qacc': 'query', 'sacc': 'subject', 'qstart': 'qstart', 'qend': 'qend',
+                  'sstart': 'sstart', 'send': 'send', 'pident': 'identity', 'evalue': 'evalue', 'bitscore': 'bitscore'}
+
+
+def _text(element, tag, convert=str):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return None
+    return convert(child.text)
+
+
+def _strand(sstart, send):
+    if sstart is None or send is None:
+        return None
+    return -1 if send < sstart else 1
+
+
+def iter_xml(handle):
+    """
+    Parses the HSPs of XML output (outfmt 5) while streaming it
+    :param handle: file object, the BLAST output
+    :return: generator of tuples with the values of COLUMNS
+    """
+
+    for _, element in ElementTree.iterparse(handle):
+        if element.tag != 'Iteration':
+            continue
+        query = (_text(element, 'Iteration_query-def') or '').split(' ')[0]
+        for hit in element.iterfind('Iteration_hits/Hit'):
+            subject = _text(hit, 'Hit_accession') or (_text(hit, 'Hit_id') or '').split(' ')[0]
+            for hsp in hit.iterfind('Hit_hsps/Hsp'):
+                sstart = _text(hsp, 'Hsp_hit-from', int)
+                send = _text(hsp, 'Hsp_hit-to', int)
+                identity = _text(hsp, 'Hsp_identity', int)
+                length = _text(hsp, 'Hsp_align-len', int)
+                yield (query, subject, _text(hsp, 'Hsp_query-from', int), _text(hsp, 'Hsp_query-to', int),
+                       sstart, send, _strand(sstart, send),
+                       100.0 * identity / length if identity is not None and length else None,
+                       _text(hsp, 'Hsp_evalue', float), _text(hsp, 'Hsp_bit-score', float))
+        # finished iterations are dropped, the memory does not grow with the output
+        element.clear()
+
+
+def expand_fields(fields):
+    """
+    :param fields: list, the format specifiers of a tabular output format, e.g. ['std', 'sstrand']
+    :return: list, the columns with std replaced by its fields, STD_FIELDS if no specifiers were given
+    """
+
+    if len(fields) == 0:
+        return list(STD_FIELDS)
+    expanded = []
+    for field in fields:
+        expanded.extend(STD_FIELDS if field == 'std' else [field])
+    return expanded
+
+
+def iter_tabular(handle, outfmt):
+    """
+    Parses the HSPs of tabular output (outfmt 6, 7 and 10)
+    :param handle: file object, the BLAST output
+    :param outfmt: str, the output format including format specifiers
+    :return: generator of tuples with the values of COLUMNS, columns which were not requested are None
+    """
+
+    parts = outfmt.split(' ')
+    delim = ',' if parts[0] == '10' else '\t'
+    fields = expand_fields(parts[1:])
+    positions = {}
+    for i, field in enumerate(fields):
+        column = TABULAR_FIELDS.get(field)
+        if column is not None and column not in positions:
+            positions[column] = i
+    if 'subject' not in positions and 'sseqid' in fields:
+        positions['subject'] = fields.index('sseqid')
+    converters = {'qstart': int, 'qend': int, 'sstart': int, 'send': int, 'identity': float, 'evalue': float,
+                  'bitscore': float}
+    for line in handle:
+        if line.startswith('#') or len(line.strip()) == 0:
+            continue
+        cells = line.rstrip('\n').split(delim)
+        values = {}
+        for column, i in positions.items():
+            values[column] = converters.get(column, str)(cells[i]) if i < len(cells) else None
+        if 'sstrand' in fields:
+            values['strand'] = -1 if cells[fields.index('sstrand')] == 'minus' else 1
+        else:
+            values['strand'] = _strand(values.get('sstart'), values.get('send'))
+        yield tuple(values.get(column) for column in COLUMNS)
+
+
+def iter_hsps(handle, outfmt):
+    """
+    :param handle: file object, the BLAST output
+    :param outfmt: str, the output format including format specifiers
+    :return: generator of tuples with the values of COLUMNS, raises ValueError for formats without HSP coordinates
+    """
+
+    fmt = str(outfmt).split(' ')[0]
+    if fmt == '5':
+        return iter_xml(handle)
+    if fmt in ('6', '7', '10'):
+        return iter_tabular(handle, str(outfmt))
+    raise ValueError('hits cannot be extracted from outfmt {}'.format(fmt))
+
+
+class HitStore:
+    """
+    Normalized HSPs of finished BLAST runs in the result database, one row per HSP in the hits table. Runs are
+    identified by their run hash, the job ids which used a run are mapped to it in hit_jobs. Runs older than the
+    retention period are removed with prune.
+    """
+
+    def __init__(self, result_db='blast_jobs.db'):
+        self.result_db = result_db
+
+    def _connect(self):
+        return tools.connect_result_db(self.result_db)
+
+    def store(self, run, handle, outfmt, blast_db=None, job=None, batch_size=10000):
+        """
+        Parses the output of a run and stores its HSPs, runs which were stored before are skipped
+        :param run: str, the run hash
+        :param handle: file object, the BLAST output
+        :param outfmt: str, the output format including format specifiers
+        :param blast_db: str, the searched database
+        :param job: str, the job id which is mapped to the run
+        :param batch_size: int, HSPs inserted at once
+        :return: int, the number of stored HSPs
+        """
+
+        hsps = iter_hsps(handle, outfmt)
+        conn = self._connect()
+        count = 0
+        try:
+            # concurrent runs with the same hash wait here instead of storing the HSPs twice
+            conn.execute('BEGIN IMMEDIATE')
+            if job is not None:
+                conn.execute('INSERT OR REPLACE INTO hit_jobs (job, run) VALUES (?, ?)', (job, run))
+            if conn.execute('SELECT 1 FROM hit_runs WHERE run = ?', (run, )).fetchone() is not None:
+                conn.commit()
+                return 0
+            insert = 'INSERT INTO hits (run, {}) VALUES (?, {})'.format(', '.join(COLUMNS),
+                                                                         ', '.join('?' * len(COLUMNS)))
+            batch = []
+            for hsp in hsps:
+                batch.append((run, ) + hsp)
+                if len(batch) >= batch_size:
+                    conn.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            conn.executemany(insert, batch)
+            count += len(batch)
+            conn.execute('INSERT INTO hit_runs (run, db, hsps, created) VALUES (?, ?, ?, ?)',
+                         (run, os.path.abspath(blast_db) if blast_db is not None else None, count, time.time()))
+            # the hits and the run become visible together
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return count
+
+    def prune(self, max_age):
+        """
+        Removes the HSPs of runs which were stored more than max_age seconds ago
+        :param max_age: float, the retention period in seconds
+        :return: int, the number of removed runs
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            runs = [row[0] for row in conn.execute('SELECT run FROM hit_runs WHERE created < ?',
+                                                   (time.time() - max_age, ))]
+            for start in range(0, len(runs), 500):
+                batch = runs[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                for table in ('hits', 'hit_jobs', 'hit_runs'):
+                    conn.execute('DELETE FROM {} WHERE run IN ({})'.format(table, placeholders), batch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(runs)
+
+    @staticmethod
+    def _where(jobs=None, subject=None, queries=None, max_evalue=None):
+        clauses = []
+        values = []
+        if jobs is not None:
+            # run hashes can be used instead of job ids
+            clauses.append('(run IN (SELECT run FROM hit_jobs WHERE job IN ({0})) OR run IN ({0}))'.format(
+                ','.join('?' * len(jobs))))
+            values.extend(jobs)
+            values.extend(jobs)
+        if subject is not None:
+            clauses.append('subject = ?')
+            values.append(subject)
+        if queries is not None:
+            clauses.append('query IN ({})'.format(','.join('?' * len(queries))))
+            values.extend(queries)
+        if max_evalue is not None:
+            clauses.append('evalue <= ?')
+            values.append(max_evalue)
+        return ('WHERE ' + ' AND '.join(clauses)) if len(clauses) > 0 else '', values
+
+    def hits(self, jobs=None, subject=None, queries=None, max_evalue=None, limit=None):
+        """
+        Returns stored HSPs, all filters are optional
+        :param jobs: list, job ids or run hashes
+        :param subject: str, the subject accession
+        :param queries: list, the query ids, e.g. primer names
+        :param max_evalue: float, the highest e-value
+        :param limit: int, the maximal number of HSPs
+        :return: list of dict, the values of COLUMNS and run, ordered by e-value
+        """
+
+        where, values = self._where(jobs=jobs, subject=subject, queries=queries, max_evalue=max_evalue)
+        sql = 'SELECT run, {} FROM hits {} ORDER BY evalue, run, rowid'.format(', '.join(COLUMNS), where)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            values.append(limit)
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, values).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(('run', ) + COLUMNS, row)) for row in rows]
+
+    def queries_hitting(self, subject, jobs=None, max_evalue=None):
+        """
+        Answers which queries, e.g. primers, hit a subject
+        :param subject: str, the subject accession
+        :param jobs: list, only these job ids if given
+        :param max_evalue: float, the highest e-value
+        :return: list of dict with run, query, hsps and best e-value, best hits first
+        """
+
+        where, values = self._where(jobs=jobs, subject=subject, max_evalue=max_evalue)
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT run, query, COUNT(*), MIN(evalue) FROM hits {} GROUP BY run, query '
+                                'ORDER BY MIN(evalue), run, query'.format(where), values).fetchall()
+        finally:
+            conn.close()
+        return [{'run': run, 'query': query, 'hsps': hsps, 'evalue': evalue} for run, query, hsps, evalue in rows]
+
+    def top_subjects(self, jobs=None, queries=None, max_evalue=None, limit=10):
+        """
+        Finds the subjects which are hit by the most queries, e.g. the top off-targets of a primer panel
+        :param jobs: list, only these job ids if given
+        :param queries: list, only these queries if given
+        :param max_evalue: float, the highest e-value
+        :param limit: int, the number of subjects
+        :return: list of dict with subject, the number of distinct queries, HSPs and the best e-value
+        """
+
+        where, values = self._where(jobs=jobs, queries=queries, max_evalue=max_evalue)
+        conn = self._connect()
+        try:
+            # queries are named per run, the same name in two runs is a different query
+            rows = conn.execute("SELECT subject, COUNT(DISTINCT run || ' ' || query) AS queries, COUNT(*), "
+                                'MIN(evalue) FROM hits {} GROUP BY subject ORDER BY queries DESC, MIN(evalue), subject '
+                                'LIMIT ?'.format(where), values + [limit]).fetchall()
+        finally:
+            conn.close()
+        return [{'subject': subject, 'queries': queries, 'hsps': hsps, 'evalue': evalue}
+                for subject, queries, hsps, evalue in rows]
@@ -0,0 +1,136 @@
+import os
+import glob
+import json
+import hashlib
+
+
+# files which make up a nucleotide BLAST database, derived files like indexes are not part of the fingerprint
+BLAST_DB_EXTENSIONS = ('.nal', '.ndb', '.nhd', '.nhi', '.nhr', '.nin', '.nnd', '.nni', '.nog', '.nos', '.not',
+                       '.nsd', '.nsi', '.nsq', '.ntf', '.nto', '.njs')
+
+
+def database_fingerprint(blast_db):
+    """
+    Returns a fingerprint of the files of a BLAST database, it changes whenever the database is rebuilt
+    :param blast_db: str, the database as passed to blastn -db
+    :return: str, the hex digest
+    """
+
+    filenames = [f for f in glob.glob(glob.escape(blast_db) + '.*') if os.path.splitext(f)[1] in BLAST_DB_EXTENSIONS]
+    if os.path.isfile(blast_db):
+        filenames.append(blast_db)
+    h = hashlib.sha1()
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        h.update('{}\t{}\t{}\n'.format(os.path.basename(filename), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def normalize_sequence(sequence):
+    """
+    Removes FASTA headers, whitespace and case from a sequence
+    :param sequence: str, a plain sequence or a FASTA record
+    :return: str, the normalized sequence
+    """
+
+    lines = [line.strip() for line in sequence.splitlines() if not line.startswith('>')]
+    return ''.join(lines).upper()
+
+
+class HitSetCache:
+    """
+    Stores the accessions and the hit FASTA of BLAST searches on disk, least recently used entries are evicted
+    once the cache exceeds max_bytes
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(sequence, parameters, fingerprint):
+        """
+        Returns the cache key for a search
+        :param sequence: str, the target sequence
+        :param parameters: dict, the BLAST parameters which influence the hits
+        :param fingerprint: str, the database fingerprint, see database_fingerprint
+        :return: str, the key
+        """
+
+        key = json.dumps([normalize_sequence(sequence), parameters, fingerprint], sort_keys=True, default=str)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + '.fa'), os.path.join(self.directory, key + '.acc')
+
+    def get(self, key):
+        """
+        Looks up a hit set
+        :param key: str, the key
+        :return: tuple (list of accessions, str filename of the hit FASTA) or None
+        """
+
+        filename_fasta, filename_acc = self._paths(key)
+        try:
+            with open(filename_acc, 'r') as f:
+                accessions = [line.strip() for line in f if line.strip()]
+            os.utime(filename_acc)
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(filename_fasta):
+            return None
+        return accessions, filename_fasta
+
+    def put(self, key, accessions, fasta):
+        """
+        Stores a hit set, the accession file is written last and marks the entry as complete
+        :param key: str, the key
+        :param accessions: list, the accessions of the hits
+        :param fasta: str, the sequences of the hits in FASTA format
+        :return: tuple (list of accessions, str filename of the hit FASTA)
+        """
+
+        filename_fasta, filename_acc = self._paths(key)
+        for filename, content in ((filename_fasta, fasta), (filename_acc, '\n'.join(accessions) + '\n')):
+            filename_tmp = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(filename_tmp, 'w') as f:
+                f.write(content)
+            os.replace(filename_tmp, filename)
+        self.evict(keep=key)
+        return list(accessions), filename_fasta
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is smaller than max_bytes
+        :param keep: str, a key which is never evicted
+        :return: int, the number of evicted entries
+        """
+
+        entries = []
+        total = 0
+        for filename_acc in glob.glob(os.path.join(glob.escape(self.directory), '*.acc')):
+            key = os.path.basename(filename_acc)[0:-len('.acc')]
+            try:
+                size = sum(os.path.getsize(f) for f in self._paths(key))
+                entries.append((os.path.getmtime(filename_acc), key, size))
+            except FileNotFoundError:
+                continue
+            total += size
+        entries.sort()
+        evicted = 0
+        for _, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # files derived from the hit FASTA, e.g. collapsed hits, are removed with their entry
+            derived = glob.glob(glob.escape(self._paths(key)[0]) + '.*')
+            for filename in derived + list(reversed(self._paths(key))):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import threading
+import collections
+import flask
+
+
+# results of finished jobs never change, clients may keep them for a year without revalidation
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# unfinished jobs are polled and must never be served from a cache
+NO_STORE = 'no-store'
+DEFAULT_SEQUENCE_MAX_AGE = 3600
+
+
+def make_etag(*parts):
+    """
+    :param parts: the values which identify the content, e.g. a database fingerprint and an accession
+    :return: str, the strong entity tag without quotes
+    """
+
+    return hashlib.sha1('\t'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def job_etag(blast_id, job):
+    """
+    Derives the entity tag of a finished job from its run hash, jobs which were loaded from the job queue or store
+    are identified by the name of their result file, which is the run hash for cached searches
+    :param blast_id: str, the job ID
+    :param job: Job, the finished job
+    :return: str, the strong entity tag without quotes
+    """
+
+    run = getattr(job, 'run_hash', None)
+    if run is None and job.stdout_file is not None:
+        run = os.path.splitext(os.path.basename(job.stdout_file))[0]
+    return make_etag('job', run if run is not None else blast_id, job.error)
+
+
+def cache_headers(etag, cache_control, vary=None):
+    headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': cache_control}
+    if vary is not None:
+        headers['Vary'] = vary
+    return headers
+
+
+def not_modified(etag, cache_control, vary=None):
+    """
+    Answers a conditional request without producing the content
+    :param etag: str, the entity tag of the current content
+    :param cache_control: str, the Cache-Control header
+    :param vary: str, the Vary header
+    :return: flask.Response with status 304 if If-None-Match matches etag, None otherwise
+    """
+
+    if flask.request.method not in ('GET', 'HEAD'):
+        return None
+    # If-None-Match uses the weak comparison, see RFC 7232 section 3.2
+    if not flask.request.if_none_match.contains_weak(etag):
+        return None
+    return flask.Response(status=304, headers=cache_headers(etag, cache_control, vary))
+
+
+class Memo:
+    """
+    Thread-safe LRU mapping for results which are derived from immutable content, keyed by its entity tag
+    """
+
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,253 @@
+import os
+import mmap
+import zlib
+import uuid
+import struct
+import bisect
+from PrimerDesigner.tools import tools
+
+
+# BGZF blocks are gzip members with a 'BC' extra field holding the block size
+_BGZF_HEADER = struct.Struct('<4BI2BH')
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+_BGZF_BLOCK_SIZE = 0xff00
+
+
+def is_bgzf(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[0:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def write_bgzf(fasta, filename, level=6, block_size=_BGZF_BLOCK_SIZE):
+    """
+    Compresses a file with bgzip block compression
+    :param fasta: str, the uncompressed file
+    :param filename: str, the compressed file
+    :param level: int, the compression level
+    :param block_size: int, the uncompressed size of each block
+    :return: str, the compressed file
+    """
+
+    filename_tmp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    with open(fasta, 'rb') as f_in, open(filename_tmp, 'wb') as f_out:
+        for data in iter(lambda: f_in.read(block_size), b''):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            cdata = compressor.compress(data) + compressor.flush()
+            f_out.write(_BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6))
+            f_out.write(struct.pack('<2BHH', 66, 67, 2, len(cdata) + 25))
+            f_out.write(cdata)
+            f_out.write(struct.pack('<II', zlib.crc32(data), len(data)))
+        f_out.write(_BGZF_EOF)
+    os.replace(filename_tmp, filename)
+    return filename
+
+
+def _bgzf_blocks(mm, pos=0):
+    """
+    Iterates over the blocks of a BGZF file
+    :param mm: mmap or bytes, the compressed file
+    :param pos: int, the offset of the first block
+    :return: generator of tuples (block offset, start of the deflate data, end of the deflate data, uncompressed size)
+    """
+
+    while pos < len(mm):
+        if mm[pos:pos + 4] != b'\x1f\x8b\x08\x04':
+            raise ValueError('invalid BGZF block at offset {}'.format(pos))
+        xlen = struct.unpack_from('<H', mm, pos + 10)[0]
+        extra = pos + 12
+        block_size = None
+        while extra < pos + 12 + xlen:
+            si1, si2, slen = struct.unpack_from('<2BH', mm, extra)
+            if si1 == 66 and si2 == 67:
+                block_size = struct.unpack_from('<H', mm, extra + 4)[0] + 1
+            extra += 4 + slen
+        if block_size is None:
+            raise ValueError('missing BGZF block size at offset {}'.format(pos))
+        isize = struct.unpack_from('<I', mm, pos + block_size - 4)[0]
+        yield pos, pos + 12 + xlen, pos + block_size - 8, isize
+        pos += block_size
+
+
+def build_gzi(filename, index=None):
+    """
+    Writes a bgzip index (.gzi) which maps uncompressed to compressed offsets, the format is the one of bgzip -i
+    :param filename: str, the bgzip compressed file
+    :param index: str, the index file, filename.gzi if None
+    :return: list of tuples (compressed offset, uncompressed offset), including the first block
+    """
+
+    if index is None:
+        index = filename + '.gzi'
+    offsets = []
+    uncompressed = 0
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos, _, _, isize in _bgzf_blocks(mm):
+                offsets.append((pos, uncompressed))
+                uncompressed += isize
+    index_tmp = '{}.{}.tmp'.format(index, uuid.uuid4().hex)
+    with open(index_tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(offsets) - 1))
+        for pair in offsets[1:]:
+            f.write(struct.pack('<QQ', *pair))
+    os.replace(index_tmp, index)
+    return offsets
+
+
+def read_gzi(index):
+    with open(index, 'rb') as f:
+        data = f.read()
+    count = struct.unpack_from('<Q', data, 0)[0]
+    values = struct.unpack_from('<{}Q'.format(2 * count), data, 8)
+    return [(0, 0)] + list(zip(values[0::2], values[1::2]))
+
+
+def build_fai(filename, index=None):
+    """
+    Writes a FASTA index (.fai) in the format of samtools faidx, offsets refer to the uncompressed data
+    :param filename: str, the FASTA file, may be gzip or bgzip compressed
+    :param index: str, the index file, filename.fai if None
+    :return: dict, name: (length, offset, line bases, line width)
+    """
+
+    if index is None:
+        index = filename + '.fai'
+    records = {}
+    order = []
+    offset = 0
+    name = None
+    length = line_bases = line_width = 0
+    seq_offset = 0
+    last_line = False
+
+    def add():
+        if name in records:
+            raise ValueError('duplicate sequence name in {}: {}'.format(filename, name))
+        records[name] = (length, seq_offset, line_bases, line_width)
+        order.append(name)
+
+    with tools.open_fasta(filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    add()
+                name = line[1:].split()[0].decode('utf-8') if len(line.strip()) > 1 else ''
+                length = line_bases = line_width = 0
+                seq_offset = offset + len(line)
+                last_line = False
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases == 0 and line_bases > 0:
+                    last_line = True
+                elif bases > 0:
+                    if last_line or (line_bases > 0 and bases > line_bases):
+                        raise ValueError('different line lengths in record {} of {}'.format(name, filename))
+                    if line_bases == 0:
+                        line_bases = bases
+                        line_width = len(line)
+                    elif bases < line_bases or len(line) != line_width:
+                        last_line = True
+                    length += bases
+            offset += len(line)
+    if name is not None:
+        add()
+    # readers opening the same file concurrently build the index into their own temporary file
+    index_tmp = '{}.{}.tmp'.format(index, uuid.uuid4().hex)
+    with open(index_tmp, 'w') as f:
+        for name in order:
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, *records[name]))
+    os.replace(index_tmp, index)
+    return records
+
+
+def read_fai(index):
+    records = {}
+    with open(index, 'r') as f:
+        for line in f:
+            cells = line.rstrip('\n').split('\t')
+            records[cells[0]] = tuple(int(c) for c in cells[1:5])
+    return records
+
+
+def _is_stale(filename, index):
+    return not os.path.isfile(index) or os.path.getmtime(index) < os.path.getmtime(filename)
+
+
+class IndexedFasta:
+    """
+    Random access to the records of a plain or bgzip compressed FASTA file, only the blocks which contain the
+    requested region are decompressed. The .fai and .gzi indices are built on first use.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.compressed = tools.is_gzip(filename)
+        if self.compressed and not is_bgzf(filename):
+            raise ValueError('random access requires bgzip compression, {} is plain gzip'.format(filename))
+        index = filename + '.fai'
+        self.records = build_fai(filename) if _is_stale(filename, index) else read_fai(index)
+        if self.compressed:
+            index = filename + '.gzi'
+            blocks = build_gzi(filename) if _is_stale(filename, index) else read_gzi(index)
+            self._compressed_offsets = [b[0] for b in blocks]
+            self._uncompressed_offsets = [b[1] for b in blocks]
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def names(self):
+        return list(self.records)
+
+    def length(self, name):
+        return self.records[name][0]
+
+    def _read(self, offset, size):
+        if not self.compressed:
+            return self._mm[offset:offset + size]
+        i = bisect.bisect_right(self._uncompressed_offsets, offset) - 1
+        skip = offset - self._uncompressed_offsets[i]
+        data = []
+        remaining = size + skip
+        for _, start, end, isize in _bgzf_blocks(self._mm, self._compressed_offsets[i]):
+            if remaining <= 0 or isize == 0:
+                break
+            data.append(zlib.decompress(self._mm[start:end], -zlib.MAX_WBITS))
+            remaining -= isize
+        return b''.join(data)[skip:skip + size]
+
+    def fetch(self, name, start=None, end=None):
+        """
+        Returns a record or a part of it
+        :param name: str, the name of the record, i.e. the first word of the header
+        :param start: int, 1-based start, from the beginning if None
+        :param end: int, 1-based inclusive end, until the end if None
+        :return: str, the sequence
+        """
+
+        if name not in self.records:
+            raise KeyError('{} not found in {}'.format(name, self.filename))
+        length, offset, line_bases, line_width = self.records[name]
+        start = 0 if start is None else max(start - 1, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        first = offset + start // line_bases * line_width + start % line_bases
+        last = offset + (end - 1) // line_bases * line_width + (end - 1) % line_bases
+        data = self._read(first, last - first + 1)
+        return data.decode('utf-8').replace('\n', '').replace('\r', '')
@@ -1,6 +1,6 @@
 import sys
 import os
-import io
+from PrimerDesigner.tools import tools
 
 
 class Amplicon:
@@ -45,7 +45,7 @@ class IsPcrParser:
 
     def parse(self, filename):
         if os.path.exists(filename):
-            f = open(filename, 'r')
+            f = tools.open_fasta(filename)
         else:
             f = filename.splitlines()
         for line in f:
@@ -55,7 +55,7 @@ class IsPcrParser:
                 self.amplicons[-1].sequence += line.strip()
 
         self.number_of_amplicons = len(self.amplicons)
-        if isinstance(f, io.TextIOWrapper):
+        if not isinstance(f, list):
             f.close()
 
 
@@ -0,0 +1,163 @@
+import time
+import sqlite3
+import threading
+import collections
+from PrimerDesigner.Job import Job
+from PrimerDesigner import config
+from PrimerDesigner.tools import tools
+
+
+DEFAULT_LIMITS = {'job_registry_max_jobs': 1000,
+                  'job_registry_max_bytes': 256 * 2 ** 20,
+                  'job_registry_max_age': 24 * 3600}
+
+
+def job_size(job):
+    """
+    Returns the number of bytes a job holds in memory, output spooled to disk is not counted
+    :param job: Job
+    :return: int
+    """
+
+    stdout = job.__dict__.get('_stdout') or ''
+    return len(stdout) + len(job.stderr or '')
+
+
+class JobRegistry:
+    """
+    Keeps recent and running jobs in memory. Finished jobs are moved to the job_store table of the result database
+    once the registry holds more than max_jobs jobs or max_bytes bytes or when they are older than max_age seconds.
+    Evicted jobs are loaded from the store when they are requested again.
+    """
+
+    def __init__(self, result_db='blast_jobs.db', max_jobs=None, max_bytes=None, max_age=None):
+        self.result_db = result_db
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._jobs = collections.OrderedDict()
+        self._created = {}
+        self._lock = threading.Lock()
+
+    def _limits(self):
+        # limits which are not passed explicitly are read from blast.conf on every eviction
+        settings = config.get_settings().config
+        limits = []
+        for key, value in (('job_registry_max_jobs', self.max_jobs), ('job_registry_max_bytes', self.max_bytes),
+                           ('job_registry_max_age', self.max_age)):
+            limits.append(value if value is not None else settings.get(key, DEFAULT_LIMITS[key]))
+        return limits
+
+    def __setitem__(self, job_id, job):
+        with self._lock:
+            self._jobs[job_id] = job
+            self._jobs.move_to_end(job_id)
+            self._created[job_id] = time.time()
+        self.evict()
+
+    def __getitem__(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._jobs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def values(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get(self, job_id, default=None):
+        """
+        Returns a job from memory or from the store
+        :param job_id: str, the job ID
+        :param default: returned if the job is unknown
+        :return: Job
+        """
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self.load(job_id)
+        return job if job is not None else default
+
+    def evict(self):
+        """
+        Moves finished jobs to the store, oldest first, until the registry is within its limits
+        :return: int, the number of evicted jobs
+        """
+
+        max_jobs, max_bytes, max_age = self._limits()
+        now = time.time()
+        evicted = []
+        with self._lock:
+            size = sum(job_size(job) for job in self._jobs.values())
+            count = len(self._jobs)
+            for job_id, job in self._jobs.items():
+                if count <= max_jobs and size <= max_bytes and now - self._created[job_id] <= max_age:
+                    # jobs are ordered by registration, all remaining jobs are younger
+                    break
+                if not job.finished:
+                    continue
+                evicted.append((job_id, job))
+                count -= 1
+                size -= job_size(job)
+            if len(evicted) == 0:
+                return 0
+            self.store(evicted)
+            for job_id, _ in evicted:
+                del self._jobs[job_id]
+                del self._created[job_id]
+        return len(evicted)
+
+    def store(self, jobs):
+        """
+        Writes jobs to the job_store table
+        :param jobs: list of tuples (job ID, Job)
+        :return: None
+        """
+
+        conn = sqlite3.connect(self.result_db, timeout=30)
+        try:
+            tools.create_empty_database(conn)
+            conn.executemany('INSERT OR REPLACE INTO job_store VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(job_id, job.status, int(bool(job.error)), int(bool(job.finished)), job.stdout_file,
+                               job.__dict__.get('_stdout') if job.stdout_file is None else None,
+                               job.stderr, job.cancel_reason, time.time()) for job_id, job in jobs])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def load(self, job_id):
+        """
+        Loads a job from the job_store table
+        :param job_id: str, the job ID
+        :return: Job or None
+        """
+
+        conn = sqlite3.connect(self.result_db, timeout=30)
+        try:
+            row = conn.execute('SELECT status, error, finished, stdout_file, stdout, stderr, cancel_reason '
+                               'FROM job_store WHERE id = ?', (job_id,)).fetchone()
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                return None
+            raise e
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = Job(status=row[0], error=bool(row[1]), finished=bool(row[2]))
+        if row[3] is not None:
+            job.stdout_file = row[3]
+        else:
+            job.stdout = row[4] or ''
+        job.stderr = row[5] or ''
+        job.cancel_reason = row[6]
+        return job
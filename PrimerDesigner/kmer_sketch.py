@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import math
+import random
+import argparse
+from PrimerDesigner.tools import tools
+from PrimerDesigner.hitset_cache import database_fingerprint
+
+
+HEADER_SIZE = 4096
+MAGIC = 'PrimerDesigner count-min sketch 1'
+# long sequences are counted in windows, this bounds the memory of the k-mer arrays
+WINDOW = 2 ** 22
+_MASK = 2 ** 64 - 1
+_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'a': 0, 'c': 1, 'g': 2, 't': 3}
+
+
+def sketch_filename(blast_db, k):
+    return '{}.k{}.cms'.format(blast_db, k)
+
+
+def hash_parameters(depth, seed):
+    rng = random.Random(seed)
+    return [(rng.getrandbits(64) | 1, rng.getrandbits(64)) for _ in range(depth)]
+
+
+def encode(kmer):
+    """
+    Encodes the canonical form of a k-mer, i.e. the smaller of the k-mer and its reverse complement
+    :param kmer: str, the k-mer
+    :return: int or None if the k-mer contains other bases than ACGT
+    """
+
+    forward = 0
+    reverse = 0
+    for i, base in enumerate(kmer):
+        code = _CODES.get(base)
+        if code is None:
+            return None
+        forward = (forward << 2) | code
+        reverse |= (3 - code) << (2 * i)
+    return min(forward, reverse)
+
+
+def canonical_kmers(seq, k):
+    """
+    Encodes the canonical k-mers of a sequence, k-mers with other bases than ACGT are skipped
+    :param seq: str, the sequence
+    :param k: int, the k-mer length, at most 31
+    :return: numpy.ndarray of uint64
+    """
+
+    import numpy as np
+    table = np.full(256, 4, dtype=np.uint8)
+    for base, code in _CODES.items():
+        table[ord(base)] = code
+    codes = table[np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n < 1:
+        return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for i in range(k):
+        forward |= codes[i:i + n] << np.uint64(2 * (k - 1 - i))
+        reverse |= (np.uint64(3) - codes[i:i + n]) << np.uint64(2 * i)
+    return np.minimum(forward, reverse)[valid]
+
+
+def _add(counters, kmers, hashes, shift):
+    import numpy as np
+    with np.errstate(over='ignore'):
+        for row, (a, b) in enumerate(hashes):
+            columns = (kmers * np.uint64(a) + np.uint64(b)) >> np.uint64(shift)
+            counts = np.bincount(columns.astype(np.int64), minlength=counters.shape[1])
+            # counters saturate instead of overflowing
+            counters[row] = np.minimum(counters[row].astype(np.uint64) + counts.astype(np.uint64), 2 ** 32 - 1)
+
+
+def build(sequences, filename, k=12, width=2 ** 22, depth=4, seed=42, fingerprint=None, chunk_size=2 ** 22):
+    """
+    Counts the canonical k-mers of sequences in a count-min sketch in one streaming pass and writes it to a file
+    which is memory-mapped by CountMinSketch
+    :param sequences: iterable of str, the sequences
+    :param filename: str, the output file
+    :param k: int, the k-mer length, at most 31
+    :param width: int, the counters per row, a power of two
+    :param depth: int, the number of rows, more rows reduce overestimated counts
+    :param seed: int, the seed of the hash functions
+    :param fingerprint: str, the fingerprint of the database, used to detect stale sketches
+    :param chunk_size: int, the k-mers which are counted at once
+    :return: CountMinSketch
+    """
+
+    import numpy as np
+    if not 0 < k <= 31:
+        raise ValueError('k needs to be between 1 and 31')
+    if width < 2 or width & (width - 1) != 0:
+        raise ValueError('width needs to be a power of two')
+    hashes = hash_parameters(depth, seed)
+    shift = 64 - int(math.log2(width))
+    filename_tmp = filename + '.tmp'
+    with open(filename_tmp, 'wb') as f:
+        f.truncate(HEADER_SIZE + depth * width * 4)
+    counters = np.memmap(filename_tmp, dtype=np.uint32, mode='r+', offset=HEADER_SIZE, shape=(depth, width))
+    total = 0
+    buffered = []
+    buffered_size = 0
+    for seq in sequences:
+        for start in range(0, max(len(seq) - k + 1, 1), WINDOW):
+            kmers = canonical_kmers(seq[start:start + WINDOW + k - 1], k)
+            buffered.append(kmers)
+            buffered_size += len(kmers)
+            if buffered_size >= chunk_size:
+                _add(counters, np.concatenate(buffered), hashes, shift)
+                total += buffered_size
+                buffered = []
+                buffered_size = 0
+    if buffered_size > 0:
+        _add(counters, np.concatenate(buffered), hashes, shift)
+        total += buffered_size
+    counters.flush()
+    del counters
+    header = json.dumps({'magic': MAGIC, 'k': k, 'width': width, 'depth': depth, 'seed': seed, 'total': total,
+                         'fingerprint': fingerprint}).encode('utf-8')
+    if len(header) >= HEADER_SIZE:
+        raise ValueError('header of the sketch is too long')
+    with open(filename_tmp, 'r+b') as f:
+        f.write(header.ljust(HEADER_SIZE, b' '))
+    os.replace(filename_tmp, filename)
+    return CountMinSketch(filename)
+
+
+def load(blast_db, k=12):
+    """
+    Opens the sketch of a database if it exists and the database was not rebuilt since
+    :param blast_db: str, the database as passed to blastn -db
+    :param k: int, the k-mer length
+    :return: CountMinSketch or None
+    """
+
+    filename = sketch_filename(blast_db, k)
+    if not os.path.isfile(filename):
+        return None
+    sketch = CountMinSketch(filename)
+    if sketch.fingerprint != database_fingerprint(blast_db):
+        print('k-mer sketch {} is stale, rebuild it with build_kmer_sketch'.format(filename), file=sys.stderr)
+        return None
+    return sketch
+
+
+class CountMinSketch:
+    """
+    Memory-mapped count-min sketch of k-mer frequencies, counts are never underestimated
+    """
+
+    def __init__(self, filename):
+        import numpy as np
+        with open(filename, 'rb') as f:
+            header = json.loads(f.read(HEADER_SIZE).decode('utf-8'))
+        if header.get('magic') != MAGIC:
+            raise ValueError('not a k-mer sketch: {}'.format(filename))
+        self.filename = filename
+        self.k = header['k']
+        self.width = header['width']
+        self.depth = header['depth']
+        self.total = header['total']
+        self.fingerprint = header['fingerprint']
+        self._hashes = hash_parameters(self.depth, header['seed'])
+        self._shift = 64 - int(math.log2(self.width))
+        self._counters = np.memmap(filename, dtype=np.uint32, mode='r', offset=HEADER_SIZE,
+                                   shape=(self.depth, self.width))
+
+    def count(self, kmer):
+        """
+        Estimates how often a k-mer or its reverse complement occurs
+        :param kmer: str, a sequence of length k
+        :return: int, 0 for k-mers with other bases than ACGT
+        """
+
+        code = encode(kmer)
+        if code is None:
+            return 0
+        return min(int(self._counters[row, ((a * code + b) & _MASK) >> self._shift])
+                   for row, (a, b) in enumerate(self._hashes))
+
+    def expected_count(self):
+        # the average count of a canonical k-mer in random sequences
+        return self.total / (4 ** self.k / 2)
+
+    def max_count(self, factor=10.0):
+        return factor * max(self.expected_count(), 1.0)
+
+    def three_prime_count(self, primer):
+        """
+        :param primer: str, a primer sequence in 5' to 3' direction
+        :return: int, the estimated frequency of the k-mer at the 3' end
+        """
+
+        return self.count(primer[-self.k:])
+
+    def accepts(self, primer_pair, max_count):
+        """
+        Checks whether the 3' ends of both primers are rare enough in the background
+        :param primer_pair: PrimerPair, the primers
+        :param max_count: float, the highest accepted frequency, see max_count
+        :return: bool
+        """
+
+        return (self.three_prime_count(primer_pair.forward.seq) <= max_count and
+                self.three_prime_count(primer_pair.reverse.seq) <= max_count)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Builds the k-mer frequency sketch used to prefilter primer 3' ends")
+    parser.add_argument('fasta', type=str, help='the FASTA file of the database, may be gzip compressed')
+    parser.add_argument('--output', type=str, default=None, help='the sketch, next to the FASTA file if not given')
+    parser.add_argument('--k', type=int, default=12, help="length of the 3' end k-mers")
+    parser.add_argument('--width', type=int, default=2 ** 22, help='counters per row, a power of two')
+    parser.add_argument('--depth', type=int, default=4, help='number of rows')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    output = args.output if args.output is not None else sketch_filename(args.fasta, args.k)
+    sketch = build((seq for _, seq in tools.iter_fasta(args.fasta)), output, k=args.k, width=args.width,
+                   depth=args.depth, fingerprint=database_fingerprint(args.fasta))
+    print('counted {} k-mers in {}'.format(sketch.total, output))
@@ -0,0 +1,390 @@
+import sys
+import os
+import json
+import math
+import time
+import random
+import signal
+import logging
+import shutil
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import concurrent.futures
+
+
+STUB_TOOLS = ('blastn', 'blastdbcmd', 'makeblastdb', 'gfServer', 'faToTwoBit')
+
+_STUB_TEMPLATE = '''#!{python}
+import sys
+sys.path.insert(0, {root!r})
+from PrimerDesigner import loadtest
+loadtest.stub_main({tool!r}, sys.argv[1:], latency={latency!r}, hits={hits!r}, sequence_length={sequence_length!r})
+'''
+
+
+def _parse_options(argv):
+    options = {}
+    positional = []
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('-') and argv[i] != '-':
+            options[argv[i].lstrip('-')] = argv[i + 1] if i + 1 < len(argv) else ''
+            i += 2
+        else:
+            positional.append(argv[i])
+            i += 1
+    return options, positional
+
+
+def _stub_sequence(accession, length):
+    rnd = random.Random(accession)
+    return ''.join(rnd.choice('ACGT') for _ in range(length))
+
+
+def _stub_blastn(options, hits, out):
+    query = options.get('query', '-')
+    if query == '-':
+        query = sys.stdin.read()
+    else:
+        with open(query, 'r') as f:
+            query = f.read()
+    query_def = query.split('\n', 1)[0].lstrip('>')
+    query_len = len(''.join(query.split('\n')[1:]))
+    fmt = options.get('outfmt', '5').split(' ')
+    if fmt[0] != '5':
+        fields = fmt[1:] or ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen', 'qstart', 'qend',
+                             'sstart', 'send', 'evalue', 'bitscore']
+        for record in query.split('>')[1:]:
+            header, seq = record.split('\n', 1)
+            length = len(seq.replace('\n', ''))
+            for h in range(hits):
+                values = {'qseqid': header.split(' ')[0], 'sseqid': 'STUB_{}'.format(h), 'sacc': 'STUB_{}'.format(h),
+                          'pident': 100.0, 'length': length, 'mismatch': 0, 'gapopen': 0, 'qstart': 1,
+                          'qend': length, 'sstart': 1, 'send': length, 'sstrand': 'plus',
+                          'evalue': '{:g}'.format(1e-50 * (h + 1)), 'bitscore': length}
+                out.write('\t'.join(str(values.get(field, '')) for field in fields) + '\n')
+        return
+    out.write('<?xml version="1.0"?>\n<BlastOutput>\n<BlastOutput_program>blastn</BlastOutput_program>\n'
+              '<BlastOutput_version>BLASTN 2.7.1+</BlastOutput_version>\n<BlastOutput_reference>stub'
+              '</BlastOutput_reference>\n<BlastOutput_db>{db}</BlastOutput_db>\n'
+              '<BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n<BlastOutput_query-def>{qdef}'
+              '</BlastOutput_query-def>\n<BlastOutput_query-len>{qlen}</BlastOutput_query-len>\n'
+              '<BlastOutput_param><Parameters><Parameters_expect>10</Parameters_expect>'
+              '<Parameters_sc-match>1</Parameters_sc-match><Parameters_sc-mismatch>-2</Parameters_sc-mismatch>'
+              '<Parameters_gap-open>0</Parameters_gap-open><Parameters_gap-extend>0</Parameters_gap-extend>'
+              '<Parameters_filter>L;m;</Parameters_filter></Parameters></BlastOutput_param>\n'
+              '<BlastOutput_iterations>\n<Iteration>\n<Iteration_iter-num>1</Iteration_iter-num>\n'
+              '<Iteration_query-ID>Query_1</Iteration_query-ID>\n<Iteration_query-def>{qdef}'
+              '</Iteration_query-def>\n<Iteration_query-len>{qlen}</Iteration_query-len>\n'
+              '<Iteration_hits>\n'.format(db=options.get('db', ''), qdef=query_def, qlen=query_len))
+    for h in range(hits):
+        out.write('<Hit><Hit_num>{n}</Hit_num><Hit_id>STUB_{h}</Hit_id><Hit_def>stub hit {h}</Hit_def>'
+                  '<Hit_accession>STUB_{h}</Hit_accession><Hit_len>{qlen}</Hit_len><Hit_hsps><Hsp>'
+                  '<Hsp_num>1</Hsp_num><Hsp_bit-score>{qlen}</Hsp_bit-score><Hsp_score>{qlen}</Hsp_score>'
+                  '<Hsp_evalue>{evalue:g}</Hsp_evalue><Hsp_query-from>1</Hsp_query-from>'
+                  '<Hsp_query-to>{qlen}</Hsp_query-to><Hsp_hit-from>1</Hsp_hit-from><Hsp_hit-to>{qlen}</Hsp_hit-to>'
+                  '<Hsp_query-frame>1</Hsp_query-frame><Hsp_hit-frame>1</Hsp_hit-frame>'
+                  '<Hsp_identity>{qlen}</Hsp_identity><Hsp_positive>{qlen}</Hsp_positive><Hsp_gaps>0</Hsp_gaps>'
+                  '<Hsp_align-len>{qlen}</Hsp_align-len><Hsp_qseq>N</Hsp_qseq><Hsp_hseq>N</Hsp_hseq>'
+                  '<Hsp_midline>|</Hsp_midline></Hsp></Hit_hsps></Hit>\n'.format(n=h + 1, h=h, qlen=query_len,
+                                                                                 evalue=1e-50 * (h + 1)))
+    out.write('</Iteration_hits>\n<Iteration_stat><Statistics><Statistics_db-num>{hits}</Statistics_db-num>'
+              '<Statistics_db-len>{length}</Statistics_db-len><Statistics_hsp-len>0</Statistics_hsp-len>'
+              '<Statistics_eff-space>0</Statistics_eff-space><Statistics_kappa>0.41</Statistics_kappa>'
+              '<Statistics_lambda>0.625</Statistics_lambda><Statistics_entropy>0.78</Statistics_entropy>'
+              '</Statistics></Iteration_stat>\n</Iteration>\n</BlastOutput_iterations>\n</BlastOutput>\n'.format(
+                  hits=hits, length=hits * query_len))
+
+
+def _stub_blastdbcmd(options, sequence_length, out):
+    if 'entry_batch' in options:
+        if options['entry_batch'] == '-':
+            entries = sys.stdin.read().splitlines()
+        else:
+            with open(options['entry_batch'], 'r') as f:
+                entries = f.read().splitlines()
+    else:
+        entries = options.get('entry', '').split(',')
+    for entry in entries:
+        cells = entry.split()
+        if len(cells) == 0:
+            continue
+        seq = _stub_sequence(cells[0], sequence_length)
+        rng = cells[1] if len(cells) > 1 else options.get('range')
+        if rng:
+            start, end = rng.split('-')
+            seq = seq[int(start) - 1:int(end)]
+        out.write('>{} stub sequence\n'.format(cells[0]))
+        for i in range(0, len(seq), 80):
+            out.write(seq[i:i + 80] + '\n')
+
+
+def _stub_gfserver(positional, latency, out):
+    command = positional[0] if positional else ''
+    pid_file = os.path.join(tempfile.gettempdir(), 'stub_gfserver_{}.pid'.format(positional[2] if len(positional) > 2
+                                                                                   else ''))
+    if command == 'start':
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        while True:
+            time.sleep(3600)
+    elif command == 'stop':
+        try:
+            with open(pid_file, 'r') as f:
+                os.kill(int(f.read()), signal.SIGTERM)
+            os.remove(pid_file)
+        except (FileNotFoundError, ProcessLookupError, ValueError):
+            pass
+    elif command == 'pcr':
+        time.sleep(latency)
+        out.write('>STUB_0:1+500 stub 500bp {} {}\n'.format(positional[3], positional[4]))
+
+
+def stub_main(tool, argv, latency=0.0, hits=10, sequence_length=1000):
+    """
+    Imitates the command line interface of a bioinformatics tool with a fixed latency and deterministic output
+    :param tool: str, one of STUB_TOOLS
+    :param argv: list, the command line arguments
+    :param latency: float, seconds to sleep before answering
+    :param hits: int, number of hits reported by blastn
+    :param sequence_length: int, length of the sequences returned by blastdbcmd
+    :return: None
+    """
+
+    options, positional = _parse_options(argv)
+    out = open(options['out'], 'w') if 'out' in options and tool == 'blastdbcmd' else sys.stdout
+    if tool == 'blastn':
+        time.sleep(latency)
+        _stub_blastn(options, hits, out)
+    elif tool == 'blastdbcmd':
+        time.sleep(latency)
+        _stub_blastdbcmd(options, sequence_length, out)
+    elif tool == 'makeblastdb':
+        for extension in ('.nhr', '.nin', '.nsq'):
+            open(options.get('out', options.get('in', 'stub')) + extension, 'w').close()
+    elif tool == 'gfServer':
+        _stub_gfserver(positional, latency, out)
+    elif tool == 'faToTwoBit':
+        from PrimerDesigner import twobit
+        twobit.write_2bit(positional[0], positional[1])
+    else:
+        raise ValueError('unknown stub: {}'.format(tool))
+    out.flush()
+
+
+def install_stubs(directory, latency=0.0, hits=10, sequence_length=1000):
+    """
+    Writes stub executables and a blast.conf which points to them
+    :param directory: str, the working directory of the load test, stubs are written to directory/bin
+    :return: str, the configuration file
+    """
+
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    os.makedirs(os.path.join(directory, 'db'), exist_ok=True)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for tool in STUB_TOOLS:
+        filename = os.path.join(bin_dir, tool)
+        with open(filename, 'w') as f:
+            f.write(_STUB_TEMPLATE.format(python=sys.executable, root=root, tool=tool, latency=latency, hits=hits,
+                                          sequence_length=sequence_length))
+        os.chmod(filename, 0o755)
+    conf_file = os.path.join(directory, 'blast.conf')
+    with open(conf_file, 'w') as f:
+        f.write('blast: {}\n'.format(os.path.join(bin_dir, 'blastn')))
+        f.write('blast_dir: {}\n'.format(os.path.join(directory, 'db', '')))
+        f.write('gfserver: {}\n'.format(os.path.join(bin_dir, 'gfServer')))
+    return conf_file
+
+
+def _request(url, method='GET', data=None):
+    body = None
+    headers = {}
+    if data is not None:
+        body = json.dumps(data).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    request = urllib.request.Request(url, data=body, method=method, headers=headers)
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return response.read()
+
+
+def _random_query():
+    from PrimerDesigner.tools import tools
+    return '>query\n{}'.format(tools.random_sequence(500))
+
+
+def _scenario_blast_submit(base_url):
+    _request(base_url + '/blast/', 'POST', {'sequence': _random_query()})
+
+
+def _scenario_blast_roundtrip(base_url, poll_interval=0.01):
+    job_id = json.loads(_request(base_url + '/blast/', 'POST', {'sequence': _random_query()}))
+    while True:
+        try:
+            return _request(base_url + '/blast/hits/{}'.format(job_id))
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+        time.sleep(poll_interval)
+
+
+def _scenario_blast_primers(base_url):
+    from PrimerDesigner.tools import tools
+    _request(base_url + '/blast_primers/', 'POST', {'forward': tools.random_sequence(20),
+                                                     'reverse': tools.random_sequence(20)})
+
+
+def _scenario_nucleotide(base_url):
+    _request(base_url + '/nucleotide/STUB_{}'.format(random.randint(0, 10 ** 6)))
+
+
+def _scenario_nucleotide_batch(base_url, size=20):
+    _request(base_url + '/nucleotide/', 'POST', {'accession': ['STUB_{}'.format(i) for i in range(size)],
+                                                 'format': 'json'})
+
+
+def _scenario_design(base_url):
+    from PrimerDesigner.tools import tools
+    _request(base_url + '/design/', 'POST', {'sequence': '>target\n{}'.format(tools.random_sequence(1500)),
+                                             'number_of_pairs': 1})
+
+
+SCENARIOS = {'blast_submit': _scenario_blast_submit,
+             'blast_roundtrip': _scenario_blast_roundtrip,
+             'blast_primers': _scenario_blast_primers,
+             'nucleotide': _scenario_nucleotide,
+             'nucleotide_batch': _scenario_nucleotide_batch,
+             'design': _scenario_design}
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+    :param values: list, sorted values
+    :param p: float, the percentile between 0 and 100
+    :return: float
+    """
+
+    if len(values) == 0:
+        return float('nan')
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def measure(scenario, base_url, concurrency, requests):
+    """
+    Runs a scenario with a fixed number of concurrent clients
+    :return: dict with requests, errors, rps and the p50, p95 and p99 latency in seconds
+    """
+
+    def timed():
+        t0 = time.perf_counter()
+        try:
+            SCENARIOS[scenario](base_url)
+            error = False
+        except (urllib.error.URLError, OSError, ValueError):
+            error = True
+        return time.perf_counter() - t0, error
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda _: timed(), range(requests)))
+    elapsed = time.perf_counter() - t0
+    latencies = sorted(r[0] for r in results if not r[1])
+    return {'endpoint': scenario,
+            'concurrency': concurrency,
+            'requests': requests,
+            'errors': sum(1 for r in results if r[1]),
+            'rps': len(latencies) / elapsed if elapsed > 0 else float('nan'),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)}
+
+
+def run_load_test(scenarios=('blast_submit', 'blast_roundtrip', 'nucleotide', 'nucleotide_batch'),
+                  concurrency=(1, 2, 4, 8), requests=50, latency=0.05, hits=10, sequence_length=1000,
+                  directory=None):
+    """
+    Starts the REST server against stub executables and sweeps the concurrency for each scenario
+    :param scenarios: iterable, names from SCENARIOS
+    :param concurrency: iterable of int, the numbers of concurrent clients
+    :param requests: int, requests per scenario and concurrency level
+    :param latency: float, the latency of each stub call in seconds
+    :param hits: int, the number of hits reported by the blastn stub
+    :param sequence_length: int, the length of the sequences returned by the blastdbcmd stub
+    :param directory: str, the working directory, a temporary directory if None
+    :return: list of dict, one result per scenario and concurrency level
+    """
+
+    from werkzeug.serving import make_server
+    from PrimerDesigner import config
+    from PrimerDesigner import ServerPrimerDesigner
+    from PrimerDesigner.tools import tools
+
+    remove_directory = directory is None
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='primer_designer_load_')
+    cwd = os.getcwd()
+    server = None
+    try:
+        install_stubs(directory, latency=latency, hits=hits, sequence_length=sequence_length)
+        # the server reads blast.conf from its working directory
+        os.chdir(directory)
+        config.reload_settings()
+        tools.create_empty_database()
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, ServerPrimerDesigner.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+        results = []
+        for scenario in scenarios:
+            for level in concurrency:
+                results.append(measure(scenario, base_url, level, requests))
+        return results
+    finally:
+        if server is not None:
+            server.shutdown()
+        os.chdir(cwd)
+        config.reload_settings()
+        if remove_directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_report(results):
+    lines = ['{:<18}{:>6}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('endpoint', 'conc', 'requests', 'errors', 'rps',
+                                                                   'p50 ms', 'p95 ms', 'p99 ms')]
+    for r in results:
+        lines.append('{:<18}{:>6}{:>9}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            r['endpoint'], r['concurrency'], r['requests'], r['errors'], r['rps'],
+            r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+    return '\n'.join(lines)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Load test of the PrimerDesigner REST server with stub executables')
+    parser.add_argument('--scenarios', type=str, default='blast_submit,blast_roundtrip,nucleotide,nucleotide_batch',
+                        help='comma separated scenarios, available: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--concurrency', type=str, default='1,2,4,8', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario and concurrency level')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of each stub call in seconds')
+    parser.add_argument('--hits', type=int, default=10, help='number of hits reported by the blastn stub')
+    parser.add_argument('--sequence_length', type=int, default=1000, help='length of the blastdbcmd stub sequences')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    results = run_load_test(scenarios=args.scenarios.split(','),
+                            concurrency=[int(c) for c in args.concurrency.split(',')],
+                            requests=args.requests,
+                            latency=args.latency,
+                            hits=args.hits,
+                            sequence_length=args.sequence_length)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_report(results))
@@ -0,0 +1,88 @@
+import os
+import glob
+import json
+import time
+import uuid
+import subprocess
+from PrimerDesigner.hitset_cache import database_fingerprint
+
+
+# megablast indexes need word sizes of at least 16, blastn uses 28 by default
+MIN_WORD_SIZE = 16
+
+
+def marker_filename(blast_db):
+    return blast_db + '.mbindex.json'
+
+
+def index_files(blast_db):
+    return sorted(glob.glob(glob.escape(blast_db) + '.*.idx'))
+
+
+def index_status(blast_db):
+    """
+    Checks whether the megablast index of a database can be used
+    :param blast_db: str, the database as passed to blastn -db
+    :return: str, 'missing', 'stale' if the database was rebuilt after the index, or 'current'
+    """
+
+    if not os.path.isfile(marker_filename(blast_db)) or len(index_files(blast_db)) == 0:
+        return 'missing'
+    with open(marker_filename(blast_db), 'r') as f:
+        marker = json.load(f)
+    if marker.get('fingerprint') != database_fingerprint(blast_db):
+        return 'stale'
+    return 'current'
+
+
+def remove_index(blast_db):
+    for filename in index_files(blast_db) + [marker_filename(blast_db)]:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def build_index(blast_executable, blast_db):
+    """
+    Builds a megablast index next to the database with makembindex, an existing index is replaced
+    :param blast_executable: str, the blastn executable, makembindex is expected in the same directory
+    :param blast_db: str, the database as passed to blastn -db
+    :return: list, the index files
+    """
+
+    remove_index(blast_db)
+    # the fingerprint is taken before the index is built, a database rebuilt in the meantime is detected as stale
+    fingerprint = database_fingerprint(blast_db)
+    t0 = time.time()
+    call = [blast_executable.replace('blastn', 'makembindex'),
+            '-input', blast_db,
+            '-iformat', 'blastdb',
+            '-output', blast_db,
+            '-old_style_index', 'false']
+    proc = subprocess.run(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        remove_index(blast_db)
+        raise RuntimeError('failed to build megablast index for {}. Error: {}'.format(blast_db, proc.stderr))
+    files = index_files(blast_db)
+    marker_tmp = '{}.{}.tmp'.format(marker_filename(blast_db), uuid.uuid4().hex)
+    with open(marker_tmp, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'created': time.time(), 'seconds': time.time() - t0,
+                   'files': [os.path.basename(filename) for filename in files]}, f)
+    os.replace(marker_tmp, marker_filename(blast_db))
+    return files
+
+
+def is_eligible(parameters):
+    """
+    Checks whether a search can use a megablast index, i.e. it runs with the megablast task and a large word size
+    :param parameters: dict, the cleaned BLAST parameters
+    :return: bool
+    """
+
+    if parameters.get('use_index') is not None or parameters.get('task', 'megablast') != 'megablast':
+        return False
+    try:
+        return int(parameters.get('word_size', 28)) >= MIN_WORD_SIZE
+    except ValueError:
+        return False
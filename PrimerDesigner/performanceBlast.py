@@ -1,6 +1,10 @@
+import os
+import sys
 import time
 import random
-from FlaskJob import BlastJob
+import argparse
+from PrimerDesigner.Job import BlastJob
+from PrimerDesigner import megablast_index
 
 
 seqs = ('''>reverse_13
@@ -35,32 +39,115 @@ AACTTGCGTTGATTACGTCCCTGCCTTTTGTACACACCGCCCGTCGCTACTACCGATTGA
 ATGGTTTAGCAAGGTCTTCGGATTGGCGCCTGAGTGGTTCTCCACTCTCGGTGATCGAGA
 AGATGATCAAACTTGATCATTTAGAGGAAGTAAAAGTCGTAACAAGG''')
 
-times = {}
-for s, seq in enumerate(seqs):
-    times[s] = {}
-    for c in range(1, 11):
-        times[s][c] = []
 
-for _ in range(10):
+def run_blast(job, seq, parameters=None):
+    parameters = dict(parameters or {}, sequence=seq)
+    t0 = time.time()
+    job.run(parameters=parameters, cache=False)
+    while not job.finished:
+        time.sleep(0.1)
+    if job.stderr != '':
+        raise RuntimeError('BLAST failed with error: {}'.format(job.stderr))
+    return time.time() - t0
+
+
+def benchmark_threads(database=None, repeats=10, max_threads=10, filename='blast_times.txt'):
+    """
+    Measures the run time of BLAST searches with different numbers of threads
+    :return: dict, sequence index: {threads: list of run times}
+    """
+
+    times = {}
     for s, seq in enumerate(seqs):
-        cores = [c for c in range(1, 11)]
-        while len(cores) > 0:
-            core = random.choice(cores)
-            cores.pop(cores.index(core))
-            print(core)
-            job = BlastJob()
-            parameters = {'sequence': seq, 'num_threads': core}
-            t0 = time.time()
-            job.run(parameters=parameters, cache=False)
-            while not job.finished:
-                time.sleep(0.1)
-            times[s][core].append(time.time() - t0)
-
-print(times)
-with open('blast_times.txt', 'w') as f:
-    for s in range(len(seqs)):
-        f.write(str(s) + '\n')
-        ks = list(times[s].keys())
-        ks.sort()
-        for k in ks:
-            f.write('  {}: {}\n'.format(k, times[s][k]))
\ No newline at end of file
+        times[s] = {}
+        for c in range(1, max_threads + 1):
+            times[s][c] = []
+
+    for _ in range(repeats):
+        for s, seq in enumerate(seqs):
+            cores = [c for c in range(1, max_threads + 1)]
+            while len(cores) > 0:
+                core = random.choice(cores)
+                cores.pop(cores.index(core))
+                print(core)
+                job = BlastJob(blast_db=database)
+                times[s][core].append(run_blast(job, seq, {'num_threads': core}))
+
+    print(times)
+    with open(filename, 'w') as f:
+        for s in range(len(seqs)):
+            f.write(str(s) + '\n')
+            ks = list(times[s].keys())
+            ks.sort()
+            for k in ks:
+                f.write('  {}: {}\n'.format(k, times[s][k]))
+    return times
+
+
+def benchmark_index(database=None, repeats=10, build=True):
+    """
+    Compares searches with and without the megablast index of the database
+    :param database: str, the database
+    :param repeats: int, the number of searches per sequence and mode
+    :param build: bool, builds the index if it is missing or stale
+    :return: dict, sequence index: {'unindexed': list of run times, 'indexed': list of run times, 'speedup': float}
+    """
+
+    job = BlastJob(blast_db=database)
+    if build and megablast_index.index_status(job.blast_db) != 'current':
+        t0 = time.time()
+        job.build_megablast_index()
+        print('built megablast index in {:.1f} s'.format(time.time() - t0))
+    if megablast_index.index_status(job.blast_db) != 'current':
+        raise RuntimeError('no current megablast index for {}'.format(job.blast_db))
+
+    results = {}
+    for s, seq in enumerate(seqs):
+        results[s] = {'unindexed': [], 'indexed': []}
+        for _ in range(repeats):
+            # alternating the modes spreads file system caching effects over both
+            results[s]['unindexed'].append(run_blast(BlastJob(blast_db=database), seq, {'use_index': 'false'}))
+            results[s]['indexed'].append(run_blast(BlastJob(blast_db=database), seq))
+        unindexed = sorted(results[s]['unindexed'])[repeats // 2]
+        indexed = sorted(results[s]['indexed'])[repeats // 2]
+        results[s]['speedup'] = unindexed / indexed if indexed > 0 else float('nan')
+        print('sequence {}: median {:.3f} s without index, {:.3f} s with index, speedup {:.2f}x'.format(
+            s, unindexed, indexed, results[s]['speedup']))
+    return results
+
+
+def seed_autotune(database=None, repeats=3, max_threads=None):
+    """
+    Runs every sequence with both tasks and several numbers of threads, the run times are recorded in the result
+    database and used to auto-tune later searches against the database
+    :return: None
+    """
+
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    for _ in range(repeats):
+        for s, seq in enumerate(seqs):
+            for task in ('megablast', 'blastn-short'):
+                for threads in range(1, max_threads + 1):
+                    seconds = run_blast(BlastJob(blast_db=database), seq, {'num_threads': threads, 'task': task})
+                    print('sequence {}, {}, {} threads: {:.3f} s'.format(s, task, threads, seconds))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmarks BLAST searches')
+    parser.add_argument('--mode', type=str, default='threads', choices=['threads', 'index', 'autotune'],
+                        help='threads compares numbers of threads, index compares searches with megablast indexes, '
+                             'autotune records run times which are used to pick threads and task of later searches')
+    parser.add_argument('--database', type=str, default=None, help='the database, nt if not given')
+    parser.add_argument('--repeats', type=int, default=10, help='searches per sequence and setting')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.mode == 'threads':
+        benchmark_threads(database=args.database, repeats=args.repeats)
+    elif args.mode == 'index':
+        benchmark_index(database=args.database, repeats=args.repeats)
+    else:
+        seed_autotune(database=args.database, repeats=args.repeats)
@@ -0,0 +1,113 @@
+import queue
+import threading
+
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Runs a chain of stages in worker threads which are connected by bounded queues, the outputs of a stage flow into
+    the next stage as soon as they are produced. Stage functions take one item and return an iterable (usually they
+    are generators) with any number of items for the next stage.
+    """
+
+    def __init__(self, queue_size=64):
+        self.queue_size = queue_size
+        self.stages = []
+        self.errors = []
+        self._stop_before = -1
+        self._lock = threading.Lock()
+
+    def add_stage(self, function, workers=1, name=None):
+        """
+        Appends a stage
+        :param function: callable, called with one item, returns an iterable of items for the next stage
+        :param workers: int, the number of threads which run the stage
+        :param name: str, the name of the stage used in error messages
+        :return: Pipeline, the pipeline itself
+        """
+
+        if workers < 1:
+            raise ValueError('a stage needs at least one worker')
+        self.stages.append((function, workers, name or getattr(function, '__name__', 'stage')))
+        return self
+
+    def stop(self, stage=None):
+        """
+        Stops feeding new items and drops the remaining inputs of the stages up to and including stage, items which
+        were already passed on are still processed by the later stages
+        :param stage: int, the index of the last stage which is stopped, all stages if None
+        :return: None
+        """
+
+        with self._lock:
+            self._stop_before = max(self._stop_before, len(self.stages) - 1 if stage is None else stage)
+
+    def stopped(self, stage=0):
+        return self._stop_before >= stage
+
+    def _feed(self, items, outbox):
+        try:
+            for item in items:
+                if self.stopped(0):
+                    break
+                outbox.put(item)
+        except Exception as e:
+            self.errors.append(('source', e))
+            self.stop()
+        finally:
+            outbox.put(_DONE)
+
+    def _work(self, index, function, name, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # the sentinel is passed on to the other workers of the stage
+                inbox.put(_DONE)
+                return
+            if self.stopped(index):
+                continue
+            try:
+                for output in function(item):
+                    outbox.put(output)
+            except Exception as e:
+                self.errors.append((name, e))
+                self.stop()
+
+    def _close(self, workers, outbox):
+        for worker in workers:
+            worker.join()
+        outbox.put(_DONE)
+
+    def run(self, items):
+        """
+        Runs all stages until the items are exhausted or the pipeline is stopped
+        :param items: iterable, the inputs of the first stage, consumed lazily in its own thread
+        :return: list, the outputs of the last stage in the order in which they were produced
+        """
+
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for index, (function, workers, name) in enumerate(self.stages):
+            stage_workers = [threading.Thread(target=self._work,
+                                              args=(index, function, name, queues[index], queues[index + 1]),
+                                              daemon=True)
+                             for _ in range(workers)]
+            threads.extend(stage_workers)
+            threads.append(threading.Thread(target=self._close, args=(stage_workers, queues[index + 1]), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        results = []
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            results.append(item)
+        for thread in threads:
+            thread.join()
+        if len(self.errors) > 0:
+            name, error = self.errors[0]
+            raise RuntimeError('pipeline stage {} failed: {}'.format(name, error)) from error
+        return results
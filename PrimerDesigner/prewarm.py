@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+from PrimerDesigner.Job import BlastJob
+from PrimerDesigner import Primer
+from PrimerDesigner import config
+from PrimerDesigner import dedup
+from PrimerDesigner import kmer_sketch
+from PrimerDesigner import megablast_index
+from PrimerDesigner.tools import tools
+
+
+WARMED = 'warmed'
+CACHED = 'cached'
+FAILED = 'failed'
+
+
+def read_panel(filename):
+    """
+    :param filename: str, the FASTA file of the panel, may be gzip or bgzip compressed
+    :return: list of SeqRecord, the targets
+    """
+
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    return [SeqRecord(Seq(seq), id=header.split(' ')[0], description='')
+            for header, seq in tools.iter_fasta(filename)]
+
+
+def _step(database, target, step, function):
+    """
+    Runs a single warming step, errors are reported instead of raised so that the other steps continue
+    :param function: callable, returns WARMED or CACHED
+    :return: dict, the report entry
+    """
+
+    entry = {'database': database, 'target': target, 'step': step}
+    t0 = time.time()
+    try:
+        entry['status'] = function()
+    except Exception as e:
+        entry['status'] = FAILED
+        entry['error'] = str(e)
+    entry['seconds'] = time.time() - t0
+    return entry
+
+
+def warm_target(record, database):
+    """
+    Fills the caches which design_primers uses for a target: the BLAST result and the hit set of the target,
+    the collapsed hit FASTA and its 2bit conversion for gfServer
+    :param record: SeqRecord, the target
+    :param database: str, the database
+    :return: list of dict, one report entry per step, later steps are skipped if a step failed
+    """
+
+    blast = BlastJob(blast_db=database)
+    settings = blast.settings
+    files = {}
+
+    def hit_set():
+        cache, key = Primer.hit_set_key(blast, record)
+        cached = cache.get(key)
+        files['hits'] = cached[1] if cached is not None else Primer.get_hit_set(blast, record)[1]
+        return CACHED if cached is not None else WARMED
+
+    def collapse():
+        threshold = settings.config.get('dedup_threshold')
+        threshold = float(threshold) if threshold is not None else None
+        cached = dedup.is_collapsed(files['hits'], threshold=threshold)
+        files['hits'] = dedup.collapse_fasta(files['hits'], threshold=threshold)[0]
+        return CACHED if cached else WARMED
+
+    def convert_to_2bit():
+        cache = Primer.twobit_cache(settings)
+        key = Primer.hit_set_2bit_key(files['hits'])
+        cached = os.path.isfile(cache.path(files['hits'], key=key))
+        cache.get(files['hits'], key=key)
+        return CACHED if cached else WARMED
+
+    steps = [('hit_set', hit_set)]
+    if settings.config.get('dedup_hits', True):
+        steps.append(('dedup', collapse))
+    steps.append(('2bit', convert_to_2bit))
+    report = []
+    for step, function in steps:
+        report.append(_step(database, record.id, step, function))
+        if report[-1]['status'] == FAILED:
+            break
+    return report
+
+
+def warm_database(database, fm_index=False, sketch=False, mb_index=False):
+    """
+    Builds the indexes of a database which are missing or outdated
+    :param database: str, the database
+    :param fm_index: bool, builds the FM-index used by design_primers with specificity='fm_index'
+    :param sketch: bool, builds the k-mer sketch used by the 3' end prefilter
+    :param mb_index: bool, builds the megablast indexes of the database or its shards
+    :return: list of dict, one report entry per index
+    """
+
+    blast = BlastJob(blast_db=database)
+    report = []
+
+    def build_fm_index():
+        if blast.fm_index_status() == 'current':
+            return CACHED
+        blast.get_fm_index()
+        return WARMED
+
+    def build_sketch():
+        if kmer_sketch.load(blast.blast_db, k=int(blast.settings.config.get('kmer_prefilter_k', 12))) is not None:
+            return CACHED
+        blast.build_kmer_sketch()
+        return WARMED
+
+    def build_megablast_index():
+        databases = [blast.blast_db] if blast.shards is None else blast.shards['shards']
+        if all(megablast_index.index_status(db) == 'current' for db in databases):
+            return CACHED
+        blast.build_megablast_index()
+        return WARMED
+
+    for step, enabled, function in (('fm_index', fm_index, build_fm_index), ('kmer_sketch', sketch, build_sketch),
+                                    ('megablast_index', mb_index, build_megablast_index)):
+        if enabled:
+            report.append(_step(database, None, step, function))
+    return report
+
+
+def prewarm(panel, databases, workers=None, fm_index=False, sketch=False, mb_index=False):
+    """
+    Warms the caches for every target of a panel in every database ahead of time, e.g. after the weekly database
+    update from cron:
+        0 3 * * 1 cd /srv/primer_designer && python -m PrimerDesigner.prewarm panels/weekly.fa nt --report warm.json
+    Each warming task runs BLAST with the configured number of threads, workers bounds how many run at once.
+    :param panel: str, the FASTA file with the targets
+    :param databases: list, the databases
+    :param workers: int, the number of concurrent tasks, config key prewarm_workers or 2 if None
+    :param fm_index: bool, see warm_database
+    :param sketch: bool, see warm_database
+    :param mb_index: bool, see warm_database
+    :return: list of dict, the report entries with database, target, step, status, seconds and error if failed
+    """
+
+    if workers is None:
+        workers = int(config.get_settings().config.get('prewarm_workers', 2))
+    records = read_panel(panel)
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        futures = [executor.submit(warm_database, database, fm_index=fm_index, sketch=sketch, mb_index=mb_index)
+                   for database in databases]
+        futures.extend(executor.submit(warm_target, record, database) for database in databases for record in records)
+        return [entry for future in futures for entry in future.result()]
+
+
+def format_report(report, seconds=None):
+    """
+    :param report: list of dict, see prewarm
+    :param seconds: float, the total run time
+    :return: str, one line per step and a summary
+    """
+
+    lines = []
+    for entry in report:
+        line = '{}\t{}\t{}\t{}\t{:.2f} s'.format(entry['database'], entry['target'] or '-', entry['step'],
+                                                 entry['status'], entry['seconds'])
+        if 'error' in entry:
+            line += '\t{}'.format(entry['error'])
+        lines.append(line)
+    counts = {status: sum(1 for entry in report if entry['status'] == status) for status in (WARMED, CACHED, FAILED)}
+    summary = '{} warmed, {} already cached, {} failed'.format(counts[WARMED], counts[CACHED], counts[FAILED])
+    if seconds is not None:
+        summary += ' in {:.2f} s'.format(seconds)
+    lines.append(summary)
+    return '\n'.join(lines)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Fills the BLAST, hit set and 2bit caches for a panel of targets '
+                                                 'before primers are designed for it')
+    parser.add_argument('panel', type=str, help='the FASTA file with the targets, may be gzip compressed')
+    parser.add_argument('databases', type=str, nargs='+', help='the databases which are searched')
+    parser.add_argument('--workers', type=int, default=None, help='the number of concurrent warming tasks')
+    parser.add_argument('--fm-index', action='store_true', help='builds missing FM-indexes of the databases')
+    parser.add_argument('--kmer-sketch', action='store_true', help="builds missing k-mer sketches for the 3' "
+                                                                   "end prefilter")
+    parser.add_argument('--megablast-index', action='store_true', help='builds missing or stale megablast indexes')
+    parser.add_argument('--report', type=str, default=None, help='writes the report as JSON to this file')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    t0 = time.time()
+    report = prewarm(args.panel, args.databases, workers=args.workers, fm_index=args.fm_index,
+                     sketch=args.kmer_sketch, mb_index=args.megablast_index)
+    seconds = time.time() - t0
+    print(format_report(report, seconds=seconds))
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({'seconds': seconds, 'steps': report}, f, indent=2)
+    if any(entry['status'] == FAILED for entry in report):
+        sys.exit(1)
@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import heapq
+import shutil
+import xml.etree.ElementTree as ElementTree
+from PrimerDesigner.tools import tools
+from PrimerDesigner.hit_store import expand_fields
+
+
+# blastn reports at most this many subjects per query if max_target_seqs is not given
+DEFAULT_MAX_TARGET_SEQS = 500
+SUBJECT_FIELDS = ('sseqid', 'sacc', 'saccver', 'sallseqid', 'sgi')
+HITS_FOUND = re.compile(rb'^# \d+ hits found')
+
+
+def manifest_filename(database):
+    return database + '.shards'
+
+
+def read_manifest(database):
+    """
+    Reads the shard manifest of a database
+    :param database: str, the database
+    :return: dict or None if the database is not sharded, shard paths are absolute
+    """
+
+    filename = manifest_filename(database)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(os.path.abspath(filename))
+    manifest['shards'] = [os.path.join(directory, shard) for shard in manifest['shards']]
+    return manifest
+
+
+def split_fasta(filename, database, shards):
+    """
+    Splits a FASTA file into shards of similar size, each record goes to the currently smallest shard
+    :param filename: str, the FASTA file
+    :param database: str, the name of the database, shard i is written to database.i.fa
+    :param shards: int, the number of shards
+    :return: tuple (list of FASTA files, int total length, int number of sequences)
+    """
+
+    filenames = ['{}.{}.fa'.format(database, i) for i in range(shards)]
+    handles = [open(f, 'w') for f in filenames]
+    sizes = [0] * shards
+    number_of_sequences = 0
+    try:
+        for header, seq in tools.iter_fasta(filename):
+            i = sizes.index(min(sizes))
+            handles[i].write('>{}\n{}\n'.format(header, seq))
+            sizes[i] += len(seq)
+            number_of_sequences += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    return filenames, sum(sizes), number_of_sequences
+
+
+def build_shards(filename, database, shards, make_blast_db):
+    """
+    Builds a sharded BLAST database and writes its manifest
+    :param filename: str, the FASTA file
+    :param database: str, the name of the database, shard i is called database.i
+    :param shards: int, the number of shards
+    :param make_blast_db: function, called with the FASTA file and the name of each shard
+    :return: dict, the manifest
+    """
+
+    filenames, length, number_of_sequences = split_fasta(filename, database, shards)
+    try:
+        for i, filename_shard in enumerate(filenames):
+            make_blast_db(filename_shard, '{}.{}'.format(database, i))
+    finally:
+        for filename_shard in filenames:
+            os.remove(filename_shard)
+    manifest = {'shards': ['{}.{}'.format(os.path.basename(database), i) for i in range(shards)],
+                'length': length,
+                'sequences': number_of_sequences}
+    with open(manifest_filename(database), 'w') as f:
+        json.dump(manifest, f)
+    return read_manifest(database)
+
+
+def _hit_evalue(hit):
+    evalues = [float(e.text) for e in hit.iter('Hsp_evalue')]
+    scores = [float(e.text) for e in hit.iter('Hsp_bit-score')]
+    return min(evalues, default=float('inf')), -max(scores, default=0)
+
+
+def _iter_iterations(filename, sections):
+    """
+    Streams the Iteration elements of XML output (outfmt 5), each one is cleared after it was consumed
+    :param filename: str, the XML output
+    :param sections: list, the other children of BlastOutput are appended as tuples (bool after the iterations,
+                     element)
+    :return: generator of Element
+    """
+
+    depth = 0
+    iterations = None
+    for event, element in ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and element.tag == 'BlastOutput_iterations':
+                iterations = element
+            continue
+        depth -= 1
+        if depth == 2 and element.tag == 'Iteration' and iterations is not None:
+            yield element
+            # finished iterations are dropped, the memory does not grow with the output
+            element.clear()
+            iterations.remove(element)
+        elif depth == 1 and element.tag != 'BlastOutput_iterations':
+            sections.append((iterations is not None, element))
+
+
+def _write_sections(output, sections, after):
+    for is_after, element in sections:
+        if is_after == after:
+            output.write(ElementTree.tostring(element))
+
+
+def merge_xml(filenames, output, max_target_seqs=None):
+    """
+    Merges the XML output (outfmt 5) of the same queries against several shards while streaming it, only one
+    iteration per shard is held in memory. Hits are sorted by e-value and capped at max_target_seqs like the hits
+    of an unsharded search.
+    :param filenames: list, the output of each shard
+    :param output: file object, the merged output is written to it
+    :param max_target_seqs: int, the maximal number of hits per query, all hits if None
+    :return: None
+    """
+
+    sections = [[] for _ in filenames]
+    shards = [_iter_iterations(filename, shard_sections) for filename, shard_sections in zip(filenames, sections)]
+    output.write(b'<?xml version="1.0"?>\n')
+    output.write(b'<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" '
+                 b'"http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n')
+    output.write(b'<BlastOutput>')
+    started = False
+    for iterations in zip(*shards):
+        if not started:
+            # the program, the database and the parameters are taken from the first shard
+            _write_sections(output, sections[0], False)
+            output.write(b'<BlastOutput_iterations>')
+            started = True
+        iteration = iterations[0]
+        hits = []
+        for shard in iterations:
+            hits.extend(shard.findall('Iteration_hits/Hit'))
+        hits.sort(key=_hit_evalue)
+        if max_target_seqs is not None:
+            hits = hits[:max_target_seqs]
+        iteration_hits = iteration.find('Iteration_hits')
+        if iteration_hits is None:
+            iteration_hits = ElementTree.SubElement(iteration, 'Iteration_hits')
+        for hit in list(iteration_hits):
+            iteration_hits.remove(hit)
+        for h, hit in enumerate(hits):
+            if hit.find('Hit_num') is not None:
+                hit.find('Hit_num').text = str(h + 1)
+            iteration_hits.append(hit)
+        for field in ('Statistics_db-num', 'Statistics_db-len'):
+            element = iteration.find('Iteration_stat/Statistics/' + field)
+            if element is not None:
+                element.text = str(sum(int(shard.find('Iteration_stat/Statistics/' + field).text)
+                                       for shard in iterations))
+        output.write(ElementTree.tostring(iteration))
+    # the remaining output is read to reach the sections after the iterations
+    for shard in shards:
+        for _ in shard:
+            pass
+    if not started:
+        _write_sections(output, sections[0], False)
+        output.write(b'<BlastOutput_iterations>')
+    output.write(b'</BlastOutput_iterations>')
+    _write_sections(output, sections[0], True)
+    output.write(b'</BlastOutput>\n')
+
+
+def shard_outfmt(outfmt):
+    """
+    Tabular output of shards is always written as outfmt 7, its comment lines mark the start of every query even if
+    a shard has no hits for it, the merged output is converted back to the requested format
+    :param outfmt: str, the requested output format including format specifiers
+    :return: str, the output format of the shards
+    """
+
+    parts = str(outfmt).split(' ')
+    if parts[0] in ('6', '10'):
+        return ' '.join(['7'] + parts[1:])
+    return str(outfmt)
+
+
+def _iter_query_blocks(filename):
+    """
+    Streams the queries of tabular output with comment lines (outfmt 7), each query starts with the program line
+    :param filename: str, the output of a shard
+    :return: generator of tuples (list of header lines, list of hit lines, list of comment lines after the hits)
+    """
+
+    program = None
+    header, hits, footer = [], [], []
+    found = False
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'#'):
+                if program is None:
+                    program = line
+                if line == program and (len(header) > 0 or len(hits) > 0):
+                    yield header, hits, footer
+                    header, hits, footer = [], [], []
+                    found = False
+                # comments after the hits found line, e.g. the number of processed queries, close the output
+                (footer if found else header).append(line)
+                found = found or HITS_FOUND.match(line) is not None
+            elif len(line.strip()) > 0:
+                hits.append(line)
+    if len(header) > 0 or len(hits) > 0:
+        yield header, hits, footer
+
+
+def merge_tabular(filenames, output, outfmt, max_target_seqs=None, database=None):
+    """
+    Merges tabular output while streaming it, the shards need to be written with shard_outfmt. The queries are read
+    in lockstep, only the hits of the current query are held in memory, they are merged by e-value like BLAST
+    sorts them within each shard.
+    :param filenames: list, the output of each shard
+    :param output: file object, the merged output is written to it
+    :param outfmt: str, the requested output format (6, 7 or 10) including format specifiers
+    :param max_target_seqs: int, the maximal number of subjects per query, all subjects if None
+    :param database: str, replaces the shard in the database comment line of outfmt 7
+    :return: None
+    """
+
+    parts = outfmt.split(' ')
+    comments = parts[0] == '7'
+    fields = expand_fields(parts[1:])
+    evalue = fields.index('evalue') if 'evalue' in fields else None
+    subject = next((fields.index(f) for f in SUBJECT_FIELDS if f in fields), None)
+
+    def cells(line):
+        return line.decode('utf-8').rstrip('\n').split('\t')
+
+    def key(line):
+        return float(cells(line)[evalue]) if evalue is not None else 0
+
+    shards = [_iter_query_blocks(filename) for filename in filenames]
+    for blocks in zip(*shards):
+        lines = []
+        kept = set()
+        for line in heapq.merge(*[hits for _, hits, _ in blocks], key=key):
+            if max_target_seqs is not None and subject is not None:
+                # all HSPs of the best max_target_seqs subjects are kept
+                subject_id = cells(line)[subject]
+                if subject_id not in kept:
+                    if len(kept) >= max_target_seqs:
+                        continue
+                    kept.add(subject_id)
+            lines.append(line)
+        if comments:
+            # the header of a shard with hits includes the fields line
+            header, _, footer = next((block for block in blocks if len(block[1]) > 0), blocks[0])
+            for line in header:
+                if HITS_FOUND.match(line):
+                    line = '# {} hits found\n'.format(len(lines)).encode('utf-8')
+                elif database is not None and line.startswith(b'# Database: '):
+                    line = '# Database: {}\n'.format(database).encode('utf-8')
+                output.write(line)
+        for line in lines:
+            output.write(line.replace(b'\t', b',') if parts[0] == '10' else line)
+        if comments:
+            output.write(b''.join(blocks[0][2]))
+
+
+def merge(filenames, output, outfmt, max_target_seqs=None, database=None):
+    """
+    Merges the output of several shards into a single output
+    :param filenames: list, the output of each shard
+    :param output: file object opened in binary mode
+    :param outfmt: str, the BLAST output format
+    :param max_target_seqs: int, the maximal number of subjects per query, all subjects if None
+    :param database: str, the name of the whole database, see merge_tabular
+    :return: None
+    """
+
+    fmt = outfmt.split(' ')[0]
+    if fmt == '5':
+        merge_xml(filenames, output, max_target_seqs=max_target_seqs)
+    elif fmt in ('6', '7', '10'):
+        merge_tabular(filenames, output, outfmt, max_target_seqs=max_target_seqs, database=database)
+    else:
+        # pairwise and other report formats cannot be merged, the reports are concatenated
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                shutil.copyfileobj(f, output)
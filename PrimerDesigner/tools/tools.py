@@ -1,8 +1,13 @@
 import os
+import gzip
 import random
 import ftplib
 import tarfile
+import shutil
 import sqlite3
+import tempfile
+import threading
+import contextlib
 
 
 def download_from_ftp(url, direc='.'):
@@ -52,6 +57,50 @@ def create_random_fasta(num_seq=10, seq_type='nuc'):
     return '\n'.join(seq)
 
 
+def is_gzip(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_fasta(filename, mode='r'):
+    """
+    Opens a FASTA file for reading, gzip and bgzip compressed files are decompressed while reading
+    :param filename: str, the FASTA file, compression is detected from its content
+    :param mode: str, either 'r' or 'rb'
+    :return: file object
+    """
+
+    if is_gzip(filename):
+        return gzip.open(filename, 'rb' if 'b' in mode else 'rt')
+    return open(filename, mode)
+
+
+def iter_fasta(handle):
+    """
+    Iterates over the records of a FASTA file without loading the whole file
+    :param handle: str or file object, the FASTA file, may be gzip or bgzip compressed
+    :return: generator of tuples (header, sequence), the header without '>'
+    """
+
+    if isinstance(handle, str):
+        with open_fasta(handle) as f:
+            yield from iter_fasta(f)
+        return
+
+    header = None
+    seq = []
+    for line in handle:
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(seq)
+            header = line[1:].strip()
+            seq = []
+        elif header is not None:
+            seq.append(line.strip())
+    if header is not None:
+        yield header, ''.join(seq)
+
+
 def create_empty_database(conn=None):
     close = False
     if conn is None:
@@ -64,12 +113,133 @@ def create_empty_database(conn=None):
     except sqlite3.OperationalError as e:
         if 'table jobs already exists' not in str(e):
             raise e
+    try:
+        c.execute('''CREATE TABLE queue
+                         (id text primary key, kind text, payload text, status text, worker text,
+                          lease_expires real, heartbeat real, created real, result text, error text)''')
+        c.execute('CREATE INDEX queue_status ON queue (status, created)')
+    except sqlite3.OperationalError as e:
+        if 'table queue already exists' not in str(e):
+            raise e
+    try:
+        c.execute('''CREATE TABLE job_store
+                         (id text primary key, status text, error integer, finished integer, stdout_file text,
+                          stdout text, stderr text, cancel_reason text, stored real)''')
+    except sqlite3.OperationalError as e:
+        if 'table job_store already exists' not in str(e):
+            raise e
+    try:
+        c.execute('''CREATE TABLE blast_timings
+                         (id integer primary key, db text, db_size integer, query_length integer, task text,
+                          num_threads integer, load real, seconds real, created real)''')
+        c.execute('CREATE INDEX blast_timings_size ON blast_timings (db_size, query_length)')
+    except sqlite3.OperationalError as e:
+        if 'table blast_timings already exists' not in str(e):
+            raise e
+    try:
+        c.execute('''CREATE TABLE hits
+                         (run text, query text, subject text, qstart integer, qend integer, sstart integer,
+                          send integer, strand integer, identity real, evalue real, bitscore real)''')
+        c.execute('CREATE INDEX hits_subject ON hits (subject, evalue)')
+        c.execute('CREATE INDEX hits_run ON hits (run, query)')
+        c.execute('CREATE INDEX hits_query ON hits (query)')
+        c.execute('CREATE TABLE hit_runs (run text primary key, db text, hsps integer, created real)')
+        c.execute('CREATE TABLE hit_jobs (job text primary key, run text)')
+        c.execute('CREATE INDEX hit_jobs_run ON hit_jobs (run)')
+    except sqlite3.OperationalError as e:
+        if 'table hits already exists' not in str(e):
+            raise e
 
     conn.commit()
     if close:
         conn.close()
 
 
+_schemas = set()
+_schemas_lock = threading.Lock()
+
+
+def connect_result_db(result_db, timeout=30):
+    """
+    Connects to the result database, its tables are only created on the first connection of a process or if the
+    database file is empty, e.g. because it was removed in the meantime
+    :param result_db: str, the SQLite database
+    :param timeout: float, seconds to wait for a lock
+    :return: sqlite3.Connection
+    """
+
+    conn = sqlite3.connect(result_db, timeout=timeout)
+    key = os.path.abspath(result_db)
+    with _schemas_lock:
+        known = key in _schemas
+    if not known or not os.path.isfile(result_db) or os.path.getsize(result_db) == 0:
+        create_empty_database(conn)
+        with _schemas_lock:
+            _schemas.add(key)
+    return conn
+
+
+def enable_wal(result_db='blast_jobs.db'):
+    """
+    Creates the result database and switches it to write-ahead logging, readers are not blocked by writers which
+    lets several server processes share it, the mode is stored in the database file
+    :param result_db: str, the SQLite database
+    :return: str, the journal mode
+    """
+
+    conn = sqlite3.connect(result_db, timeout=30)
+    try:
+        create_empty_database(conn)
+        return conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def temporary_directory(parent=None, prefix='job_'):
+    """
+    Creates a private directory for the files of a single job, it is removed with everything in it when the context
+    exits, also if the job failed
+    :param parent: str, the directory in which it is created, e.g. a tmpfs like /dev/shm, the system default if None
+    :param prefix: str, the prefix of the directory name
+    :return: context manager which yields str, the path of the directory
+    """
+
+    if parent is not None:
+        os.makedirs(parent, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def feed_stdin(proc, data):
+    """
+    Writes data to the stdin of a process in a thread and closes it afterwards, the caller can read the output of
+    the process at the same time without filling up the pipes
+    :param proc: subprocess.Popen, the process, started with stdin=subprocess.PIPE
+    :param data: str or bytes, the input, its type needs to match the mode of the pipe
+    :return: threading.Thread, the writer
+    """
+
+    def write():
+        try:
+            proc.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            # the process exited early, its error is reported by its return code and stderr
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread
+
+
 def make_dirs(dirs=None):
     """
     Creates a list of directories needed to store files for PrimerDesigner
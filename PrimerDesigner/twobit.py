@@ -0,0 +1,275 @@
+import os
+import re
+import glob
+import mmap
+import struct
+import shutil
+import hashlib
+import tempfile
+import itertools
+from PrimerDesigner.tools import tools
+
+
+_SIGNATURE = 0x1A412743
+_HEADER = struct.Struct('<IIII')
+_BASES = 'TCAG'
+_PACK = {''.join(k): i for i, k in enumerate(itertools.product(_BASES, repeat=4))}
+_UNPACK = [''.join(k) for k in itertools.product(_BASES, repeat=4)]
+
+
+def _blocks(pattern, seq):
+    starts = []
+    sizes = []
+    for m in re.finditer(pattern, seq):
+        starts.append(m.start())
+        sizes.append(m.end() - m.start())
+    return starts, sizes
+
+
+def _pack_record(seq):
+    """
+    Packs a single sequence into the 2bit record format
+    :param seq: str, the sequence, lower case letters are stored as soft-masked
+    :return: bytes, the record
+    """
+
+    upper = seq.upper()
+    n_starts, n_sizes = _blocks('[^ACGT]+', upper)
+    mask_starts, mask_sizes = _blocks('[a-z]+', seq)
+    # N and other ambiguous bases are stored as T and restored from the N blocks
+    upper = re.sub('[^ACGT]', 'T', upper)
+    upper += 'T' * (-len(upper) % 4)
+    dna = bytes(_PACK[upper[i:i + 4]] for i in range(0, len(upper), 4))
+
+    record = [struct.pack('<II', len(seq), len(n_starts))]
+    record.append(struct.pack('<{}I'.format(len(n_starts)), *n_starts))
+    record.append(struct.pack('<{}I'.format(len(n_sizes)), *n_sizes))
+    record.append(struct.pack('<I', len(mask_starts)))
+    record.append(struct.pack('<{}I'.format(len(mask_starts)), *mask_starts))
+    record.append(struct.pack('<{}I'.format(len(mask_sizes)), *mask_sizes))
+    record.append(struct.pack('<I', 0))
+    record.append(dna)
+    return b''.join(record)
+
+
+def write_2bit(fasta, filename):
+    """
+    Converts a FASTA file to UCSC 2bit format, only one record is held in memory at a time
+    :param fasta: str or file object, the FASTA file
+    :param filename: str, the 2bit file
+    :return: str, the 2bit file
+    """
+
+    names = []
+    sizes = []
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename))) as body:
+        for header, seq in tools.iter_fasta(fasta):
+            name = header.split(' ')[0].encode('ascii')
+            if len(name) > 255:
+                raise ValueError('sequence name too long for 2bit format: {}'.format(name))
+            record = _pack_record(seq)
+            body.write(record)
+            names.append(name)
+            sizes.append(len(record))
+
+        offset = _HEADER.size + sum(1 + len(name) + 4 for name in names)
+        filename_tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(filename_tmp, 'wb') as f:
+            f.write(_HEADER.pack(_SIGNATURE, 0, len(names), 0))
+            for name, size in zip(names, sizes):
+                f.write(struct.pack('<B', len(name)))
+                f.write(name)
+                f.write(struct.pack('<I', offset))
+                offset += size
+            if offset >= 2 ** 32:
+                raise ValueError('FASTA file too large for 2bit format')
+            body.seek(0)
+            shutil.copyfileobj(body, f)
+    os.replace(filename_tmp, filename)
+    return filename
+
+
+class TwoBitReader:
+    """
+    Memory-mapped random access to the sequences of a 2bit file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count, _ = _HEADER.unpack_from(self._mm, 0)
+        if signature != _SIGNATURE or version != 0:
+            raise ValueError('{} is not a 2bit file'.format(filename))
+        self.offsets = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            size = self._mm[pos]
+            name = self._mm[pos + 1:pos + 1 + size].decode('ascii')
+            self.offsets[name] = struct.unpack_from('<I', self._mm, pos + 1 + size)[0]
+            pos += 1 + size + 4
+        self._records = {}
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def names(self):
+        return list(self.offsets)
+
+    def _record(self, name):
+        record = self._records.get(name)
+        if record is None:
+            pos = self.offsets[name]
+            size, n_count = struct.unpack_from('<II', self._mm, pos)
+            pos += 8
+            n_blocks = struct.unpack_from('<{}I'.format(2 * n_count), self._mm, pos)
+            pos += 8 * n_count
+            mask_count = struct.unpack_from('<I', self._mm, pos)[0]
+            pos += 4
+            mask_blocks = struct.unpack_from('<{}I'.format(2 * mask_count), self._mm, pos)
+            pos += 8 * mask_count + 4
+            record = (size,
+                      list(zip(n_blocks[:n_count], n_blocks[n_count:])),
+                      list(zip(mask_blocks[:mask_count], mask_blocks[mask_count:])),
+                      pos)
+            self._records[name] = record
+        return record
+
+    def length(self, name):
+        return self._record(name)[0]
+
+    def sequence(self, name, start=0, end=None):
+        """
+        Returns a subsequence without reading the rest of the record
+        :param name: str, the name of the sequence
+        :param start: int, 0-based start
+        :param end: int, 0-based exclusive end, the end of the sequence if None
+        :return: str, the sequence, soft-masked regions in lower case
+        """
+
+        size, n_blocks, mask_blocks, dna_offset = self._record(name)
+        if end is None or end > size:
+            end = size
+        start = max(0, start)
+        if start >= end:
+            return ''
+        first = start // 4
+        last = (end + 3) // 4
+        packed = self._mm[dna_offset + first:dna_offset + last]
+        seq = ''.join(_UNPACK[b] for b in packed)[start - first * 4:end - first * 4]
+        for blocks, replace in ((n_blocks, lambda s: 'N' * len(s)), (mask_blocks, str.lower)):
+            for block_start, block_size in blocks:
+                s = max(block_start, start) - start
+                e = min(block_start + block_size, end) - start
+                if s < e:
+                    seq = seq[:s] + replace(seq[s:e]) + seq[e:]
+        return seq
+
+    def records(self):
+        """
+        Iterates over all sequences
+        :return: generator of tuples (name, sequence)
+        """
+
+        for name in self.offsets:
+            yield name, self.sequence(name)
+
+
+def file_hash(filename, block_size=1 << 20):
+    """
+    Returns the SHA1 of the content of a file
+    :param filename: str, the file
+    :param block_size: int, the number of bytes read at a time
+    :return: str, the hex digest
+    """
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TwoBitCache:
+    """
+    Stores 2bit conversions of FASTA files by content hash or by a key which identifies the content, e.g. the key of
+    a hit set, the same FASTA is only converted once. Least recently used conversions are evicted once the cache
+    exceeds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, fasta, key=None):
+        """
+        :param fasta: str, the FASTA file
+        :param key: str, identifies the content of the FASTA file, its SHA1 is computed if None
+        :return: str, the 2bit file
+        """
+
+        return os.path.join(self.directory, '{}.2bit'.format(key if key is not None else file_hash(fasta)))
+
+    def get(self, fasta, key=None):
+        """
+        Returns the 2bit file for a FASTA file, converting it if it is not cached yet
+        :param fasta: str, the FASTA file
+        :param key: str, see path
+        :return: str, the 2bit file
+        """
+
+        filename = self.path(fasta, key=key)
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            write_2bit(fasta, filename)
+            self.evict(keep=filename)
+        return filename
+
+    def open(self, fasta, key=None):
+        return TwoBitReader(self.get(fasta, key=key))
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used 2bit files until the cache is smaller than max_bytes
+        :param keep: str, a 2bit file which is never evicted
+        :return: int, the number of evicted files
+        """
+
+        entries = []
+        total = 0
+        for filename in glob.glob(os.path.join(glob.escape(self.directory), '*.2bit')):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, filename, stat.st_size))
+            total += stat.st_size
+        entries.sort()
+        evicted = 0
+        for _, filename, size in entries:
+            if total <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,354 @@
+import sys
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+from PrimerDesigner.Job import Job, BlastJob
+from PrimerDesigner.tools import tools
+
+
+# the longest wait after repeated database errors in seconds
+MAX_BACKOFF = 30
+
+
+class JobQueue:
+    """
+    A job queue in the queue table of the result database. Workers claim jobs atomically and hold them with a lease
+    which they renew by sending heartbeats, jobs of crashed workers are claimed again once their lease expired.
+    BLAST output is stored relative to result_dir, workers and servers on several machines need the same result
+    database and result_dir on a shared file system.
+    """
+
+    def __init__(self, result_db='blast_jobs.db', timeout=30):
+        self.result_db = result_db
+        self.timeout = timeout
+        conn = self._connect()
+        tools.create_empty_database(conn)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.result_db, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, kind, payload, job_id=None):
+        """
+        Adds a job to the queue
+        :param kind: str, either 'blast', 'blast_primers' or 'design'
+        :param payload: dict, the arguments of the job, needs to be JSON serializable
+        :param job_id: str, the ID of the job, a new one is created if None
+        :return: str, the job ID
+        """
+
+        if job_id is None:
+            job_id = BlastJob.get_job_id()
+        conn = self._connect()
+        try:
+            conn.execute("INSERT INTO queue (id, kind, payload, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                         (job_id, kind, json.dumps(payload), time.time()))
+        finally:
+            conn.close()
+        return job_id
+
+    def claim(self, worker, lease=60):
+        """
+        Claims the oldest queued job or a job whose lease expired
+        :param worker: str, the ID of the worker
+        :param lease: float, the lease in seconds
+        :return: tuple (job ID, kind, payload) or None if there is nothing to do
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            # jobs cancelled while their worker died are not picked up again
+            conn.execute("UPDATE queue SET status = 'cancelled' WHERE status = 'cancelling' AND lease_expires < ?",
+                         (now,))
+            row = conn.execute("SELECT id, kind, payload FROM queue "
+                               "WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                               "ORDER BY created LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE queue SET status = 'running', worker = ?, lease_expires = ?, heartbeat = ? "
+                             "WHERE id = ?", (worker, now + lease, now, row['id']))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row['id'], row['kind'], json.loads(row['payload'])
+
+    def heartbeat(self, job_id, worker, lease=60):
+        """
+        Renews the lease of a job
+        :return: bool, False if the worker lost the job to another worker
+        """
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            c = conn.execute("UPDATE queue SET lease_expires = ?, heartbeat = ? "
+                             "WHERE id = ? AND worker = ? AND status = 'running'", (now + lease, now, job_id, worker))
+            return c.rowcount == 1
+        finally:
+            conn.close()
+
+    def finish(self, job_id, worker, result=None, error=None):
+        """
+        Stores the result of a job
+        :param job_id: str, the job ID
+        :param worker: str, the ID of the worker, results of workers which lost their lease are discarded
+        :param result: dict, the result, needs to be JSON serializable
+        :param error: str, the error message if the job failed
+        :return: bool, True if the result was stored
+        """
+
+        status = 'failed' if error is not None else 'finished'
+        conn = self._connect()
+        try:
+            c = conn.execute("UPDATE queue SET status = CASE WHEN status = 'cancelling' THEN 'cancelled' ELSE ? END, "
+                             "result = ?, error = COALESCE(error, ?), lease_expires = NULL "
+                             "WHERE id = ? AND worker = ? AND status IN ('running', 'cancelling')",
+                             (status, json.dumps(result), error, job_id, worker))
+            return c.rowcount == 1
+        finally:
+            conn.close()
+
+    def cancel(self, job_id, reason='cancelled by user'):
+        """
+        Cancels a job, queued jobs are cancelled right away, running jobs are cancelled by their worker
+        :param job_id: str, the job ID
+        :param reason: str, why the job was cancelled
+        :return: str, the new status or None if the job is unknown or already done
+        """
+
+        conn = self._connect()
+        try:
+            c = conn.execute("UPDATE queue SET status = 'cancelled', error = ? WHERE id = ? AND status = 'queued'",
+                             (reason, job_id))
+            if c.rowcount == 1:
+                return 'cancelled'
+            c = conn.execute("UPDATE queue SET status = 'cancelling', error = ? WHERE id = ? AND status = 'running'",
+                             (reason, job_id))
+            if c.rowcount == 1:
+                return 'cancelling'
+        finally:
+            conn.close()
+        return None
+
+    def get(self, job_id):
+        """
+        Returns a job from the queue
+        :param job_id: str, the job ID
+        :return: dict or None, payload and result are decoded
+        """
+
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM queue WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        row = dict(row)
+        row['payload'] = json.loads(row['payload'])
+        row['result'] = json.loads(row['result']) if row['result'] else None
+        return row
+
+    def load_job(self, job_id, directory_results=None):
+        """
+        Returns a queued job as Job object
+        :param job_id: str, the job ID
+        :param directory_results: str, the result directory which relative output files are resolved against
+        :return: Job or None
+        """
+
+        row = self.get(job_id)
+        if row is None:
+            return None
+        job = Job(status=row['status'], error=row['status'] in ('failed', 'cancelled'),
+                  finished=row['status'] in ('finished', 'failed', 'cancelled'))
+        if row['status'] in ('cancelling', 'cancelled'):
+            job.cancel_reason = row['error']
+        result = row['result'] or {}
+        job.stdout_file = result.get('stdout_file')
+        if job.stdout_file is not None and directory_results is not None:
+            # absolute paths are kept by os.path.join
+            job.stdout_file = os.path.join(directory_results, job.stdout_file)
+        job.stderr = result.get('stderr') or row['error'] or ''
+        job.result = result
+        return job
+
+
+class Worker:
+    """
+    Runs jobs from a JobQueue
+    """
+
+    def __init__(self, queue, conf_file='blast.conf', worker_id=None, lease=60, poll_interval=1.0):
+        self.queue = queue
+        self.conf_file = conf_file
+        if worker_id is None:
+            worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:8])
+        self.worker_id = worker_id
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.current_job = None
+
+    def execute(self, kind, payload):
+        """
+        Runs a single job
+        :param kind: str, the kind of the job
+        :param payload: dict, the arguments of the job
+        :return: dict, the result
+        """
+
+        if kind in ('blast', 'blast_primers'):
+            job = BlastJob(conf_file=self.conf_file, result_db=self.queue.result_db, blast_db=payload.get('database'))
+            self.current_job = job
+            parameters = payload['parameters']
+            if kind == 'blast_primers':
+                parameters = job.set_arguments_for_primer_blast(parameters)
+            job.run(parameters=parameters)
+            if job.cancelled:
+                return {'stdout_file': None, 'stderr': job.stderr, 'error': True, 'cancel_reason': job.cancel_reason}
+            return {'stdout_file': self.result_path(job), 'stderr': job.stderr, 'error': job.error}
+        elif kind == 'design':
+            from PrimerDesigner.Primer import design_primers
+            primers = design_primers(payload['sequence'], payload['number_of_pairs'],
+                                     database=payload.get('database', 'nt'))
+            return {'primers': [str(primer) for primer in primers]}
+        raise ValueError('unknown job kind: {}'.format(kind))
+
+    @staticmethod
+    def result_path(job):
+        """
+        :param job: BlastJob, a finished job
+        :return: str, the output file relative to the result directory, absolute if it is outside of it
+        """
+
+        stdout_file = os.path.abspath(job.stdout_file)
+        relative = os.path.relpath(stdout_file, os.path.abspath(job.directory_results))
+        if relative.startswith(os.pardir):
+            return stdout_file
+        return relative
+
+    def _heartbeat(self, job_id, stop):
+        while not stop.wait(min(self.lease / 3, 5)):
+            try:
+                renewed = self.queue.heartbeat(job_id, self.worker_id, lease=self.lease)
+                row = None if renewed else self.queue.get(job_id)
+            except sqlite3.OperationalError as e:
+                # the database is busy, the lease is renewed with the next heartbeat
+                print('worker {} could not renew the lease for job {}: {}'.format(self.worker_id, job_id, e),
+                      file=sys.stderr)
+                continue
+            if not renewed:
+                if row is not None and row['status'] == 'cancelling':
+                    if self.current_job is not None:
+                        self.current_job.cancel(row['error'])
+                else:
+                    print('worker {} lost the lease for job {}'.format(self.worker_id, job_id), file=sys.stderr)
+                return
+
+    def run_once(self):
+        """
+        Claims and runs a single job
+        :return: bool, True if a job was run
+        """
+
+        claimed = self.queue.claim(self.worker_id, lease=self.lease)
+        if claimed is None:
+            return False
+        job_id, kind, payload = claimed
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop), daemon=True)
+        heartbeat.start()
+        try:
+            try:
+                result = self.execute(kind, payload)
+            except Exception as e:
+                self._finish(job_id, error='{}: {}'.format(type(e).__name__, e))
+            else:
+                self._finish(job_id, result=result)
+        finally:
+            stop.set()
+            heartbeat.join()
+            self.current_job = None
+        return True
+
+    def _finish(self, job_id, result=None, error=None, attempts=5):
+        """
+        Stores the result of a job, a busy database is retried with backoff
+        :return: bool, True if the result was stored
+        """
+
+        for attempt in range(attempts):
+            try:
+                return self.queue.finish(job_id, self.worker_id, result=result, error=error)
+            except sqlite3.OperationalError as e:
+                if attempt == attempts - 1:
+                    raise
+                print('worker {} could not store the result of job {}: {}'.format(self.worker_id, job_id, e),
+                      file=sys.stderr)
+                time.sleep(min(self.poll_interval * 2 ** attempt, MAX_BACKOFF))
+
+    def run(self, stop=None):
+        """
+        Runs jobs until stop is set
+        :param stop: threading.Event, runs forever if None
+        :return: None
+        """
+
+        if stop is None:
+            stop = threading.Event()
+        errors = 0
+        while not stop.is_set():
+            try:
+                ran = self.run_once()
+            except sqlite3.Error as e:
+                # e.g. 'database is locked' when many workers share the database, the worker keeps polling
+                errors += 1
+                print('worker {} could not access the queue: {}'.format(self.worker_id, e), file=sys.stderr)
+                stop.wait(min(self.poll_interval * 2 ** errors, MAX_BACKOFF))
+                continue
+            errors = 0
+            if not ran:
+                stop.wait(self.poll_interval)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Runs BLAST and design jobs from the shared job queue, workers on '
+                                                 'other machines need the result database and result_dir on a '
+                                                 'shared file system')
+    parser.add_argument('--result_db', type=str, default='blast_jobs.db', help='the SQLite database with the queue')
+    parser.add_argument('--conf', type=str, default='blast.conf', help='the configuration file')
+    parser.add_argument('--threads', type=int, default=1, help='number of jobs which are run in parallel')
+    parser.add_argument('--lease', type=float, default=60, help='lease of a claimed job in seconds')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds to wait if the queue is empty')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    queue = JobQueue(args.result_db)
+    threads = []
+    for _ in range(args.threads):
+        worker = Worker(queue, conf_file=args.conf, lease=args.lease, poll_interval=args.poll)
+        thread = threading.Thread(target=worker.run, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
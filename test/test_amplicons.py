@@ -0,0 +1,62 @@
+import unittest
+import io
+import random
+from PrimerDesigner import amplicons
+from PrimerDesigner import fm_index
+from PrimerDesigner.amplicons import PrimerHits, PLUS, MINUS
+
+
+class Amplicons(unittest.TestCase):
+
+    def test_from_blast(self):
+        output = io.StringIO('forward_0\tNR_1\t101\t120\tplus\t0.1\n'
+                             'reverse_0\tNR_1\t620\t601\tminus\t0.1\n'
+                             'reverse_0\tNR_2\t5\t24\tplus\t10\n')
+        hits = PrimerHits.from_blast(output, {'forward_0': 0, 'reverse_0': 1})
+        self.assertEqual(hits.subjects, ['NR_1', 'NR_2'])
+        self.assertEqual(list(hits.start), [100, 600, 4])
+        self.assertEqual(list(hits.end), [120, 620, 24])
+        self.assertEqual(list(hits.strand), [PLUS, MINUS, PLUS])
+        self.assertEqual(list(hits.primer), [0, 1, 1])
+        products = amplicons.predict_products(hits)
+        self.assertEqual(list(products.start), [100])
+        self.assertEqual(list(products.end), [620])
+        self.assertEqual(amplicons.off_target_products(hits, ['NR_1.1']), {})
+        self.assertEqual(amplicons.off_target_products(hits, ['NR_2']), {'NR_1': 1})
+
+    def test_from_fm_index(self):
+        self.assertEqual(amplicons.base_accession('NR_1.2'), 'NR_1')
+        self.assertEqual(amplicons.base_accession('chr1.part.3'), 'chr1.part')
+        self.assertEqual(amplicons.base_accession('scaffold.a'), 'scaffold.a')
+        hits = [fm_index.Hit('NR_1.1', 100, '+', 0), fm_index.Hit('NR_2.1', 5, '-', 1)]
+        self.assertEqual(PrimerHits.from_fm_index(hits, 20, 0).subjects, ['NR_1', 'NR_2'])
+        filtered = PrimerHits.from_fm_index(hits, 20, 0, subjects={'NR_2'})
+        self.assertEqual(filtered.subjects, ['NR_2'])
+        self.assertEqual(list(filtered.end), [25])
+
+    def test_predict_products(self):
+        rng = random.Random(1)
+        n = 2000
+        subjects = [rng.choice(['A', 'B', 'C']) for _ in range(n)]
+        start = [rng.randint(0, 20000) for _ in range(n)]
+        end = [s + 20 for s in start]
+        strand = [rng.choice([PLUS, MINUS]) for _ in range(n)]
+        primer = [rng.randint(0, 1) for _ in range(n)]
+        hits = PrimerHits.from_lists(subjects, start, end, strand, primer)
+        products = amplicons.predict_products(hits, max_size=500)
+        expected = sorted((subjects[i], start[i], end[j], primer[i], primer[j])
+                          for i in range(n) for j in range(n)
+                          if subjects[i] == subjects[j] and strand[i] == PLUS and strand[j] == MINUS and
+                          end[i] <= end[j] <= start[i] + 500)
+        found = sorted((hits.subjects[s], int(a), int(b), int(p), int(m))
+                       for s, a, b, p, m in zip(*products))
+        self.assertEqual(found, expected)
+
+    def test_empty(self):
+        hits = PrimerHits.from_lists([], [], [], [], [])
+        self.assertEqual(len(amplicons.predict_products(hits).start), 0)
+        self.assertEqual(amplicons.off_target_products(hits, []), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
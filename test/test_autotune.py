@@ -0,0 +1,59 @@
+import unittest
+import os
+import sqlite3
+from PrimerDesigner import autotune
+from PrimerDesigner import Job
+
+
+class Autotune(unittest.TestCase):
+
+    def setUp(self):
+        self.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_autotune.jobs.db')
+        try:
+            os.remove(self.result_db)
+        except FileNotFoundError:
+            pass
+
+    def tearDown(self):
+        try:
+            os.remove(self.result_db)
+        except FileNotFoundError:
+            pass
+
+    def test_choose(self):
+        tuner = autotune.Autotuner(result_db=self.result_db, min_samples=3)
+        self.assertIsNone(tuner.choose(1000, 100, ['megablast'], [1, 2, 4], load=0))
+        for seconds in (1.0, 1.2, 0.9):
+            tuner.record('db', 1000, 100, 'megablast', 1, seconds, load=0)
+            tuner.record('db', 1000, 100, 'megablast', 4, seconds / 3, load=0)
+            tuner.record('db', 1000, 100, 'blastn-short', 4, seconds / 2, load=0)
+        tuner.record('db', 1000, 100, 'megablast', 2, 0.01, load=0)
+        # two threads have too few samples, similar queries are used, different ones not
+        self.assertEqual(tuner.choose(1000, 120, ['megablast'], [1, 2, 4], load=0), ('megablast', 4))
+        self.assertEqual(tuner.choose(1000, 100, ['megablast', 'blastn-short'], [4], load=0), ('megablast', 4))
+        self.assertEqual(tuner.choose(1000, 100, ['blastn-short'], [1, 4], load=0), ('blastn-short', 4))
+        self.assertIsNone(tuner.choose(1000, 1000, ['megablast'], [1, 4], load=0))
+        self.assertIsNone(tuner.choose(10 ** 6, 100, ['megablast'], [1, 4], load=0))
+
+    def test_slowdown(self):
+        self.assertEqual(autotune.slowdown(0, 2, cpus=4), 1.0)
+        self.assertEqual(autotune.slowdown(6, 2, cpus=4), 2.0)
+
+    def test_blast_records_timings(self):
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = self.result_db
+        with open(os.path.join(os.getcwd(), 'data', 'random_sequence_0.fa'), 'r') as f:
+            seq = f.read()
+        job.run({'sequence': seq, 'num_threads': 1}, cache=False)
+        self.assertEqual(job.stderr, '')
+        conn = sqlite3.connect(self.result_db)
+        rows = conn.execute('SELECT task, num_threads, db_size FROM blast_timings').fetchall()
+        conn.close()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1], 1)
+        self.assertGreater(rows[0][2], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
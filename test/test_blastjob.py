@@ -73,6 +73,97 @@ class Blast(unittest.TestCase):
         self.assertEqual(job.stdout, '')
         self.assertNotEqual(job.stderr, '')
 
+    def test_iter_accessions(self):
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            seq = f.read().split('>')[1].split('\n', 1)[1].replace('\n', '')
+        records = list(job.iter_accessions(['NR_0', 'NR_1']))
+        self.assertEqual([r[0].split(' ')[0] for r in records], ['NR_0', 'NR_1'])
+        self.assertEqual(records[0][1], seq)
+        records = list(job.iter_accessions(['NR_0'], start=11, end=30))
+        self.assertEqual(records[0][1], seq[10:30])
+        records = list(job.iter_accessions(['NR_0'], start=11))
+        self.assertEqual(records[0][1], seq[10:])
+        self.assertRaises(ValueError, list, job.iter_accessions(['does_not_exist']))
+        self.assertRaises(ValueError, list, job.iter_accessions(['NR_0'], start=30, end=11))
+
+    def test_query_files(self):
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            seq = '>query\n' + f.read().split('>')[3].split('\n', 1)[1]
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_blast.jobs.db')
+        queries = set(os.listdir(job.directory_query))
+        job.run({'sequence': seq, 'num_threads': 1}, cache=False)
+        # the query is piped into blastn
+        self.assertEqual(job.get_hits(), ['NR_2'])
+        self.assertEqual(set(os.listdir(job.directory_query)), queries)
+        self.assertIn('NR_2', job.get_accession('NR_2'))
+
+        # queries which are written to files are removed with their job directory
+        directory = os.path.join(os.getcwd(), 'temp', 'job_tmp')
+        conf_file = os.path.join(os.getcwd(), 'temp', 'query_files.conf')
+        with open(conf_file, 'w') as f:
+            f.write('blast: {}\n'.format(job.blast_executable))
+            f.write('blast_dir: {}/\n'.format(os.path.join(os.getcwd(), 'data')))
+            f.write('query_stdin: false\n')
+            f.write('job_tmp_dir: {}\n'.format(directory))
+        try:
+            job = Job.BlastJob(conf_file=conf_file, blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+            job.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_blast.jobs.db')
+            job.run({'sequence': seq, 'num_threads': 1}, cache=False)
+            self.assertEqual(job.get_hits(), ['NR_2'])
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            os.remove(conf_file)
+            if os.path.isdir(directory):
+                os.rmdir(directory)
+
+    def test_restricted_blast(self):
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_blast.jobs.db')
+        seqidlist = job.compile_seqidlist(['NR_1', 'NR_0', 'NR_0'])
+        self.assertEqual(seqidlist, job.compile_seqidlist('NR_0;NR_1'))
+        self.assertNotEqual(seqidlist, job.compile_seqidlist(['NR_0']))
+        with open(seqidlist, 'r') as f:
+            self.assertEqual(f.read(), 'NR_0\nNR_1\n')
+        self.assertRaises(ValueError, job.compile_seqidlist, [])
+        self.assertRaises(ValueError, job.compile_taxidlist, ['human'])
+
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            seq = '>query\n' + f.read().split('>')[3].split('\n', 1)[1]
+        job.run({'sequence': seq, 'num_threads': 1})
+        run_hash = job.run_hash
+        self.assertEqual(job.get_hits(), ['NR_2'])
+        job.run({'sequence': seq, 'num_threads': 1, 'seqidlist': ['NR_0', 'NR_1']})
+        self.assertNotEqual(job.run_hash, run_hash)
+        self.assertEqual(job.get_hits(), [])
+
+    def test_tuned_task_cache(self):
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_blast.jobs.db')
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            seq = '>query\n' + f.read().split('>')[3].split('\n', 1)[1].replace('\n', '')[0:30]
+        tuner = Job.autotune.Autotuner(job.result_db)
+        for task, seconds in (('blastn-short', 0.1), ('megablast', 1)):
+            for _ in range(3):
+                tuner.record(job.blast_db, job.database_size(), 30, task, 1, seconds, load=0)
+        job.run({'sequence': seq, 'num_threads': 1})
+        run_hash = job.run_hash
+        # the tuned task changes, the blastn-short result is not reused for megablast
+        for _ in range(6):
+            tuner.record(job.blast_db, job.database_size(), 30, 'megablast', 1, 0.01, load=0)
+        job.run({'sequence': seq, 'num_threads': 1})
+        self.assertNotEqual(job.run_hash, run_hash)
+        run_hash = job.run_hash
+        stdout_file = job.stdout_file
+        job.run({'sequence': seq, 'num_threads': 1})
+        self.assertEqual(job.run_hash, run_hash)
+        self.assertEqual(job.stdout_file, stdout_file)
+
     def test_blast_cache(self):
         job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
                            blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
@@ -0,0 +1,63 @@
+import unittest
+import os
+import glob
+import random
+from PrimerDesigner import dedup
+from PrimerDesigner.tools import tools
+
+
+def mutate(seq, n, seed=1):
+    rnd = random.Random(seed)
+    seq = list(seq)
+    for _ in range(n):
+        i = rnd.randrange(len(seq))
+        seq[i] = rnd.choice('ACGT'.replace(seq[i], ''))
+    return ''.join(seq)
+
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+class Dedup(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta = os.path.join(os.getcwd(), 'temp', 'dedup.fa')
+        self.seq_1 = tools.random_sequence(2000)
+        self.seq_2 = tools.random_sequence(2000)
+        self.records = [('acc_1 isolate 1', self.seq_1),
+                        ('acc_2 isolate 2', self.seq_1),
+                        ('acc_3 strain 3', mutate(self.seq_1, 2)),
+                        ('acc_4 other', self.seq_2),
+                        ('acc_5 reverse', reverse_complement(self.seq_2)),
+                        ('acc_6 short', 'ACGT')]
+        with open(self.fasta, 'w') as f:
+            for header, seq in self.records:
+                f.write('>{}\n{}\n'.format(header, seq))
+
+    def tearDown(self):
+        for filename in glob.glob(self.fasta + '*'):
+            os.remove(filename)
+
+    def test_identical(self):
+        representatives, members = dedup.collapse(self.records)
+        self.assertEqual(len(representatives), 5)
+        self.assertEqual(members['acc_1'], ['acc_1', 'acc_2'])
+        self.assertEqual(dedup.expand(['acc_1', 'acc_4'], members), ['acc_1', 'acc_2', 'acc_4'])
+
+    def test_cluster(self):
+        representatives, members = dedup.collapse(self.records, threshold=0.8)
+        self.assertEqual(sorted(members['acc_1']), ['acc_1', 'acc_2', 'acc_3'])
+        self.assertEqual(sorted(members['acc_4']), ['acc_4', 'acc_5'])
+        self.assertEqual(members['acc_6'], ['acc_6'])
+        self.assertEqual(len(representatives), 3)
+
+    def test_collapse_fasta(self):
+        filename, members = dedup.collapse_fasta(self.fasta)
+        self.assertEqual([h.split(' ')[0] for h, _ in tools.iter_fasta(filename)],
+                         ['acc_1', 'acc_3', 'acc_4', 'acc_5', 'acc_6'])
+        self.assertEqual(dedup.collapse_fasta(self.fasta), (filename, members))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import os
+import glob
+from PrimerDesigner import fasta_headers
+from PrimerDesigner import fasta_to_sql
+from PrimerDesigner.tools import tools
+
+
+class FastaHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta = os.path.join(os.getcwd(), 'temp', 'headers.fa')
+        self.records = [('acc_{} description {}'.format(i, i), tools.random_sequence(10 + 37 * i)) for i in range(50)]
+        self.records.append(('no_description', 'ACGT'))
+        with open(self.fasta, 'w') as f:
+            for header, seq in self.records:
+                f.write('>{}\n'.format(header))
+                for i in range(0, len(seq), 60):
+                    f.write(seq[i:i + 60] + '\n')
+
+    def tearDown(self):
+        for filename in glob.glob(self.fasta + '*'):
+            os.remove(filename)
+
+    def test_records(self):
+        expected = list(fasta_headers.iter_records(self.fasta, processes=1, chunks=1))
+        self.assertEqual([r[0] for r in expected], [r[0] for r in self.records])
+        self.assertEqual([r[2] for r in expected], [len(r[1]) for r in self.records])
+        with open(self.fasta, 'rb') as f:
+            data = f.read()
+        for header, offset, _, _, _ in expected:
+            self.assertTrue(data[offset:].startswith('>{}\n'.format(header).encode('utf-8')))
+        for chunks in (2, 7, 200):
+            self.assertEqual(list(fasta_headers.iter_records(self.fasta, processes=2, chunks=chunks)), expected)
+
+    def test_extract(self):
+        outputs = {output: '{}.{}'.format(self.fasta, output) for output in fasta_headers.OUTPUTS}
+        self.assertEqual(fasta_headers.extract(self.fasta, outputs, processes=2, chunks=5), len(self.records))
+        with open(outputs['accessions'], 'r') as f:
+            self.assertEqual(f.read().splitlines(), [h.split(' ')[0] for h, _ in self.records])
+        with open(outputs['descriptions'], 'r') as f:
+            self.assertEqual(f.read().splitlines()[-2:], ['description 49', 'no_description'])
+        with open(outputs['headers'], 'r') as f:
+            self.assertEqual(f.read().splitlines(), ['>' + h for h, _ in self.records])
+        # the positions are the same as in the table written by fasta_to_csv
+        fasta_to_sql.fasta_to_csv(self.fasta, output_location=self.fasta + '.expected')
+        with open(outputs['csv'], 'r') as f, open(self.fasta + '.expected', 'r') as f_expected:
+            positions = [line.split('\t')[2:] for line in f]
+            positions_expected = [line.split('\t')[2:] for line in f_expected]
+        self.assertEqual(positions, positions_expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
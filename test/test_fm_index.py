@@ -0,0 +1,82 @@
+import unittest
+import os
+import random
+from PrimerDesigner import fm_index
+from PrimerDesigner.tools import tools
+
+
+class FmIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(os.getcwd(), 'temp', 'random.fa.fmi')
+        self.index = fm_index.FmIndex.build(os.path.join(os.getcwd(), 'data', 'random.fa'), self.filename)
+        self.records = list(tools.iter_fasta(os.path.join(os.getcwd(), 'data', 'random.fa')))
+
+    def tearDown(self):
+        self.index.close()
+        for filename in (self.filename, self.filename + '.names', fm_index.marker_filename(self.filename)):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def naive_hits(self, pattern, mismatches):
+        hits = []
+        for header, seq in self.records:
+            for strand, p in (('+', pattern), ('-', pattern.translate(str.maketrans('ACGT', 'TGCA'))[::-1])):
+                for i in range(len(seq) - len(p) + 1):
+                    mm = sum(1 for a, b in zip(seq[i:i + len(p)], p) if a != b)
+                    if mm <= mismatches:
+                        hits.append(fm_index.Hit(header.split(' ')[0], i, strand, mm))
+        hits.sort()
+        return hits
+
+    def test_exact_match(self):
+        name, seq = self.records[3]
+        primer = seq[100:120]
+        hits = self.index.locate(primer)
+        self.assertIn(fm_index.Hit(name.split(' ')[0], 100, '+', 0), hits)
+        self.assertEqual(hits, self.naive_hits(primer, 0))
+        self.assertEqual(self.index.count(primer), len(hits))
+
+    def test_frequent_pattern(self):
+        # short patterns match more positions than are resolved one by one
+        hits = self.index.locate('ACGT')
+        self.assertGreater(len(hits), fm_index._SMALL_INTERVAL)
+        self.assertEqual(hits, self.naive_hits('ACGT', 0))
+
+    def test_mismatches(self):
+        random.seed(1)
+        for _ in range(5):
+            name, seq = random.choice(self.records)
+            start = random.randint(0, len(seq) - 12)
+            primer = list(seq[start:start + 12])
+            primer[5] = 'A' if primer[5] != 'A' else 'C'
+            primer = ''.join(primer)
+            self.assertEqual(self.index.locate(primer, mismatches=1), self.naive_hits(primer, 1))
+
+    def test_reload(self):
+        index = fm_index.open_index(self.filename)
+        self.assertEqual(index.names, self.index.names)
+        self.assertIs(index, fm_index.open_index(self.filename))
+        # a rebuilt index replaces the loaded one, which is closed
+        fm_index.FmIndex.build(os.path.join(os.getcwd(), 'data', 'random.fa'), self.filename).close()
+        os.utime(self.filename, ns=(index.mtime + 1, index.mtime + 1))
+        reloaded = fm_index.open_index(self.filename)
+        self.assertIsNot(index, reloaded)
+        self.assertTrue(index._mm.closed)
+        self.assertEqual(reloaded.names, self.index.names)
+        self.assertIs(reloaded, fm_index.open_index(self.filename))
+
+    def test_index_status(self):
+        self.assertEqual(fm_index.index_status(self.filename, 'fingerprint'), 'stale')
+        fm_index.FmIndex.build(os.path.join(os.getcwd(), 'data', 'random.fa'), self.filename,
+                               fingerprint='fingerprint').close()
+        self.assertEqual(fm_index.index_status(self.filename, 'fingerprint'), 'current')
+        self.assertEqual(fm_index.index_status(self.filename, 'rebuilt'), 'stale')
+        self.assertEqual(fm_index.index_status(self.filename + '.missing', 'fingerprint'), 'missing')
+        self.assertEqual([f for f in os.listdir(os.path.dirname(self.filename)) if '.tmp' in f], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+import io
+import os
+import time
+from PrimerDesigner import Job
+from PrimerDesigner import hit_store
+from PrimerDesigner.hit_store import HitStore
+
+
+class HitStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_hit_store.jobs.db')
+        try:
+            os.remove(self.result_db)
+        except FileNotFoundError:
+            pass
+
+    def tearDown(self):
+        for filename in (self.result_db, os.path.join(os.getcwd(), 'temp', 'hit_store.conf')):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def test_tabular(self):
+        output = io.StringIO('# comment\n'
+                             'forward_0\tNR_1\t100.0\t20\t0\t0\t1\t20\t101\t120\t0.01\t40\n'
+                             'reverse_0\tNR_1\t95.0\t20\t1\t0\t1\t20\t620\t601\t0.1\t35\n')
+        hsps = list(hit_store.iter_hsps(output, '6'))
+        self.assertEqual(hsps[0], ('forward_0', 'NR_1', 1, 20, 101, 120, 1, 100.0, 0.01, 40.0))
+        self.assertEqual(hsps[1][6], -1)
+        output = io.StringIO('p,NR_2,5,24,minus\n')
+        self.assertEqual(list(hit_store.iter_hsps(output, '10 qseqid sacc sstart send sstrand')),
+                         [('p', 'NR_2', None, None, 5, 24, -1, None, None, None)])
+        output = io.StringIO('p\tNR_2\t100.0\t20\t0\t0\t1\t20\t120\t101\t0.01\t40\tplus\n')
+        self.assertEqual(list(hit_store.iter_hsps(output, '6 std sstrand')),
+                         [('p', 'NR_2', 1, 20, 120, 101, 1, 100.0, 0.01, 40.0)])
+        self.assertRaises(ValueError, hit_store.iter_hsps, output, '0')
+
+    def test_queries(self):
+        store = HitStore(self.result_db)
+        panel_1 = io.StringIO('forward_0\tNR_1\t100.0\t20\t0\t0\t1\t20\t101\t120\t0.01\t40\n'
+                              'reverse_0\tNR_1\t100.0\t20\t0\t0\t1\t20\t620\t601\t0.1\t40\n'
+                              'reverse_0\tNR_2\t100.0\t20\t0\t0\t1\t20\t620\t601\t1\t40\n')
+        panel_2 = io.StringIO('forward_0\tNR_2\t100.0\t20\t0\t0\t1\t20\t101\t120\t0.5\t40\n')
+        self.assertEqual(store.store('run_1', panel_1, '6', job='job_1'), 3)
+        self.assertEqual(store.store('run_2', panel_2, '6', job='job_2'), 1)
+        # runs are only stored once, further jobs are mapped to them
+        self.assertEqual(store.store('run_2', io.StringIO(''), '6', job='job_3'), 0)
+
+        self.assertEqual([h['query'] for h in store.hits(subject='NR_1')], ['forward_0', 'reverse_0'])
+        self.assertEqual(len(store.hits(jobs=['job_3'])), 1)
+        self.assertEqual(len(store.hits(jobs=['run_1'], max_evalue=0.1)), 2)
+        self.assertEqual([(q['run'], q['query']) for q in store.queries_hitting('NR_2')],
+                         [('run_2', 'forward_0'), ('run_1', 'reverse_0')])
+        top = store.top_subjects()
+        self.assertEqual([(t['subject'], t['queries']) for t in top], [('NR_1', 2), ('NR_2', 2)])
+        top = store.top_subjects(jobs=['job_1'], queries=['reverse_0'], limit=1)
+        self.assertEqual([(t['subject'], t['hsps']) for t in top], [('NR_1', 1)])
+
+    def test_prune(self):
+        store = HitStore(self.result_db)
+        store.store('run_1', io.StringIO('forward_0\tNR_1\t100.0\t20\t0\t0\t1\t20\t101\t120\t0.01\t40\n'), '6',
+                    job='job_1')
+        time.sleep(0.1)
+        store.store('run_2', io.StringIO('forward_0\tNR_2\t100.0\t20\t0\t0\t1\t20\t101\t120\t0.5\t40\n'), '6',
+                    job='job_2')
+        self.assertEqual(store.prune(0.05), 1)
+        self.assertEqual([h['run'] for h in store.hits()], ['run_2'])
+        self.assertEqual(store.hits(jobs=['job_1']), [])
+        self.assertEqual(store.prune(3600), 0)
+
+    def test_blast_job(self):
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            seq = '>query\n' + f.read().split('>')[3].split('\n', 1)[1]
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                           blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = self.result_db
+        job.run({'sequence': seq, 'num_threads': 1, 'job_id': 'unstored_job'}, cache=False)
+        # the hit store is disabled by default
+        self.assertEqual(HitStore(self.result_db).hits(jobs=['unstored_job']), [])
+
+        conf_file = os.path.join(os.getcwd(), 'temp', 'hit_store.conf')
+        with open(os.path.join(os.getcwd(), 'data', 'blast.conf'), 'r') as f:
+            conf = f.read()
+        with open(conf_file, 'w') as f:
+            f.write(conf + 'hit_store: true\n')
+        job = Job.BlastJob(conf_file=conf_file, blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        job.result_db = self.result_db
+        job.run({'sequence': seq, 'num_threads': 1, 'job_id': 'stored_job'})
+        hits = HitStore(self.result_db).hits(jobs=['stored_job'])
+        self.assertEqual([(h['query'], h['subject'], h['strand']) for h in hits], [('query', 'NR_2', 1)])
+        self.assertEqual(hits[0]['identity'], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import shutil
+import time
+from PrimerDesigner import hitset_cache
+from PrimerDesigner import Primer
+from PrimerDesigner.Job import BlastJob
+
+
+class HitSetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'temp', 'hitsets')
+        self.cache = hitset_cache.HitSetCache(self.directory, max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_key(self):
+        key = self.cache.key('>seq_1\nacgt\nACGT', {'word_size': 11}, 'abc')
+        self.assertEqual(key, self.cache.key('ACGTACGT', {'word_size': 11}, 'abc'))
+        self.assertNotEqual(key, self.cache.key('ACGTACGT', {'word_size': 7}, 'abc'))
+        self.assertNotEqual(key, self.cache.key('ACGTACGT', {'word_size': 11}, 'abd'))
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('key_1'))
+        self.cache.put('key_1', ['acc_1', 'acc_2'], '>acc_1\nACGT\n>acc_2\nACGT\n')
+        accessions, filename = self.cache.get('key_1')
+        self.assertEqual(accessions, ['acc_1', 'acc_2'])
+        with open(filename, 'r') as f:
+            self.assertTrue(f.read().startswith('>acc_1'))
+
+    def test_evict(self):
+        self.cache.put('key_1', ['acc_1'], '>acc_1\n' + 'A' * 60)
+        time.sleep(0.01)
+        self.cache.put('key_2', ['acc_2'], '>acc_2\n' + 'A' * 60)
+        self.assertIsNone(self.cache.get('key_1'))
+        self.assertIsNotNone(self.cache.get('key_2'))
+
+    def test_fingerprint(self):
+        blast_db = os.path.join(os.getcwd(), 'data', 'random2.fa')
+        fingerprint = hitset_cache.database_fingerprint(blast_db)
+        self.assertEqual(fingerprint, hitset_cache.database_fingerprint(blast_db))
+        self.assertNotEqual(fingerprint, hitset_cache.database_fingerprint(os.path.join(os.getcwd(), 'data', 'random.fa')))
+
+    def test_rebuilt_database(self):
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        blast_db = os.path.join(self.directory, 'rebuilt.fa')
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(os.getcwd(), 'data', 'random.fa'), 'r') as f:
+            database = f.read()
+        with open(blast_db, 'w') as f:
+            f.write(database)
+        record = SeqRecord(Seq(database.split('>')[3].split('\n', 1)[1].replace('\n', '')), id='target', description='')
+        blast = BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'), blast_db=blast_db)
+        blast.result_db = os.path.join(self.directory, 'blast_jobs.db')
+        self.assertEqual(Primer.get_hit_set(blast, record)[0], ['NR_2'])
+
+        # the rebuilt database renames the hit, neither the BLAST result nor the hit set may be reused
+        with open(blast_db, 'w') as f:
+            f.write(database.replace('>NR_2', '>NR_20'))
+        blast = BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'), blast_db=blast_db)
+        blast.result_db = os.path.join(self.directory, 'blast_jobs.db')
+        accessions, filename = Primer.get_hit_set(blast, record)
+        self.assertEqual(accessions, ['NR_20'])
+        with open(filename, 'r') as f:
+            self.assertTrue(f.read().startswith('>NR_20'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import os
+import gzip
+import glob
+import shutil
+from PrimerDesigner import indexed_fasta
+from PrimerDesigner.tools import tools
+
+
+class IndexedFasta(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta = os.path.join(os.getcwd(), 'temp', 'indexed.fa')
+        self.records = [('seq_1', tools.random_sequence(1001)),
+                        ('seq_2', 'GGGG'),
+                        ('seq_3', tools.random_sequence(5000))]
+        with open(self.fasta, 'w') as f:
+            for name, seq in self.records:
+                f.write('>{} description\n'.format(name))
+                for i in range(0, len(seq), 60):
+                    f.write(seq[i:i + 60] + '\n')
+        self.bgzf = indexed_fasta.write_bgzf(self.fasta, self.fasta + '.bgz', block_size=1000)
+        self.gzip = self.fasta + '.gz'
+        with open(self.fasta, 'rb') as f_in, gzip.open(self.gzip, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    def tearDown(self):
+        for filename in glob.glob(self.fasta + '*'):
+            os.remove(filename)
+
+    def test_iter_fasta(self):
+        for filename in (self.fasta, self.gzip, self.bgzf):
+            records = [(header.split(' ')[0], seq) for header, seq in tools.iter_fasta(filename)]
+            self.assertEqual(records, self.records)
+
+    def test_fetch(self):
+        for filename in (self.fasta, self.bgzf):
+            with indexed_fasta.IndexedFasta(filename) as fasta:
+                self.assertEqual(fasta.names, [name for name, _ in self.records])
+                for name, seq in self.records:
+                    self.assertEqual(fasta.length(name), len(seq))
+                    self.assertEqual(fasta.fetch(name), seq)
+                self.assertEqual(fasta.fetch('seq_3', 59, 3021), self.records[2][1][58:3021])
+                self.assertEqual(fasta.fetch('seq_3', 4990), self.records[2][1][4989:])
+                self.assertRaises(KeyError, fasta.fetch, 'seq_4')
+        self.assertTrue(os.path.isfile(self.bgzf + '.gzi'))
+        self.assertEqual(indexed_fasta.read_gzi(self.bgzf + '.gzi'), indexed_fasta.build_gzi(self.bgzf))
+
+    def test_plain_gzip(self):
+        self.assertRaises(ValueError, indexed_fasta.IndexedFasta, self.gzip)
+
+
+if __name__ == '__main__':
+    unittest.main()
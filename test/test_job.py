@@ -1,4 +1,7 @@
 import unittest
+import sys
+import threading
+import time
 import PrimerDesigner
 
 class Job(unittest.TestCase):
@@ -13,6 +16,40 @@ class Job(unittest.TestCase):
         self.assertEqual(job.stdout, '')
         self.assertEqual(job.stderr, '')
 
+    def test_timeout(self):
+        job = PrimerDesigner.Job.Job()
+        t0 = time.time()
+        job.run_processes([['sleep', '10']], [None], timeout=0.5)
+        self.assertLess(time.time() - t0, 5)
+        self.assertTrue(job.cancelled)
+        self.assertIn('timeout', job.cancel_reason)
+
+    def test_cancel(self):
+        job = PrimerDesigner.Job.Job()
+        threading.Timer(0.5, job.cancel, args=('duplicate job',)).start()
+        t0 = time.time()
+        job.run_processes([['sleep', '10'], ['sleep', '10']], [None, None])
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(job.cancel_reason, 'duplicate job')
+
+    def test_signals(self):
+        job = PrimerDesigner.Job.Job()
+        stderr = job.run_processes([['sh', '-c', 'kill -9 $$']], [None], cpu_timeout=10)
+        # a kill from outside is not mistaken for the CPU limit
+        self.assertFalse(job.cancelled)
+        self.assertIn('terminated by signal SIGKILL', stderr)
+
+        job = PrimerDesigner.Job.Job()
+        job.run_processes([[sys.executable, '-c', 'while True: pass']], [None], timeout=30, cpu_timeout=1)
+        self.assertTrue(job.cancelled)
+        self.assertIn('CPU time limit', job.cancel_reason)
+
+    def test_cancel_finished(self):
+        job = PrimerDesigner.Job.Job(status='finished', finished=True)
+        self.assertFalse(job.cancel())
+        self.assertFalse(job.cancelled)
+        self.assertEqual(job.status, 'finished')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import os
+from PrimerDesigner.Job import Job
+from PrimerDesigner.job_registry import JobRegistry
+
+
+class Registry(unittest.TestCase):
+
+    def setUp(self):
+        self.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_registry.jobs.db')
+        self.registry = JobRegistry(self.result_db, max_jobs=2, max_bytes=1000, max_age=3600)
+
+    def tearDown(self):
+        try:
+            os.remove(self.result_db)
+        except FileNotFoundError:
+            pass
+
+    def test_evict_by_count(self):
+        running = Job(status='running')
+        self.registry['job_0'] = running
+        for i in range(1, 4):
+            job = Job(status='finished', finished=True)
+            job.stdout = 'output {}'.format(i)
+            self.registry['job_{}'.format(i)] = job
+        # running jobs are never evicted
+        self.assertIn('job_0', self.registry)
+        self.assertNotIn('job_1', self.registry)
+        self.assertNotIn('job_2', self.registry)
+        self.assertIn('job_3', self.registry)
+        job = self.registry.get('job_1')
+        self.assertTrue(job.finished)
+        self.assertEqual(job.stdout, 'output 1')
+        self.assertIsNone(self.registry.get('job_4'))
+
+    def test_evict_by_bytes(self):
+        job = Job(status='finished', finished=True)
+        job.stdout_file = os.path.join(os.getcwd(), 'data', 'random.fa')
+        job.stderr = 'e' * 2000
+        self.registry['job_1'] = job
+        self.assertNotIn('job_1', self.registry)
+        loaded = self.registry['job_1']
+        self.assertEqual(loaded.stdout_file, job.stdout_file)
+        self.assertEqual(loaded.stderr, job.stderr)
+
+    def test_evict_by_age(self):
+        self.registry.max_age = -1
+        self.registry['job_1'] = Job(status='cancelled', error=True, finished=True)
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(self.registry['job_1'].status, 'cancelled')
+
+
+if __name__ == '__main__':
+    unittest.main()
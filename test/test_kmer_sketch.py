@@ -0,0 +1,63 @@
+import unittest
+import os
+import shutil
+import collections
+from PrimerDesigner import kmer_sketch
+from PrimerDesigner import Job
+from PrimerDesigner.Primer import PrimerPair
+from PrimerDesigner.tools import tools
+
+
+class KmerSketch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'temp', 'kmer_sketch')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_encode(self):
+        self.assertEqual(kmer_sketch.encode('ACGTT'), kmer_sketch.encode('AACGT'))
+        self.assertIsNone(kmer_sketch.encode('ACGNT'))
+        self.assertEqual(list(kmer_sketch.canonical_kmers('AACGTNACGTT', 5)),
+                         [kmer_sketch.encode('AACGT'), kmer_sketch.encode('ACGTT')])
+
+    def test_counts(self):
+        sequences = [tools.random_sequence(500) for _ in range(5)]
+        repeat = 'GATTACAGATTA'
+        sequences.append(repeat * 20)
+        exact = collections.Counter()
+        for seq in sequences:
+            for i in range(len(seq) - 11):
+                exact[kmer_sketch.encode(seq[i:i + 12])] += 1
+        filename = os.path.join(self.directory, 'db.k12.cms')
+        sketch = kmer_sketch.build(sequences, filename, k=12, width=2 ** 12, depth=4, chunk_size=100)
+        self.assertEqual(sketch.total, sum(exact.values()))
+        for seq in sequences[:2]:
+            for i in range(0, len(seq) - 11, 7):
+                # counts are never underestimated
+                self.assertGreaterEqual(sketch.count(seq[i:i + 12]), exact[kmer_sketch.encode(seq[i:i + 12])])
+        self.assertGreaterEqual(sketch.count(repeat), 20)
+        pair = PrimerPair()
+        pair.forward.seq = 'TTTTTT' + repeat
+        pair.reverse.seq = sequences[0][:20]
+        self.assertFalse(sketch.accepts(pair, max_count=10))
+        pair.forward.seq = sequences[1][:20]
+        self.assertTrue(sketch.accepts(pair, max_count=10))
+
+    def test_load(self):
+        database = os.path.join(self.directory, 'db.fa')
+        shutil.copy(os.path.join(os.getcwd(), 'data', 'random.fa'), database)
+        job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'), blast_db=database)
+        self.assertIsNone(kmer_sketch.load(database, k=11))
+        sketch = job.build_kmer_sketch(k=11, width=2 ** 12)
+        self.assertGreater(sketch.total, 0)
+        self.assertEqual(kmer_sketch.load(database, k=11).total, sketch.total)
+        with open(database, 'a') as f:
+            f.write('>new\nACGT\n')
+        self.assertIsNone(kmer_sketch.load(database, k=11))
+
+
+if __name__ == '__main__':
+    unittest.main()
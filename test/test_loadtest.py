@@ -0,0 +1,38 @@
+import unittest
+import os
+import shutil
+import tempfile
+import subprocess
+from PrimerDesigner import loadtest
+
+
+class LoadTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([3], 95), 3)
+
+    def test_stub_blastdbcmd(self):
+        directory = tempfile.mkdtemp(prefix='primer_designer_test_')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        loadtest.install_stubs(directory, sequence_length=100)
+        output = subprocess.check_output([os.path.join(directory, 'bin', 'blastdbcmd'), '-db', 'nt',
+                                          '-entry', 'STUB_1', '-range', '11-20']).decode('utf-8')
+        self.assertEqual(output.splitlines()[0], '>STUB_1 stub sequence')
+        self.assertEqual(len(output.splitlines()[1]), 10)
+
+    def test_run_load_test(self):
+        cwd = os.getcwd()
+        results = loadtest.run_load_test(scenarios=['blast_roundtrip', 'nucleotide'], concurrency=[1, 2], requests=2,
+                                         latency=0)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual(result['errors'], 0)
+            self.assertLessEqual(result['p50'], result['p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import os
+import glob
+import shutil
+from PrimerDesigner import Job
+from PrimerDesigner import megablast_index
+
+
+class MegablastIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta = os.path.join(os.getcwd(), 'temp', 'mbindex.fa')
+        shutil.copy(os.path.join(os.getcwd(), 'data', 'random.fa'), self.fasta)
+        self.job = Job.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'),
+                                blast_db=os.path.join(os.getcwd(), 'data', 'random.fa'))
+        self.database = self.job.fasta_to_blast_db(self.fasta, database=os.path.join(os.getcwd(), 'temp', 'mbindex'))
+        self.job.set_database(self.database)
+
+    def tearDown(self):
+        for filename in glob.glob(os.path.join(os.getcwd(), 'temp', 'mbindex*')):
+            os.remove(filename)
+
+    def test_lifecycle(self):
+        self.assertEqual(megablast_index.index_status(self.database), 'missing')
+        self.assertGreater(len(self.job.build_megablast_index()), 0)
+        self.assertEqual(megablast_index.index_status(self.database), 'current')
+        # rebuilding the database invalidates the index
+        with open(self.fasta, 'a') as f:
+            f.write('>extra\nACGTACGTACGTACGTACGT\n')
+        self.job._make_blast_db(self.fasta, self.database)
+        self.assertEqual(megablast_index.index_status(self.database), 'stale')
+        self.job.fasta_to_blast_db(self.fasta, database=self.database)
+        self.assertEqual(megablast_index.index_status(self.database), 'missing')
+        self.job.fasta_to_blast_db(self.fasta, database=self.database, build_index=True)
+        self.assertEqual(megablast_index.index_status(self.database), 'current')
+
+    def test_eligible(self):
+        self.assertTrue(megablast_index.is_eligible({}))
+        self.assertFalse(megablast_index.is_eligible({'word_size': 11}))
+        self.assertFalse(megablast_index.is_eligible({'use_index': 'false'}))
+        self.assertFalse(megablast_index.is_eligible({'task': 'blastn'}))
+
+    def test_run_uses_index(self):
+        self.job.result_db = os.path.join(os.getcwd(), 'temp', 'mbindex.jobs.db')
+        with open(os.path.join(os.getcwd(), 'data', 'random_sequence_0.fa'), 'r') as f:
+            seq = f.read()
+        self.assertFalse(self.job._use_megablast_index({}, ['blastn']))
+        self.job.build_megablast_index()
+        self.assertTrue(self.job._use_megablast_index({}, ['blastn']))
+        self.assertFalse(self.job._use_megablast_index({}, ['blastn', '-task', 'blastn-short']))
+        self.job.run({'sequence': seq, 'num_threads': 1}, cache=False)
+        self.assertEqual(self.job.stderr, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
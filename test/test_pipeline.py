@@ -0,0 +1,66 @@
+import unittest
+import time
+import threading
+from PrimerDesigner.pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stages(self):
+        def square(x):
+            yield x * x
+
+        def odd(x):
+            if x % 2 == 1:
+                yield x
+
+        pipeline = Pipeline(queue_size=2).add_stage(square, workers=3).add_stage(odd, workers=2)
+        self.assertEqual(sorted(pipeline.run(range(10))), [1, 9, 25, 49, 81])
+
+    def test_stages_overlap(self):
+        active = []
+        overlapped = threading.Event()
+
+        def slow(x):
+            active.append(x)
+            time.sleep(0.05)
+            yield x
+
+        def check(x):
+            # the first stage is still working on later items
+            if len(active) < 5:
+                overlapped.set()
+            yield x
+
+        Pipeline(queue_size=1).add_stage(slow).add_stage(check).run(range(5))
+        self.assertTrue(overlapped.is_set())
+
+    def test_stop(self):
+        pipeline = Pipeline(queue_size=1)
+        passed = []
+
+        def first(x):
+            if x >= 3:
+                pipeline.stop(0)
+            else:
+                yield x
+
+        def second(x):
+            passed.append(x)
+            yield x
+
+        results = pipeline.add_stage(first).add_stage(second).run(iter(range(10 ** 6)))
+        self.assertEqual(results, [0, 1, 2])
+        self.assertEqual(passed, [0, 1, 2])
+
+    def test_error(self):
+        def fail(x):
+            raise ValueError('bad item {}'.format(x))
+            yield x
+
+        self.assertRaises(RuntimeError, Pipeline().add_stage(fail, workers=2).run, range(3))
+        self.assertRaises(ValueError, Pipeline().add_stage, fail, workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import os
+import shutil
+import tempfile
+from PrimerDesigner import prewarm
+from PrimerDesigner import config
+
+
+class Prewarm(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='primer_designer_test_')
+        with open(os.path.join(self.directory, 'blast.conf'), 'w') as f:
+            f.write('blast: {}\n'.format(os.path.abspath(os.path.join(self.cwd, '..', 'bin', 'ncbi-blast-2.7.1+',
+                                                                      'bin', 'blastn'))))
+            f.write('blast_dir: {}/\n'.format(self.directory))
+            f.write('cache_dir: {}\n'.format(os.path.join(self.directory, 'cache')))
+        shutil.copy(os.path.join(self.cwd, 'data', 'random.fa'), os.path.join(self.directory, 'random.fa'))
+        with open(os.path.join(self.cwd, 'data', 'random.fa'), 'r') as f:
+            records = f.read().split('>')
+        with open(os.path.join(self.directory, 'panel.fa'), 'w') as f:
+            for i in (3, 4):
+                f.write('>target_{}\n{}'.format(i, records[i].split('\n', 1)[1]))
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        config.reload_settings()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_prewarm(self):
+        report = prewarm.prewarm('panel.fa', ['random.fa'], workers=2, fm_index=True)
+        self.assertEqual([(e['target'], e['step']) for e in report],
+                         [(None, 'fm_index'), ('target_3', 'hit_set'), ('target_3', 'dedup'), ('target_3', '2bit'),
+                          ('target_4', 'hit_set'), ('target_4', 'dedup'), ('target_4', '2bit')])
+        self.assertEqual(set(e['status'] for e in report), {prewarm.WARMED})
+
+        # the second run only finds cached entries
+        report = prewarm.prewarm('panel.fa', ['random.fa'], workers=2, fm_index=True)
+        self.assertEqual(set(e['status'] for e in report), {prewarm.CACHED})
+        self.assertTrue(prewarm.format_report(report, seconds=1).endswith('0 warmed, 7 already cached, 0 failed '
+                                                                          'in 1.00 s'))
+
+        # after a database update the hit sets are searched again instead of reusing the old BLAST output
+        with open('random.fa', 'r') as f:
+            database = f.read()
+        with open('random.fa', 'w') as f:
+            f.write(database.replace('>NR_2', '>NR_20'))
+        report = prewarm.prewarm('panel.fa', ['random.fa'], workers=2, fm_index=True)
+        self.assertEqual([e['status'] for e in report if e['step'] in ('fm_index', 'hit_set')], [prewarm.WARMED] * 3)
+        self.assertEqual([e['status'] for e in report if e['target'] == 'target_3'], [prewarm.WARMED] * 3)
+        cache_directory = os.path.join(self.directory, 'cache', 'hitsets')
+        hit_sets = [f for f in os.listdir(cache_directory) if f.endswith('.fa') and '.dedup' not in f]
+        hit_fasta = ''
+        for filename in hit_sets:
+            with open(os.path.join(cache_directory, filename), 'r') as f:
+                hit_fasta += f.read()
+        self.assertIn('>NR_20', hit_fasta)
+        with open('random.fa.fmi.names', 'r') as f:
+            self.assertIn('NR_20\t', f.read())
+
+        report = prewarm.prewarm('panel.fa', ['does_not_exist'], workers=1)
+        self.assertEqual([e['status'] for e in report], [prewarm.FAILED, prewarm.FAILED])
+        self.assertIn('error', report[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,12 @@ class DesignPrimers(unittest.TestCase):
         print(p)
         self.assertEqual(len(p), 5)
 
+    def test_invalid_specificity(self):
+        target = '>target\n' + 'ACGT' * 50
+        self.assertRaises(ValueError, design_primers, target, 5, specificity='primer3')
+        # the FM-index cannot be restricted to taxa
+        self.assertRaises(ValueError, design_primers, target, 5, specificity='fm_index', taxids=[9606])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import os
+import shutil
+import tempfile
+import sqlite3
+import threading
+import time
+from PrimerDesigner import ServerPrimerDesigner
+from PrimerDesigner import worker
+from PrimerDesigner.tools import tools
+
+
+class SharedServer(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='primer_designer_test_')
+        with open(os.path.join(self.directory, 'blast.conf'), 'w') as f:
+            f.write('blast: {}\n'.format(os.path.abspath(os.path.join(self.cwd, '..', 'bin', 'ncbi-blast-2.7.1+',
+                                                                      'bin', 'blastn'))))
+            f.write('blast_dir: {}/\n'.format(self.directory))
+            f.write('cache_dir: {}\n'.format(os.path.join(self.directory, 'cache')))
+            f.write('queue_wait_timeout: 0.5\n')
+        # the REST API searches the default database
+        shutil.copy(os.path.join(self.cwd, 'data', 'random.fa'), os.path.join(self.directory, 'nt'))
+        with open(os.path.join(self.cwd, 'data', 'random.fa'), 'r') as f:
+            self.sequence = '>query\n' + f.read().split('>')[3].split('\n', 1)[1]
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_shared_state(self):
+        # two apps stand in for two worker processes of a pre-fork server
+        client_1 = ServerPrimerDesigner.create_app(shared=True, worker_threads=0).test_client()
+        client_2 = ServerPrimerDesigner.create_app(shared=True, worker_threads=0).test_client()
+        conn = sqlite3.connect('blast_jobs.db')
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        conn.close()
+
+        job_id = client_1.post('/blast/', json={'sequence': self.sequence}).get_json()
+        self.assertEqual(client_2.get('/blast/{}'.format(job_id)).get_json(), '')
+        self.assertTrue(worker.Worker(worker.JobQueue('blast_jobs.db')).run_once())
+        self.assertIn('NR_2', client_2.get('/blast/{}'.format(job_id)).get_json())
+        self.assertEqual(client_1.get('/blast/hits/{}'.format(job_id)).get_json(), ['NR_2'])
+
+    def test_etags(self):
+        client = ServerPrimerDesigner.create_app(shared=True, worker_threads=0).test_client()
+        job_id = client.post('/blast/', json={'sequence': self.sequence}).get_json()
+        response = client.get('/blast/{}'.format(job_id))
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', response.headers)
+        worker.Worker(worker.JobQueue('blast_jobs.db')).run_once()
+
+        for url in ('/blast/{}'.format(job_id), '/blast/hits/{}'.format(job_id)):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(client.get(url, headers={'If-None-Match': '"other"'}).status_code, 200)
+        self.assertNotEqual(client.get('/blast/{}'.format(job_id)).headers['ETag'],
+                            client.get('/blast/hits/{}'.format(job_id)).headers['ETag'])
+
+        response = client.get('/nucleotide/NR_2')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertEqual(client.get('/nucleotide/NR_2', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertNotEqual(client.get('/nucleotide/NR_1').headers['ETag'], etag)
+        compressed = client.get('/nucleotide/NR_2?start=1&end=50', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotEqual(compressed.headers['ETag'], client.get('/nucleotide/NR_2?start=1&end=50').headers['ETag'])
+        self.assertNotEqual(compressed.headers['ETag'], etag)
+        self.assertEqual(client.get('/nucleotide/NR_2?start=1&end=50',
+                                    headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': compressed.headers['ETag']}).status_code, 304)
+
+        # a rebuilt database invalidates the sequences
+        os.utime('nt', ns=(0, 0))
+        self.assertEqual(client.get('/nucleotide/NR_2', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_delete_finished(self):
+        tools.create_empty_database()
+        client = ServerPrimerDesigner.create_app().test_client()
+        job_id = client.post('/blast/', json={'sequence': self.sequence}).get_json()
+        ServerPrimerDesigner.jobs[job_id].future.result()
+        response = client.delete('/blast/{}'.format(job_id))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['status'], 'finished')
+        conn = sqlite3.connect('blast_jobs.db')
+        self.assertNotEqual(conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id, )).fetchone()[0],
+                            'cancelled')
+        conn.close()
+        self.assertEqual(client.delete('/blast/unknown').status_code, 404)
+
+    def test_queued_design(self):
+        client = ServerPrimerDesigner.create_app(shared=True, worker_threads=0).test_client()
+        # without a worker the request gives up after queue_wait_timeout and cancels its job
+        response = client.post('/design/', json={'sequence': self.sequence})
+        self.assertEqual(response.status_code, 504)
+        self.assertTrue(response.get_json()['error'])
+        queue = worker.JobQueue('blast_jobs.db')
+        self.assertIsNone(queue.claim('test'))
+
+        errors = []
+
+        def design():
+            try:
+                ServerPrimerDesigner.RestDesignPrimers.design_primers_queued(
+                    {'sequence': self.sequence, 'number_of_pairs': 1}, poll_interval=0.01, timeout=10)
+            except ServerPrimerDesigner.QueueWaitError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=design)
+        thread.start()
+        while thread.is_alive():
+            conn = sqlite3.connect('blast_jobs.db')
+            rows = conn.execute("SELECT id FROM queue WHERE status = 'queued'").fetchall()
+            conn.close()
+            if len(rows) > 0:
+                queue.cancel(rows[0][0])
+                break
+            time.sleep(0.01)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([e.status_code for e in errors], [409])
+
+
+if __name__ == '__main__':
+    unittest.main()
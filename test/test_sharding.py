@@ -0,0 +1,131 @@
+import unittest
+import os
+import io
+import glob
+from PrimerDesigner import sharding
+from PrimerDesigner.tools import tools
+
+
+def blast_xml(hits, db_len):
+    hits_xml = ''
+    for h, (accession, evalue) in enumerate(hits):
+        hits_xml += ('<Hit><Hit_num>{}</Hit_num><Hit_accession>{}</Hit_accession><Hit_hsps><Hsp>'
+                     '<Hsp_bit-score>10</Hsp_bit-score><Hsp_evalue>{}</Hsp_evalue>'
+                     '</Hsp></Hit_hsps></Hit>').format(h + 1, accession, evalue)
+    return ('<?xml version="1.0"?>\n<BlastOutput><BlastOutput_program>blastn</BlastOutput_program>'
+            '<BlastOutput_iterations><Iteration>'
+            '<Iteration_hits>{}</Iteration_hits><Iteration_stat><Statistics><Statistics_db-num>1</Statistics_db-num>'
+            '<Statistics_db-len>{}</Statistics_db-len></Statistics></Iteration_stat>'
+            '</Iteration></BlastOutput_iterations></BlastOutput>').format(hits_xml, db_len)
+
+
+def blast_tabular(queries, database, fields='query acc., subject acc., evalue'):
+    """
+    :param queries: list of tuples (query, list of hit lines), written like blastn -outfmt 7
+    """
+
+    text = ''
+    for query, lines in queries:
+        text += '# BLASTN 2.7.1+\n# Query: {}\n# Database: {}\n'.format(query, database)
+        if len(lines) > 0:
+            text += '# Fields: {}\n'.format(fields)
+        text += '# {} hits found\n'.format(len(lines))
+        text += ''.join(line + '\n' for line in lines)
+    return text + '# BLAST processed {} queries\n'.format(len(queries))
+
+
+class Sharding(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = os.path.join(os.getcwd(), 'temp', 'shard_test')
+
+    def tearDown(self):
+        for filename in glob.glob(self.prefix + '*'):
+            os.remove(filename)
+
+    def test_split_fasta(self):
+        fasta = os.path.join(os.getcwd(), 'data', 'random.fa')
+        filenames, length, number_of_sequences = sharding.split_fasta(fasta, self.prefix, 3)
+        records = list(tools.iter_fasta(fasta))
+        self.assertEqual(number_of_sequences, len(records))
+        self.assertEqual(length, sum(len(seq) for _, seq in records))
+        shard_records = []
+        for filename in filenames:
+            shard_records.extend(tools.iter_fasta(filename))
+        self.assertEqual(sorted(shard_records), sorted(records))
+
+    def test_merge_xml(self):
+        filenames = []
+        for i, hits in enumerate(([('acc_1', 1e-5), ('acc_2', 1e-1)], [('acc_3', 1e-10)])):
+            filenames.append('{}.{}.xml'.format(self.prefix, i))
+            with open(filenames[-1], 'w') as f:
+                f.write(blast_xml(hits, 100))
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '5')
+        self.assertEqual(tools_hits(output.getvalue()), ['acc_3', 'acc_1', 'acc_2'])
+        self.assertIn(b'<Statistics_db-len>200</Statistics_db-len>', output.getvalue())
+        self.assertEqual(output.getvalue().count(b'<BlastOutput_program>blastn</BlastOutput_program>'), 1)
+
+    def test_merge_max_target_seqs(self):
+        filenames = []
+        for i, hits in enumerate(([('acc_1', 1e-5), ('acc_2', 1e-1)], [('acc_3', 1e-10), ('acc_4', 1)])):
+            filenames.append('{}.{}.xml'.format(self.prefix, i))
+            with open(filenames[-1], 'w') as f:
+                f.write(blast_xml(hits, 100))
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '5', max_target_seqs=2)
+        self.assertEqual(tools_hits(output.getvalue()), ['acc_3', 'acc_1'])
+        self.assertIn(b'<Hit_num>2</Hit_num>', output.getvalue())
+        self.assertNotIn(b'<Hit_num>3</Hit_num>', output.getvalue())
+
+        filenames = []
+        for i, lines in enumerate((['q1\tacc_1\t1e-5', 'q1\tacc_1\t1e-4', 'q1\tacc_2\t1e-3'],
+                                   ['q1\tacc_3\t1e-9'])):
+            filenames.append('{}.{}.tsv'.format(self.prefix, i))
+            with open(filenames[-1], 'w') as f:
+                f.write(blast_tabular([('q1', lines)], 'shard_{}'.format(i)))
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '6 qseqid sacc evalue', max_target_seqs=2)
+        # all HSPs of the kept subjects are reported
+        self.assertEqual(output.getvalue().decode().split()[1::3], ['acc_3', 'acc_1', 'acc_1'])
+
+    def test_merge_tabular(self):
+        filenames = []
+        for i, queries in enumerate(([('q1', ['q1\tacc_1\t1e-5']), ('q2', ['q2\tacc_2\t1e-3'])],
+                                     [('q1', ['q1\tacc_3\t1e-9', 'q1\tacc_4\t1e-2']), ('q2', [])])):
+            filenames.append('{}.{}.tsv'.format(self.prefix, i))
+            with open(filenames[-1], 'w') as f:
+                f.write(blast_tabular(queries, 'shard_{}'.format(i)))
+        self.assertEqual(sharding.shard_outfmt('6 qseqid sacc evalue'), '7 qseqid sacc evalue')
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '6 qseqid sacc evalue')
+        self.assertEqual(output.getvalue().decode().split(), ['q1', 'acc_3', '1e-9', 'q1', 'acc_1', '1e-5',
+                                                              'q1', 'acc_4', '1e-2', 'q2', 'acc_2', '1e-3'])
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '10 qseqid sacc evalue', max_target_seqs=2)
+        self.assertEqual(output.getvalue().decode().splitlines(), ['q1,acc_3,1e-9', 'q1,acc_1,1e-5', 'q2,acc_2,1e-3'])
+
+        # outfmt 7 keeps the comments of every query with the number of merged hits
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '7 qseqid sacc evalue', max_target_seqs=2, database='db')
+        self.assertEqual(output.getvalue().decode(),
+                         blast_tabular([('q1', ['q1\tacc_3\t1e-9', 'q1\tacc_1\t1e-5']),
+                                        ('q2', ['q2\tacc_2\t1e-3'])], 'db'))
+
+        # std is expanded among other format specifiers
+        for i, evalue in enumerate(('1e-5', '1e-9')):
+            with open(filenames[i], 'w') as f:
+                f.write(blast_tabular([('q1', ['\t'.join(['q1', 'acc_{}'.format(i)] + ['0'] * 8 +
+                                                          [evalue, '40', 'plus'])])], 'shard_{}'.format(i)))
+        output = io.BytesIO()
+        sharding.merge(filenames, output, '6 std sstrand')
+        self.assertEqual(output.getvalue().decode().split()[1::13], ['acc_1', 'acc_0'])
+
+
+def tools_hits(xml):
+    import xml.etree.ElementTree as ElementTree
+    return [e.text for e in ElementTree.fromstring(xml.split(b'\n', 1)[1]).iter('Hit_accession')]
+
+
+if __name__ == '__main__':
+    unittest.main()
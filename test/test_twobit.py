@@ -0,0 +1,69 @@
+import unittest
+import os
+import shutil
+from PrimerDesigner import twobit
+from PrimerDesigner.tools import tools
+
+
+class TwoBit(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta = os.path.join(os.getcwd(), 'temp', 'twobit.fa')
+        self.records = [('seq_1', 'ACGTACGTNNNNacgtaTTGCA'),
+                        ('seq_2', 'GGGG'),
+                        ('seq_3', tools.random_sequence(1001))]
+        with open(self.fasta, 'w') as f:
+            for name, seq in self.records:
+                f.write('>{} description\n{}\n'.format(name, seq))
+        self.filename = os.path.join(os.getcwd(), 'temp', 'twobit.2bit')
+
+    def tearDown(self):
+        for filename in (self.fasta, self.filename):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def test_round_trip(self):
+        twobit.write_2bit(self.fasta, self.filename)
+        with twobit.TwoBitReader(self.filename) as reader:
+            self.assertEqual(reader.names, [name for name, _ in self.records])
+            for name, seq in self.records:
+                self.assertEqual(reader.length(name), len(seq))
+                self.assertEqual(reader.sequence(name), seq)
+            self.assertEqual(reader.sequence('seq_1', 5, 15), self.records[0][1][5:15])
+            self.assertEqual(reader.sequence('seq_3', 333, 777), self.records[2][1][333:777])
+
+    def test_cache(self):
+        cache = twobit.TwoBitCache(os.path.join(os.getcwd(), 'temp', 'cache'))
+        filename = cache.get(self.fasta)
+        inode = os.stat(filename).st_ino
+        self.assertEqual(cache.get(self.fasta), filename)
+        # a cached file is only touched for the eviction order, not converted again
+        self.assertEqual(os.stat(filename).st_ino, inode)
+        os.remove(filename)
+
+    def test_cache_key_and_eviction(self):
+        directory = os.path.join(os.getcwd(), 'temp', 'cache_evict')
+        cache = twobit.TwoBitCache(directory, max_bytes=1)
+        try:
+            first = cache.get(self.fasta, key='first')
+            self.assertEqual(os.path.basename(first), 'first.2bit')
+            # the key is trusted, the content is not hashed again
+            self.assertEqual(cache.path('does_not_exist.fa', key='first'), first)
+            second = cache.get(self.fasta, key='second')
+            # the least recently used file is removed, the new one is kept although it exceeds the limit
+            self.assertFalse(os.path.isfile(first))
+            self.assertTrue(os.path.isfile(second))
+            cache.max_bytes = 2 * os.path.getsize(second)
+            first = cache.get(self.fasta, key='first')
+            os.utime(first, (1, 1))
+            cache.get(self.fasta, key='second')
+            cache.get(self.fasta, key='third')
+            self.assertEqual(sorted(os.listdir(directory)), ['second.2bit', 'third.2bit'])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
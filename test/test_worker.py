@@ -0,0 +1,91 @@
+import unittest
+import os
+import sqlite3
+import threading
+from PrimerDesigner import worker
+
+
+class JobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.result_db = os.path.join(os.getcwd(), 'temp', 'tmp_queue.jobs.db')
+        self.queue = worker.JobQueue(self.result_db)
+
+    def tearDown(self):
+        try:
+            os.remove(self.result_db)
+        except FileNotFoundError:
+            pass
+
+    def test_claim(self):
+        job_id = self.queue.enqueue('blast', {'parameters': {'sequence': 'ACGT'}})
+        claimed = self.queue.claim('worker_1')
+        self.assertEqual(claimed, (job_id, 'blast', {'parameters': {'sequence': 'ACGT'}}))
+        self.assertIsNone(self.queue.claim('worker_2'))
+        self.assertTrue(self.queue.heartbeat(job_id, 'worker_1'))
+        self.assertFalse(self.queue.heartbeat(job_id, 'worker_2'))
+        self.assertTrue(self.queue.finish(job_id, 'worker_1', result={'stdout_file': None}))
+        self.assertEqual(self.queue.get(job_id)['status'], 'finished')
+        self.assertTrue(self.queue.load_job(job_id).finished)
+
+    def test_result_path(self):
+        job = worker.BlastJob(conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'))
+        job.stdout_file = os.path.join(job.directory_results, 'run.out')
+        self.assertEqual(worker.Worker.result_path(job), 'run.out')
+        job.stdout_file = '/elsewhere/run.out'
+        self.assertEqual(worker.Worker.result_path(job), '/elsewhere/run.out')
+
+        # a server on another machine resolves the output against its own mount of result_dir
+        job_id = self.queue.enqueue('blast', {})
+        self.queue.claim('worker_1')
+        self.queue.finish(job_id, 'worker_1', result={'stdout_file': 'run.out'})
+        self.assertEqual(self.queue.load_job(job_id, directory_results='/mnt/results').stdout_file,
+                         os.path.join('/mnt/results', 'run.out'))
+
+    def test_expired_lease(self):
+        job_id = self.queue.enqueue('blast', {})
+        self.queue.claim('worker_1', lease=-1)
+        self.assertEqual(self.queue.claim('worker_2')[0], job_id)
+        self.assertFalse(self.queue.finish(job_id, 'worker_1', result={}))
+        self.assertTrue(self.queue.finish(job_id, 'worker_2', result={}))
+
+    def test_failed_job(self):
+        job_id = self.queue.enqueue('unknown', {})
+        w = worker.Worker(self.queue, conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'))
+        self.assertTrue(w.run_once())
+        self.assertFalse(w.run_once())
+        job = self.queue.load_job(job_id)
+        self.assertTrue(job.error)
+        self.assertIn('unknown job kind', job.stderr)
+
+    def test_locked_database(self):
+        class LockedQueue(worker.JobQueue):
+            failures = 2
+
+            def claim(self, *args, **kwargs):
+                if self.failures > 0:
+                    self.failures -= 1
+                    raise sqlite3.OperationalError('database is locked')
+                return super().claim(*args, **kwargs)
+
+        queue = LockedQueue(self.result_db)
+        job_id = queue.enqueue('unknown', {})
+        w = worker.Worker(queue, conf_file=os.path.join(os.getcwd(), 'data', 'blast.conf'), poll_interval=0.01)
+        stop = threading.Event()
+        thread = threading.Thread(target=w.run, args=(stop, ))
+        thread.start()
+        try:
+            # the worker survives the errors and runs the job once the database is available again
+            for _ in range(500):
+                if queue.get(job_id)['status'] == 'failed':
+                    break
+                stop.wait(0.01)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(queue.failures, 0)
+        self.assertEqual(queue.get(job_id)['status'], 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main()